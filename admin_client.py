@@ -1,6 +1,7 @@
 import socket
 import configparser
 import json
+from simple_map.protocol import encode_message, recv_message
 
 
 print('parsing config...')
@@ -20,13 +21,76 @@ while not closed:
     if len(cmd.split(' ')) == 1:
         if cmd == 'quit' or cmd == 'exit':
             closed=True
+        elif cmd == 'stats':
+            server_con.sendall(encode_message(json.dumps({'op':'admin', 'arg':'stats'})))
+            data = recv_message(server_con)
+            if data == 'err':
+                print('Stats not available from server')
+            else:
+                stats = json.loads(data)
+                print('uptime: %ss' % stats['uptime_s'])
+                for name, value in sorted(stats['counters'].items()):
+                    print('%-18s %d' % (name, value))
+                print('%-18s %8s %8s %8s %8s %8s' % ('op', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+                for name, timing in stats['timings'].items():
+                    if timing['count']:
+                        print('%-18s %8d %8.2f %8.2f %8.2f %8.2f' % (name, timing['total'], timing['p50_ms'],
+                                                                   timing['p95_ms'], timing['p99_ms'], timing['max_ms']))
+                for name, room in sorted(stats['rooms'].items()):
+                    print('room %s: map %s (%d live edits%s), %d tokens, version %d, %d subscribers' % (
+                        name, room['map'], room.get('edits', 0), ', fog of war' if room.get('fog') else '',
+                        room['tokens'], room['version'], room['subscribers']))
     else:
         op, arg = cmd.split(' ', 1)
-        if op == 'map':
+        if op == 'join':
+            print('joining room %s' % arg)
+            server_con.sendall(encode_message(json.dumps({'op':'join', 'arg':arg})))
+            data = recv_message(server_con)
+            if data != 'ack':
+                print('Join not acknowledged by server')
+        elif op == 'map':
             print('changing map to %s' % arg)
-            server_con.sendall(json.dumps({'op':'admin', 'arg':'set_map', 'data':arg}).encode())
-            resp_len = int(server_con.recv(8).decode())
-            data = server_con.recv(resp_len)
-            if data.decode() != 'ack':
+            server_con.sendall(encode_message(json.dumps({'op':'admin', 'arg':'set_map', 'data':arg})))
+            data = recv_message(server_con)
+            if data != 'ack':
                 print('Update not acknowledged by server')
+        elif op == 'fog':
+            if arg not in ('on', 'off'):
+                print('usage: fog on|off')
+                continue
+            server_con.sendall(encode_message(json.dumps({'op':'admin', 'arg':'fog', 'data':arg == 'on'})))
+            data = recv_message(server_con)
+            if data != 'ack':
+                print('Fog not acknowledged by server')
+        elif op == 'encounter':
+            # every token of the file, and its map if it names one, in one request
+            try:
+                with open(arg, 'r') as fin:
+                    encounter = json.load(fin)
+            except (OSError, ValueError) as e:
+                print('Failed to read encounter: %s' % e)
+                continue
+            if not isinstance(encounter, dict) or not isinstance(encounter.get('tokens', {}), dict):
+                print('usage: encounter FILE, a JSON object with a "tokens" object of name -> {"row", "col", "img"}'
+                      ' and optionally "map" and "replace"')
+                continue
+            print('loading encounter %s: %d tokens' % (arg, len(encounter.get('tokens', {}))))
+            server_con.sendall(encode_message(json.dumps({'op':'admin', 'arg':'load_encounter', 'data':encounter})))
+            data = recv_message(server_con)
+            if data != 'ack':
+                print('Encounter not accepted by server')
+        elif op == 'export':
+            server_con.sendall(encode_message(json.dumps({'op':'admin', 'arg':'export_encounter'})))
+            data = recv_message(server_con)
+            if data == 'err':
+                print('Export not available from server')
+                continue
+            encounter = json.loads(data)
+            try:
+                with open(arg, 'w') as fout:
+                    json.dump(encounter, fout, indent=1, sort_keys=True)
+            except OSError as e:
+                print('Failed to write encounter: %s' % e)
+                continue
+            print('exported %d tokens on %s to %s' % (len(encounter['tokens']), encounter['map'], arg))
 server_con.close()
@@ -0,0 +1,35 @@
+import json
+import platform
+import sys
+import time
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(samples):
+    # timings in seconds -> milliseconds summary
+    if not samples:
+        return {'count':0}
+    return {'count':len(samples),
+            'mean_ms':1000.0 * sum(samples) / len(samples),
+            'p50_ms':1000.0 * percentile(samples, 50),
+            'p99_ms':1000.0 * percentile(samples, 99),
+            'max_ms':1000.0 * max(samples)}
+
+def write_results(name, params, results, output=None):
+    report = {'benchmark':name,
+              'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python':sys.version.split()[0],
+              'platform':platform.platform(),
+              'params':params,
+              'results':results}
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w', encoding='utf-8') as fout:
+            fout.write(text + '\n')
@@ -0,0 +1,85 @@
+import argparse
+import glob
+import os
+import random
+import time
+
+# headless unless the caller picked a video driver
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+from simple_map import Game
+from simple_map.token import Token
+from bench import summarize, write_results
+
+# Renders every map at a few zoom levels and token counts with the same
+# Game drawing code the client uses, without a server. Run from the repo root.
+def place_tokens(game, count):
+    rng = random.Random(count)
+    token_names = sorted(game.token_images)
+    game.set_tokens({'token%d' % i: Token(rng.randrange(game.game_grid.num_rows),
+                                           rng.randrange(game.grid_cols),
+                                           rng.choice(token_names))
+                     for i in range(count)})
+
+def time_frames(game, frames, draw, pan=0):
+    samples = []
+    for frame in range(frames):
+        if pan:
+            x, y = game.view_offset
+            game.view_offset = (x + pan, y)
+        game.display.fill(game.CLR_GREY)
+        started = time.perf_counter()
+        draw()
+        samples += [time.perf_counter() - started]
+    return summarize(samples)
+
+def bench_map(game, mapfile, tile_sizes, token_counts, frames):
+    results = {}
+    game.game_grid = Game.load_map(mapfile)
+    for tile_size in tile_sizes:
+        game.tile_size = tile_size
+        game.rescale_assets()
+        game.view_offset = (0, 0)
+        game.get_palette_tiles()
+        cold = []
+        for frame in range(frames):
+            game.map_chunks.clear()
+            started = time.perf_counter()
+            game.draw_tiles(game.display)
+            cold += [time.perf_counter() - started]
+        entry = {'cold_tiles':summarize(cold),
+                 'warm_tiles':time_frames(game, frames, lambda: game.draw_tiles(game.display)),
+                 'pan_tiles':time_frames(game, frames, lambda: game.draw_tiles(game.display), pan=-game.tile_size // 4)}
+        for count in token_counts:
+            place_tokens(game, count)
+            game.view_offset = (0, 0)
+            entry['tokens_%d' % count] = time_frames(game, frames, game.draw_tokens)
+        game.set_tokens({})
+        results['tile_size_%d' % tile_size] = entry
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark map and token rendering')
+    parser.add_argument('maps', nargs='*', help='map files in maps/ (default: all of them)')
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[16, 32, 64, 96])
+    parser.add_argument('--tokens', type=int, nargs='+', default=[0, 50, 200])
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--width', type=int, default=1800)
+    parser.add_argument('--height', type=int, default=1000)
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    maps = args.maps or sorted(os.path.basename(f) for f in glob.glob('maps/*.csv'))
+    game = Game(server_hostname=None, server_port=None,
+                display_width=args.width, display_height=args.height,
+                map_margin=10, tile_padding=1, tile_size=64, font_size=18)
+    game.prefetch_zoom_levels = False
+    results = {}
+    for mapfile in maps:
+        results[mapfile] = bench_map(game, mapfile, args.tile_sizes, args.tokens, args.frames)
+    pygame.quit()
+    write_results('render', vars(args), results, args.output)
+
+if __name__ == '__main__':
+    main()
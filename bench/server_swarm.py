@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from simple_map.protocol import encode_message, read_message
+from bench import summarize, write_results
+
+# Simulated players talking to the server the way NetworkClient does: each
+# joins a room, subscribes to pushes, reports a viewport and fetches the map
+# once. After that it only places a token and pans now and then, and fetches
+# the map again when a new one is pushed. Nothing is polled, so the load is
+# the pushes fanned out to everyone in the room.
+# moves: (token name, row, col) -> when it was placed, shared by the whole
+# swarm so whoever gets it pushed can tell how long that took.
+class SwarmClient:
+    def __init__(self, room, move_rate, pan_rate, token_names, moves, viewport=0):
+        self.room = room
+        self.viewport = viewport
+        self.move_rate = move_rate
+        self.pan_rate = pan_rate
+        self.token_names = token_names
+        self.moves = moves
+        self.next_id = 0
+        self.waiting = {}
+        self.latencies = {}
+        self.push_delays = []
+        self.pushes = {}
+        self.bytes_in = 0
+        self.map_hash = None
+        self.writer = None
+        self.panned = 0
+
+    async def run(self, host, port, duration):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        receiver = asyncio.ensure_future(self.receive(reader))
+        try:
+            await self.request({'op':'join', 'arg':self.room})
+            self.send({'op':'subscribe', 'arg':'tokens', 'data':None})
+            self.pan()
+            await self.fetch_map()
+            end = time.perf_counter() + duration
+            rate = self.move_rate + (self.pan_rate if self.viewport else 0)
+            while rate > 0:
+                # moves and pans arrive at random like a player's, not in lockstep with the other clients
+                await asyncio.sleep(random.expovariate(rate))
+                if time.perf_counter() >= end:
+                    break
+                if random.random() < self.move_rate / rate:
+                    token = {'name':random.choice(self.token_names), 'row':random.randrange(50),
+                             'col':random.randrange(50), 'img':'black_circle'}
+                    self.moves[(token['name'], token['row'], token['col'])] = time.perf_counter()
+                    await self.request({'op':'set', 'arg':'place_token', 'data':token})
+                else:
+                    self.pan()
+            if rate <= 0:
+                await asyncio.sleep(duration)
+        finally:
+            receiver.cancel()
+            self.writer.close()
+
+    def send(self, message):
+        self.writer.write(encode_message(json.dumps(message)))
+
+    def pan(self):
+        if self.viewport:
+            row, col = random.randrange(50), random.randrange(50)
+            self.send({'op':'viewport', 'data':[row, col, row + self.viewport, col + self.viewport]})
+            self.panned = time.perf_counter()
+
+    async def fetch_map(self):
+        # the conditional get Game sends at startup and whenever the server pushes a new map
+        response = await self.request({'op':'get', 'arg':'map', 'data':{'hash':self.map_hash}})
+        if response:
+            self.map_hash = json.loads(response)['hash']
+
+    async def request(self, request):
+        self.next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        op = request['op'] if request['op'] == 'join' else request['op'] + ' ' + request['arg']
+        self.waiting[self.next_id] = (future, op, time.perf_counter())
+        self.send(dict(request, id=self.next_id))
+        await self.writer.drain()
+        return await future
+
+    async def receive(self, reader):
+        try:
+            while True:
+                message = await read_message(reader)
+                self.bytes_in += len(message.encode('utf8')) + 8
+                message = json.loads(message)
+                if 'id' in message:
+                    future, op, started = self.waiting.pop(message['id'])
+                    self.latencies.setdefault(op, []).append(time.perf_counter() - started)
+                    future.set_result(message['resp'])
+                else:
+                    self.pushes[message.get('type')] = self.pushes.get(message.get('type'), 0) + 1
+                    if message.get('type') == 'tokens':
+                        for name, token in message['tokens'].items():
+                            placed = self.moves.get((name, token['row'], token['col']))
+                            # moves from before a pan come with it, they were not waiting on the server
+                            if placed is not None and placed > self.panned:
+                                self.push_delays += [time.perf_counter() - placed]
+                    elif message.get('type') == 'map' and message['map'] != self.map_hash:
+                        asyncio.ensure_future(self.fetch_map())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(mapfile, port, state_dir):
+    server = subprocess.Popen([sys.executable, 'map_server.py', mapfile, '--host', '127.0.0.1',
+                               '--port', str(port), '--state-dir', state_dir],
+                              stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+async def run_swarm(host, port, clients, rooms, move_rate, pan_rate, tokens, duration, viewport):
+    swarm = []
+    moves = {}
+    for index in range(clients):
+        room = 'bench%d' % (index % rooms)
+        token_names = ['%s_token%d' % (room, i) for i in range(tokens)]
+        swarm += [SwarmClient(room, move_rate, pan_rate, token_names, moves, viewport)]
+    await asyncio.gather(*[client.run(host, port, duration) for client in swarm])
+    return swarm
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test map_server.py with simulated clients')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--move-rate', type=float, default=0.5, help='place_token requests per second per client')
+    parser.add_argument('--pan-rate', type=float, default=0.2, help='viewport changes per second per client with --viewport')
+    parser.add_argument('--tokens', type=int, default=100, help='distinct tokens per room')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--viewport', type=int, default=0, help='cells per side each client reports seeing, 0 for all')
+    parser.add_argument('--map', default='huge_field.csv')
+    parser.add_argument('--host', help='use a running server instead of starting one')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    server = None
+    host, port = args.host, args.port
+    with tempfile.TemporaryDirectory() as state_dir:
+        if host is None:
+            host, port = '127.0.0.1', free_port()
+            server = start_server(args.map, port, state_dir)
+        try:
+            started = time.perf_counter()
+            swarm = asyncio.get_event_loop().run_until_complete(
+                run_swarm(host, port, args.clients, args.rooms, args.move_rate, args.pan_rate, args.tokens,
+                          args.duration, args.viewport))
+            elapsed = time.perf_counter() - started
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    latencies = {}
+    for client in swarm:
+        for op, samples in client.latencies.items():
+            latencies.setdefault(op, []).extend(samples)
+    total = sum(len(samples) for samples in latencies.values())
+    pushes = {}
+    for client in swarm:
+        for kind, count in client.pushes.items():
+            pushes[kind] = pushes.get(kind, 0) + count
+    push_delays = [delay for client in swarm for delay in client.push_delays]
+    results = {'requests':total,
+               'requests_per_s':total / elapsed,
+               'pushes':pushes,
+               'pushes_per_s':sum(pushes.values()) / elapsed,
+               'bytes_in':sum(client.bytes_in for client in swarm),
+               'latency':{op: summarize(samples) for op, samples in latencies.items()},
+               # from a move being sent to each client that is pushed it getting it
+               'push_delay':summarize(push_delays)}
+    write_results('server_swarm', vars(args), results, args.output)
+
+if __name__ == '__main__':
+    main()
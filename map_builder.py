@@ -1,23 +1,35 @@
+from simple_map.metrics import startup
 import pygame
 import pygame_gui
 from simple_map import Game
+from simple_map.tile_grid import TileGrid
+from simple_map.editing import MapEditor, rect_cells, line_cells, brush_cells, flood_cells
+from simple_map.chunked_map import write_chunked
+from simple_map.assets import AssetDirectory
+from simple_map.name_index import NameIndex
 import configparser
-import csv
 import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 from pathlib import Path
+startup.mark('imports')
 
 class TileSelectionDialog(pygame_gui.elements.UIPanel):
     def __init__(self, manager, tiles, pos, height):
+        # tiles: name -> thumbnail no bigger than a tile button
         self.tiles = tiles
-        self.tile_options = sorted(list(self.tiles.keys()))
+        self.index = NameIndex(self.tiles.keys())
+        self.tile_options = self.index.search('')
         self.button_pad = 10
-        self.buttons_per_page = 10
+        # only the visible rows of the list get buttons, scrolling changes what they show
+        self.buttons_per_page = max(1, (height - 130) // (64+self.button_pad))
         self.tile_buttons = []
         self.tile_images = []
-        self.selected_tile = 0
-        self.active_page = 0
-        self.page_max = len(self.tile_options) // self.buttons_per_page
+        self.selected_image = self.tile_options[0]
+        self.first_option = 0
         self.pos = pos
         pygame_gui.elements.UIPanel.__init__(self,
                                              starting_layer_height=10,
@@ -27,45 +39,115 @@ class TileSelectionDialog(pygame_gui.elements.UIPanel):
                                                     container=self,
                                                     relative_rect=pygame.Rect((10,20),(100,30)),
                                                     manager=manager)
-        self.btnNext = pygame_gui.elements.UIButton(text='>',
+        self.btnUndo = pygame_gui.elements.UIButton(text='Undo',
                                                     container=self,
-                                                    relative_rect=pygame.Rect((35,70),(25,30)),
+                                                    relative_rect=pygame.Rect((120,20),(75,30)),
                                                     manager=manager)
-        self.btnPrev = pygame_gui.elements.UIButton(text='<',
+        self.btnRedo = pygame_gui.elements.UIButton(text='Redo',
                                                     container=self,
-                                                    relative_rect=pygame.Rect((10,70),(25,30)),
+                                                    relative_rect=pygame.Rect((200,20),(75,30)),
                                                     manager=manager)
+        self.btnSaveChunked = pygame_gui.elements.UIButton(text='Save as .smap',
+                                                           container=self,
+                                                           relative_rect=pygame.Rect((120,70),(155,30)),
+                                                           manager=manager)
+        self.txtFilter = pygame_gui.elements.UITextEntryLine(container=self,
+                                                             relative_rect=pygame.Rect((10,70),(100,30)),
+                                                             manager=manager)
+        self.scrollTiles = pygame_gui.elements.UIVerticalScrollBar(container=self,
+                                                                   relative_rect=pygame.Rect((80,120),(20,self.buttons_per_page*(64+self.button_pad)-self.button_pad)),
+                                                                   visible_percentage=1.0,
+                                                                   manager=manager)
         for i in range(self.buttons_per_page):
             btnTile = pygame_gui.elements.UIButton(container=self,
                                                    text='tile%d'%i,
                                                    relative_rect=pygame.Rect((10,120 + i*(64+self.button_pad)),(64,64)),
                                                    manager=manager)
-            btnTile.tile_index = i
-            btnTile.img_name = self.tile_options[i]
+            btnTile.img_name = None
+            # the mouse wheel scrolls the list over the tiles too
+            self.scrollTiles.join_focus_sets(btnTile)
             self.tile_buttons += [btnTile]
 
             imgTile = pygame_gui.elements.UIImage(container=self,
                                                   relative_rect=pygame.Rect((10,120 + i*(64+self.button_pad)),(64,64)),
-                                                  image_surface=self.tiles[self.tile_options[i]],
+                                                  image_surface=self.tiles[self.tile_options[0]],
                                                   manager=manager)
             self.tile_images += [imgTile]
-
+        self.set_filter('')
+        
+        self.tool_buttons = []
+        for i, tool in enumerate(['brush', 'line', 'rect', 'fill']):
+            btnTool = pygame_gui.elements.UIButton(container=self,
+                                                   text=tool.capitalize(),
+                                                   relative_rect=pygame.Rect((120,120 + i*40),(90,30)),
+                                                   manager=manager)
+            btnTool.tool = tool
+            self.tool_buttons += [btnTool]
+        self.lblBrush = pygame_gui.elements.UILabel(container=self,
+                                                    relative_rect=pygame.Rect((120,280),(150,30)),
+                                                    manager=manager,
+                                                    text='')
+        self.btnExport = pygame_gui.elements.UIButton(text='Export PNG',
+                                                      container=self,
+                                                      relative_rect=pygame.Rect((120,320),(155,30)),
+                                                      manager=manager)
+        self.brush_size = 0
+        self.select_tool('brush')
+        self.set_brush_size(0)
+    
+    def select_tool(self, tool):
+        self.tool = tool
+        for btnTool in self.tool_buttons:
+            if btnTool.tool == tool:
+                btnTool.select()
+            else:
+                btnTool.unselect()
+    
+    def set_brush_size(self, brush_size):
+        self.brush_size = max(0, min(brush_size, 10))
+        self.lblBrush.set_text('Brush size: %d  [ ]' % self.brush_size)
         
     def get_selected_rect(self):
-        return pygame.Rect((self.pos[0]+10+2,120 + self.selected_tile*(64+self.button_pad)+2),(64,64))
+        # None while the selected tile is scrolled or filtered out of view
+        for i, btnTile in enumerate(self.tile_buttons):
+            if btnTile.img_name == self.selected_image:
+                return pygame.Rect((self.pos[0]+10+2,120 + i*(64+self.button_pad)+2),(64,64))
+        return None
         
     def get_selected_image(self):
-        return self.tile_buttons[self.selected_tile].img_name
+        return self.selected_image
+    
+    def set_filter(self, text):
+        self.tile_options = self.index.search(text)
+        self.scrollTiles.set_visible_percentage(min(1.0, self.buttons_per_page / max(1, len(self.tile_options))))
+        self.scrollTiles.reset_scroll_position()
+        self.scrollTiles.redraw_scrollbar()
+        self.first_option = 0
+        self.update_images()
+    
+    def update(self, time_delta):
+        pygame_gui.elements.UIPanel.update(self, time_delta)
+        if self.scrollTiles.check_has_moved_recently():
+            last_first = max(0, len(self.tile_options) - self.buttons_per_page)
+            first_option = min(last_first, round(self.scrollTiles.start_percentage * len(self.tile_options)))
+            if first_option != self.first_option:
+                self.first_option = first_option
+                self.update_images()
     
     def update_images(self):
         for i in range(self.buttons_per_page):
-            img_index = i + self.buttons_per_page*self.active_page
-            if img_index < len(self.tile_options):
-                self.tile_images[i].set_image(self.tiles[self.tile_options[img_index]])
-                self.tile_buttons[i].img_name = self.tile_options[img_index]
+            img_index = i + self.first_option
+            img_name = self.tile_options[img_index] if img_index < len(self.tile_options) else None
+            if img_name == self.tile_buttons[i].img_name:
+                continue
+            self.tile_buttons[i].img_name = img_name
+            if img_name is None:
+                self.tile_buttons[i].hide()
+                self.tile_images[i].hide()
             else:
-                self.tile_images[i].set_image(self.tiles[self.tile_options[0]])
-                self.tile_buttons[i].img_name = self.tile_options[0]
+                self.tile_images[i].set_image(self.tiles[img_name])
+                self.tile_buttons[i].show()
+                self.tile_images[i].show()
 
 
 print('parsing config...')
@@ -79,35 +161,75 @@ font_size = int(conf.get('Graphics', 'Font Size'))
 
 conf_res = conf.get('Graphics', 'Resolution')
 
-mapfile = input('map filename>').strip()
-if Path(os.path.join('maps', mapfile)).exists():
-    game_grid = Game.load_map(mapfile)
-else:
-    print('map not found, creating new map...')
-    numrows = int(input('rows>'))
-    numcols = int(input('cols>'))
-    game_grid = []
-    for _ in range(numrows):
-        row = []
-        for _ in range(numcols):
-            row += ['grass']
-        game_grid += [row]
+host = conf.get('Server', 'Hostname')
+port = int(conf.get('Server', 'Port'))
+room = conf.get('Server', 'Room', fallback=None)
+
+mapfile = input('map filename (blank to edit the server\'s map live)>').strip()
+startup.skip()
+# live edits go to the server as they are made and reach the players right away
+live = not mapfile
+autosave_dir = None
+restored = False
+if not live:
+    if Path(os.path.join('maps', mapfile)).exists():
+        game_grid = Game.load_map(mapfile)
+    else:
+        print('map not found, creating new map...')
+        numrows = int(input('rows>'))
+        numcols = int(input('cols>'))
+        startup.skip()
+        game_grid = TileGrid.blank(numrows, numcols, 'grass')
+    startup.mark('map')
+
+    # edits since the last save are journaled here in case the builder does not exit cleanly
+    autosave_dir = os.path.join('autosave', mapfile)
+    autosaved_grid = MapEditor.recover(autosave_dir)
+    startup.mark('autosave')
+    if autosaved_grid is not None:
+        if input('unsaved changes found for this map, restore them? (y/n)>').strip().lower() == 'y':
+            game_grid = autosaved_grid
+            restored = True
+        startup.skip()
 
 display_width = int(conf_res.split('x')[0])
 display_height = int(conf_res.split('x')[1])
 print('spawning game instance...')
-game = Game(server_hostname=None,
-            server_port=None,
+game = Game(server_hostname=host if live else None,
+            server_port=port if live else None,
             display_width=display_width,
             display_height=display_height,
             map_margin=map_margin,
             tile_padding=tile_padding,
             tile_size=tile_size,
             font_size=font_size,
-            refresh_period=1)
+            room=room)
 
-game.game_grid = game_grid
-game.mapfile = mapfile
+def send_cells(changes):
+    # sent with the next process_network, the server checks it is for the map it has
+    game.network.send_request({'op':'set', 'arg':'cells', 'data':{'map':game.map_hash, 'cells':changes}}, 'cells')
+
+def live_editor():
+    return MapEditor(game.game_grid, game.set_tile, on_change=send_cells)
+
+if live:
+    print('fetching map from server...')
+    deadline = time.time() + 10
+    while not game.game_grid:
+        if time.time() > deadline:
+            print('Failed to get the map from the server')
+            pygame.quit()
+            quit()
+        game.process_network()
+        pygame.event.pump()
+        time.sleep(0.05)
+    mapfile = game.mapfile
+    editor = live_editor()
+    startup.mark('map')
+else:
+    game.game_grid = game_grid
+    game.mapfile = mapfile
+    editor = MapEditor(game_grid, game.set_tile, autosave_dir, saved=not restored, path=os.path.join('maps', mapfile))
 
 game.clock = pygame.time.Clock()
 game.closed = False
@@ -116,9 +238,52 @@ game.closed = False
             
     
 
-tile_dialog = TileSelectionDialog(manager=game.ui_manager, tiles=game.tiles, pos=(display_width-300, 0), height=display_height)
+# palette thumbnails are cached next to the full size tiles, only changed tiles are scaled again
+thumbnails = AssetDirectory('tiles', thumbnail_size=64).load()
+tile_dialog = TileSelectionDialog(manager=game.ui_manager, tiles=thumbnails, pos=(display_width-300, 0), height=display_height)
+startup.mark('palette')
 
 closed = False
+# cell where the current line, rect or brush drag started, and where it is now
+drag_start = None
+drag_end = None
+
+def cell_at(pos):
+    if pos[0] < (display_width-300) and game.minimap_cell(pos) is None:
+        return game.x_y_to_row_col(*pos)
+    return None
+
+def preview_rect(start, end):
+    x0, y0 = game.row_col_to_x_y(min(start[0], end[0]), min(start[1], end[1]))
+    x1, y1 = game.row_col_to_x_y(max(start[0], end[0]) + 1, max(start[1], end[1]) + 1)
+    return pygame.Rect(x0, y0, x1 - x0 - game.tile_padding, y1 - y0 - game.tile_padding)
+
+def cell_centre(cell):
+    x, y = game.row_col_to_x_y(*cell)
+    return (x + game.tile_size // 2, y + game.tile_size // 2)
+
+def export_png(path):
+    # the export runs as its own process so its render workers do not re-run this script
+    grid = game.game_grid.copy()
+    def run():
+        try:
+            if getattr(sys, 'frozen', False):
+                from simple_map.export import export_map
+                export_map(grid, path, game.tile_size, game.tile_padding, workers=0)
+                print('wrote %s' % path)
+                return
+            fd, grid_path = tempfile.mkstemp(suffix='.smap')
+            os.close(fd)
+            try:
+                write_chunked(grid, grid_path)
+                subprocess.run([sys.executable, '-m', 'simple_map.export', grid_path, path,
+                                '--tile-size', str(game.tile_size), '--tile-padding', str(game.tile_padding)],
+                               check=True)
+            finally:
+                os.remove(grid_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Failed to export %s: %s' % (path, e))
+    threading.Thread(target=run, daemon=True).start()
 
 while not closed:
     time_delta = game.clock.tick(60)/1000.0
@@ -128,47 +293,110 @@ while not closed:
             closed = True
         elif event.type == pygame.USEREVENT:
             if event.user_type == pygame_gui.UI_BUTTON_PRESSED:
-                if event.ui_element == tile_dialog.btnNext:
-                    if tile_dialog.active_page < tile_dialog.page_max:
-                        tile_dialog.active_page += 1
-                        tile_dialog.update_images()
-                elif event.ui_element == tile_dialog.btnPrev:
-                    if tile_dialog.active_page > 0:
-                        tile_dialog.active_page -= 1
-                        tile_dialog.update_images()
-                elif event.ui_element in tile_dialog.tile_buttons:
-                    tile_dialog.selected_tile = event.ui_element.tile_index
+                if event.ui_element in tile_dialog.tile_buttons:
+                    tile_dialog.selected_image = event.ui_element.img_name
+                elif event.ui_element in tile_dialog.tool_buttons:
+                    tile_dialog.select_tool(event.ui_element.tool)
+                elif event.ui_element == tile_dialog.btnUndo:
+                    editor.undo()
+                elif event.ui_element == tile_dialog.btnRedo:
+                    editor.redo()
                 elif event.ui_element == tile_dialog.btnSave:
-                    with open(os.path.join('maps',mapfile), 'w', newline='\n', encoding='utf-8') as fout:
-                        writer = csv.writer(fout)
-                        for row in game.game_grid:
-                            writer.writerow(row)
+                    # written in the background, editing carries on meanwhile
+                    editor.save(os.path.join('maps',mapfile), done=lambda path: print('saved %s' % path))
+                elif event.ui_element == tile_dialog.btnSaveChunked:
+                    # chunked copy that large maps can be opened from without reading them whole
+                    chunked_path = os.path.join('maps', os.path.splitext(mapfile)[0] + '.smap')
+                    editor.save(chunked_path, done=lambda path: print('saved %s' % path))
+                elif event.ui_element == tile_dialog.btnExport:
+                    export_png(os.path.join('maps', os.path.splitext(mapfile)[0] + '.png'))
+            elif event.user_type == pygame_gui.UI_TEXT_ENTRY_CHANGED:
+                if event.ui_element == tile_dialog.txtFilter:
+                    tile_dialog.set_filter(event.text)
         elif event.type == pygame.MOUSEBUTTONDOWN:
-            if event.button == 1 and event.pos[0] < (display_width-300):
-                pos_rc = game.x_y_to_row_col(*event.pos)
+            if game.minimap_cell(event.pos) is not None:
+                # jumps the view, painting under the minimap is not possible
+                game.process_event(event)
+            elif event.button == 1:
+                pos_rc = cell_at(event.pos)
                 if pos_rc is not None:
-                    game.game_grid[pos_rc[0]][pos_rc[1]] = tile_dialog.get_selected_image()
+                    tile_name = tile_dialog.get_selected_image()
+                    if tile_dialog.tool == 'fill':
+                        editor.apply(flood_cells(game.game_grid, *pos_rc), tile_name)
+                    else:
+                        drag_start = drag_end = pos_rc
+                        if tile_dialog.tool == 'brush':
+                            editor.begin_stroke()
+                            editor.apply(brush_cells(*pos_rc, tile_dialog.brush_size), tile_name)
             elif event.button in [4,5]:
                 if event.pos[0] < (display_width-300):
                     game.process_event(event)
+        elif event.type == pygame.MOUSEMOTION:
+            pos_rc = cell_at(event.pos)
+            if drag_start is not None and pos_rc is not None and pos_rc != drag_end:
+                if tile_dialog.tool == 'brush':
+                    # paint along the path so fast drags leave no gaps
+                    cells = []
+                    for row, col in line_cells(*drag_end, *pos_rc)[1:]:
+                        cells += brush_cells(row, col, tile_dialog.brush_size)
+                    editor.apply(cells, tile_dialog.get_selected_image())
+                drag_end = pos_rc
+        elif event.type == pygame.MOUSEBUTTONUP:
+            if event.button == 1 and drag_start is not None:
+                if tile_dialog.tool == 'line':
+                    editor.apply(line_cells(*drag_start, *drag_end), tile_dialog.get_selected_image())
+                elif tile_dialog.tool == 'rect':
+                    editor.apply(rect_cells(*drag_start, *drag_end), tile_dialog.get_selected_image())
+                editor.end_stroke()
+                drag_start = drag_end = None
                     
-        elif event.type == pygame.KEYDOWN:
-            game.process_event(event)
+        elif event.type == pygame.KEYDOWN and not tile_dialog.txtFilter.is_focused:
+            ctrl = pygame.key.get_mods() & pygame.KMOD_CTRL
+            shift = pygame.key.get_mods() & pygame.KMOD_SHIFT
+            if ctrl and (event.key == pygame.K_y or (event.key == pygame.K_z and shift)):
+                editor.redo()
+            elif ctrl and event.key == pygame.K_z:
+                editor.undo()
+            elif event.key == pygame.K_LEFTBRACKET:
+                tile_dialog.set_brush_size(tile_dialog.brush_size - 1)
+            elif event.key == pygame.K_RIGHTBRACKET:
+                tile_dialog.set_brush_size(tile_dialog.brush_size + 1)
+            else:
+                game.process_event(event)
                 
         game.ui_manager.process_events(event)
     
+    if live:
+        # sends this frame's edits, applies everyone else's and fetches a new map when the server pushes one
+        game.process_network()
+        if game.game_grid is not editor.grid:
+            print('map changed on the server, undo history cleared')
+            editor.close()
+            editor = live_editor()
+            mapfile = game.mapfile
+    
     game.ui_manager.update(time_delta)
     
     game.display.fill(game.CLR_GREY)
     
     game.draw_tiles(game.display)
+    game.draw_minimap(game.display)
     
     game.ui_manager.draw_ui(game.display)
     
-    pygame.draw.rect(game.display, (255,0,0), tile_dialog.get_selected_rect(), 3)
+    selected_rect = tile_dialog.get_selected_rect()
+    if selected_rect is not None:
+        pygame.draw.rect(game.display, (255,0,0), selected_rect, 3)
+    
+    if drag_start is not None:
+        if tile_dialog.tool == 'rect':
+            pygame.draw.rect(game.display, (255,0,0), preview_rect(drag_start, drag_end), 3)
+        elif tile_dialog.tool == 'line':
+            pygame.draw.line(game.display, (255,0,0), cell_centre(drag_start), cell_centre(drag_end), 3)
     
     pygame.display.update()
-    game.clock.tick(60)
+    startup.finish()
 
+editor.close()
 pygame.quit()
 quit()
\ No newline at end of file
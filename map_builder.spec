@@ -7,7 +7,7 @@ a = Analysis(['map_builder.py'],
              pathex=['C:\\Users\\Matt\\workspace\\simple-map'],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             hiddenimports=['pkg_resources.py2_warn'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
@@ -1,52 +1,801 @@
+import argparse
 import asyncio
+import base64
 import json
 import csv
-import sys
+import os
+import time
+from collections import OrderedDict, deque
+from simple_map.protocol import encode_message, read_message
+from simple_map.map_codec import encode_grid, map_hash, group_cells
+from simple_map.chunked_map import load_map
+from simple_map.journal import Journal
+from simple_map.metrics import Metrics
+from simple_map.fov import OpacityGrid, cell_runs
+from simple_map.token import image_scale
 
 HOST = '192.168.2.26'  # Standard loopback interface address (localhost)
 PORT = 65432        # Port to listen on (non-privileged ports are > 1023)
 
-mapfile = sys.argv[1]
+DEFAULT_ROOM = 'default'
+STATE_DIR = 'server_state'  # Journal and snapshots of all rooms, restored on startup
+BUCKET_SIZE = 16  # cells per side of a token index bucket
+VIEW_MARGIN = 8  # cells around a client's viewport it still gets tokens for
+EDIT_LOG_SIZE = 1000  # map edits kept for pushing to clients that fall behind
+SIGHT_RADIUS = 20  # cells a token sees in fog of war
+SIGHT_CACHE_SIZE = 256  # positions whose field of view is kept, the least recently used go first
+POSITIONS_PERIOD = 1.0  # seconds between pushes of where every token is, for the minimaps of clients with a viewport
 
-tokens = {}
+# One table: its map, its tokens and the connections subscribed to it.
+class Room:
+    def __init__(self, name, mapfile):
+        self.name = name
+        self.set_map(mapfile)
+        self.tokens = {}
+        # token name -> version of its last change, kept in ascending version order
+        self.token_versions = {}
+        # token name -> version at which it was removed
+        self.removed_tokens = {}
+        # bumped on every token change; clients subscribe from a version
+        self.version = 0
+        # version of the last wipe of all tokens, deltas from before it are not possible
+        self.reset_version = 0
+        # (row // BUCKET_SIZE, col // BUCKET_SIZE) -> names of the tokens placed in that bucket
+        self.token_buckets = {}
+        self.changed = asyncio.Condition()
+        self.subscribers = set()
+        # with fog of war on, players only get what their tokens can see
+        self.fog = False
+        # encoded deltas for the current version keyed by base version, shared by all subscribers
+        self.delta_cache = {}
+        self.delta_cache_version = None
+        # (delta, encoded) for the current version keyed by what a viewport's delta depends on,
+        # shared by the subscribers with the same view
+        self.area_cache = {}
+        self.area_cache_version = None
+        # where every token is, encoded once per version
+        self.positions_cache = None
+        self.positions_cache_version = None
 
-async def handle_client(reader, writer):
-    global tokens
-    global mapfile
-    request = None
-    while request != 'quit':
-        request = (await reader.read(255)).decode('utf8')
-        req = json.loads(request)
-        if 'op' in req and 'arg' in req:
-            if req['op'] == 'get':
-                if req['arg'] == 'map':
-                    response = json.dumps(mapfile)
-                elif req['arg'] == 'tokens':
-                    response = json.dumps(tokens)
+    def set_map(self, name, grid=None):
+        # grid: the map already loaded from the file
+        self.grid = grid if grid is not None else load_map(os.path.join('maps', name))
+        # reads the whole map, chunked ones included, clients get it all
+        blob = encode_grid(self.grid)
+        self.mapfile = name
+        # encoded contents of the map and their hash, sent to clients whose copy differs
+        self.map_blob = blob
+        self.map_hash = map_hash(blob)
+        # live edits since the map was loaded: how many, the last few as they were made,
+        # and every cell they changed with its current tile, which new clients get with the map
+        self.edit_count = 0
+        self.edit_log = deque(maxlen=EDIT_LOG_SIZE)
+        self.edited_cells = {}
+        self.cells_cache = {}
+        self.cells_cache_version = None
+        # what blocks sight on the map, built when fog of war first needs it,
+        # and the cells seen from the positions tokens looked from most recently since the map last changed
+        self.opacity = None
+        self.sight_cache = OrderedDict()
+
+    def apply_cells(self, changes):
+        # changes: tile name -> cell ids, nothing is changed unless every cell is on the map
+        if not isinstance(changes, dict):
+            return False
+        stride = self.grid.num_cols
+        for tile_name, cells in changes.items():
+            if not isinstance(cells, list):
+                return False
+            for cell in cells:
+                # JSON true and false arrive as bools, which are ints too
+                if not isinstance(cell, int) or isinstance(cell, bool) or cell < 0:
+                    return False
+                row, col = divmod(cell, stride)
+                if row >= self.grid.num_rows or col >= self.grid.row_len(row):
+                    return False
+        for tile_name, cells in changes.items():
+            for cell in cells:
+                self.grid.set(*divmod(cell, stride), tile_name)
+                self.edited_cells[cell] = tile_name
+                if self.opacity is not None:
+                    self.opacity.set_tile(*divmod(cell, stride), tile_name)
+        self.sight_cache.clear()
+        self.edit_log.append(changes)
+        self.edit_count += 1
+        return True
+
+    def cell_delta(self, since):
+        # cells changed by the edits after since, from the start when those edits are no longer logged
+        if since < self.edit_count - len(self.edit_log):
+            return {'map':self.map_hash, 'base':0, 'version':self.edit_count, 'cells':group_cells(self.edited_cells)}
+        cells = {}
+        for changes in list(self.edit_log)[len(self.edit_log) - (self.edit_count - since):]:
+            for tile_name, cell_ids in changes.items():
+                for cell in cell_ids:
+                    cells[cell] = tile_name
+        return {'map':self.map_hash, 'base':since, 'version':self.edit_count, 'cells':group_cells(cells)}
+
+    def sight(self, row, col):
+        key = (row, col)
+        if key not in self.sight_cache:
+            if self.opacity is None:
+                self.opacity = OpacityGrid(self.grid)
+            self.sight_cache[key] = self.opacity.field_of_view(row, col, SIGHT_RADIUS)
+            if len(self.sight_cache) > SIGHT_CACHE_SIZE:
+                self.sight_cache.popitem(last=False)
+        else:
+            self.sight_cache.move_to_end(key)
+        return self.sight_cache[key]
+
+    def player_sight(self, player):
+        # ids of the cells the player's tokens see, None when fog of war is off or there is no player
+        if not self.fog or not player:
+            return None
+        cells = set()
+        for token_name in player:
+            token = self.tokens.get(token_name)
+            if token is not None:
+                cells |= self.sight(token['row'], token['col'])
+        return cells
+
+    def in_sight(self, cells, token):
+        return 0 <= token['col'] < self.grid.num_cols and token['row'] * self.grid.num_cols + token['col'] in cells
+
+    def visible_tokens(self, player):
+        # the tokens a player may see, its own and those on cells they see
+        cells = self.player_sight(player)
+        if cells is None:
+            return self.tokens
+        return {token_name: token for token_name, token in self.tokens.items()
+                if token_name in player or self.in_sight(cells, token)}
+
+    def encoded_cells(self, since):
+        if self.cells_cache_version != (self.map_hash, self.edit_count):
+            self.cells_cache = {}
+            self.cells_cache_version = (self.map_hash, self.edit_count)
+        if since not in self.cells_cache:
+            self.cells_cache[since] = encode_message(json.dumps(dict(self.cell_delta(since), type='cells')))
+        return self.cells_cache[since]
+
+    async def notify_changed(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    @staticmethod
+    def bucket(token):
+        return (token['row'] // BUCKET_SIZE, token['col'] // BUCKET_SIZE)
+
+    def index_token(self, token_name):
+        self.token_buckets.setdefault(self.bucket(self.tokens[token_name]), set()).add(token_name)
+
+    def unindex_token(self, token_name):
+        if token_name in self.tokens:
+            key = self.bucket(self.tokens[token_name])
+            self.token_buckets[key].discard(token_name)
+            if not self.token_buckets[key]:
+                del self.token_buckets[key]
+
+    def tokens_in(self, area):
+        # names of the tokens placed inside (first_row, first_col, last_row, last_col)
+        first_row, first_col, last_row, last_col = area
+        names = []
+        for bucket_row in range(first_row // BUCKET_SIZE, last_row // BUCKET_SIZE + 1):
+            for bucket_col in range(first_col // BUCKET_SIZE, last_col // BUCKET_SIZE + 1):
+                for token_name in self.token_buckets.get((bucket_row, bucket_col), ()):
+                    if in_area(self.tokens[token_name], area):
+                        names += [token_name]
+        return names
+
+    def update_token(self, token_name, token):
+        self.version += 1
+        self.set_token(token_name, token)
+
+    def place_tokens(self, tokens):
+        # many tokens as one change, subscribers get them all in a single delta
+        self.version += 1
+        for token_name, token in tokens.items():
+            self.set_token(token_name, token)
+
+    def set_token(self, token_name, token):
+        self.unindex_token(token_name)
+        if token is None:
+            self.tokens.pop(token_name, None)
+            self.token_versions.pop(token_name, None)
+            self.removed_tokens[token_name] = self.version
+        else:
+            self.tokens[token_name] = token
+            self.index_token(token_name)
+            self.token_versions.pop(token_name, None)
+            self.token_versions[token_name] = self.version
+            self.removed_tokens.pop(token_name, None)
+
+    def reset_tokens(self):
+        self.version += 1
+        self.reset_version = self.version
+        self.tokens = {}
+        self.token_buckets = {}
+        self.token_versions.clear()
+        self.removed_tokens.clear()
+
+    def token_delta(self, since):
+        if since is None or since < self.reset_version or since > self.version:
+            return {'base':None, 'version':self.version, 'tokens':self.tokens, 'removed':[]}
+        changed = {}
+        for token_name in reversed(self.token_versions):
+            if self.token_versions[token_name] <= since:
+                break
+            changed[token_name] = self.tokens[token_name]
+        removed = []
+        for token_name in reversed(self.removed_tokens):
+            if self.removed_tokens[token_name] <= since:
+                break
+            removed += [token_name]
+        return {'base':since, 'version':self.version, 'tokens':changed, 'removed':removed}
+
+    def state(self):
+        return {'mapfile':self.mapfile, 'tokens':dict(self.tokens), 'version':self.version,
+                'edits':self.edit_count, 'cells':group_cells(self.edited_cells), 'fog':self.fog}
+
+    @classmethod
+    def from_state(cls, name, state, default_mapfile):
+        try:
+            room = cls(name, state['mapfile'])
+        except (OSError, ValueError) as e:
+            # the tokens are kept, the edits were to the map that is gone
+            print('Failed to load map of room %s, using %s: %s' % (name, default_mapfile, e))
+            room = cls(name, default_mapfile)
+        else:
+            if state.get('cells'):
+                room.apply_cells({tile_name: cells for tile_name, cells in state['cells'].items()})
+            room.edit_count = state.get('edits', 0)
+            room.edit_log.clear()
+        room.fog = state.get('fog', False)
+        room.tokens = state['tokens']
+        # clients from before the restart get a full snapshot
+        room.version = room.reset_version = state['version']
+        for token_name in room.tokens:
+            room.token_versions[token_name] = room.version
+            room.index_token(token_name)
+        return room
+
+    def encoded_delta(self, since):
+        if self.delta_cache_version != self.version:
+            self.delta_cache = {}
+            self.delta_cache_version = self.version
+        if since not in self.delta_cache:
+            delta = self.token_delta(since)
+            self.delta_cache[since] = encode_message(json.dumps(dict(delta, type='tokens')))
+        return self.delta_cache[since]
+
+    def area_delta(self, key, make):
+        if self.area_cache_version != self.version:
+            self.area_cache = {}
+            self.area_cache_version = self.version
+        if key not in self.area_cache:
+            self.area_cache[key] = make()
+        return self.area_cache[key]
+
+    def covers(self, area):
+        first_row, first_col, last_row, last_col = area
+        return (first_row <= 0 and first_col <= 0
+                and last_row >= self.grid.num_rows - 1 and last_col >= self.grid.num_cols - 1)
+
+    def encoded_positions(self):
+        if self.positions_cache_version != self.version:
+            self.positions_cache = encode_positions(self.version, self.tokens.values())
+            self.positions_cache_version = self.version
+        return self.positions_cache
+
+def encode_positions(version, tokens):
+    # [row, col, cells per side] of each token, all a minimap needs
+    positions = [[token['row'], token['col'], image_scale(token['img'])] for token in tokens]
+    return encode_message(json.dumps({'type':'positions', 'version':version, 'tokens':positions}))
+
+def in_area(token, area):
+    first_row, first_col, last_row, last_col = area
+    return first_row <= token['row'] <= last_row and first_col <= token['col'] <= last_col
+
+# One connection's token subscription. Without a viewport every change is
+# sent. With one, only tokens near the viewport are: a token moving or a view
+# panning into range arrives as an addition and one leaving it as a removal,
+# so a client's traffic follows what it can see rather than the map size.
+# A player, a client that named its own tokens, gets the same treatment in
+# fog of war: it is sent the cells its tokens see whenever they change, and
+# only the tokens on those cells besides its own.
+# A client with a viewport also gets where every token it may see is, at most
+# every POSITIONS_PERIOD seconds, which is all its minimap needs.
+class Subscriber:
+    def __init__(self, writer, since, viewport=None, player=()):
+        self.writer = writer
+        # last version sent to the client, deltas are based on it
+        self.client_version = since
+        # version up to which changes have been looked at, possibly without sending anything
+        self.seen = since
+        self.area = None
+        # names of the tokens the client has, None until it was sent its area
+        self.known = None
+        self.set_viewport(viewport)
+        # map and number of its edits the client was last sent
+        self.map_hash = None
+        self.edits_sent = None
+        self.player = set(player)
+        # cells the client may see, None when it sees everything, and what they were worked out from
+        self.fog = None
+        self.fog_key = None
+        # version and fog the positions were last sent for, and when
+        self.positions_key = None
+        self.positions_time = None
+
+    def set_player(self, player):
+        self.player = set(player)
+
+    def current_fog_key(self, room):
+        if not room.fog or not self.player:
+            return None
+        positions = sorted((token['row'], token['col']) for token_name, token in room.tokens.items()
+                           if token_name in self.player)
+        return (room.map_hash, room.edit_count, tuple(positions))
+
+    def next_fog(self, room):
+        # encoded fog mask to push when the cells the client's tokens see changed
+        fog_key = self.current_fog_key(room)
+        if fog_key == self.fog_key:
+            return None
+        self.fog_key = fog_key
+        self.fog = room.player_sight(self.player)
+        # the tokens sent are filtered again
+        self.viewport_changed = True
+        cells = None if self.fog is None else cell_runs(self.fog)
+        return encode_message(json.dumps({'type':'fog', 'map':room.map_hash, 'cells':cells}))
+
+    def sees(self, room, token_name, token):
+        if self.area is not None and not in_area(token, self.area):
+            return False
+        return self.in_sight(room, token_name, token)
+
+    def in_sight(self, room, token_name, token):
+        if self.fog is None or token_name in self.player:
+            return True
+        return room.in_sight(self.fog, token)
+
+    def positions_wait(self, room):
+        # seconds until the positions are due, None while the client has the current ones or gets every token anyway
+        if self.sees_area(room) or self.positions_key == (room.version, self.fog_key):
+            return None
+        if self.positions_time is None:
+            return 0
+        return max(0, self.positions_time + POSITIONS_PERIOD - time.monotonic())
+
+    def next_positions(self, room):
+        if self.positions_wait(room) != 0:
+            return None
+        self.positions_key = (room.version, self.fog_key)
+        self.positions_time = time.monotonic()
+        if self.fog is None:
+            return room.encoded_positions()
+        return encode_positions(room.version, [token for token_name, token in room.tokens.items()
+                                               if self.in_sight(room, token_name, token)])
+
+    def visible_tokens(self, room):
+        names = room.tokens_in(self.area) if self.area is not None else list(room.tokens)
+        return [token_name for token_name in names if self.sees(room, token_name, room.tokens[token_name])]
+
+    def set_viewport(self, viewport):
+        # viewport_changed is also set when the fog changes, either way the tokens in view are worked out again
+        self.viewport_changed = True
+        if viewport is None:
+            self.area = None
+        else:
+            # widened to whole buckets, clients looking at about the same place share their deltas
+            first_row, first_col, last_row, last_col = viewport
+            self.area = ((first_row - VIEW_MARGIN) // BUCKET_SIZE * BUCKET_SIZE,
+                         (first_col - VIEW_MARGIN) // BUCKET_SIZE * BUCKET_SIZE,
+                         ((last_row + VIEW_MARGIN) // BUCKET_SIZE + 1) * BUCKET_SIZE - 1,
+                         ((last_col + VIEW_MARGIN) // BUCKET_SIZE + 1) * BUCKET_SIZE - 1)
+
+    def pending(self, room):
+        return (self.seen is None or self.seen != room.version or self.viewport_changed
+                or self.map_hash != room.map_hash or self.edits_sent != room.edit_count
+                or self.fog_key != self.current_fog_key(room) or self.positions_wait(room) == 0)
+
+    def next_cells(self, room):
+        # encoded cell delta to push, for a new map only its hash, clients fetch the map themselves
+        message = None
+        if self.map_hash != room.map_hash:
+            message = encode_message(json.dumps({'type':'map', 'map':room.map_hash, 'name':room.mapfile}))
+        elif self.edits_sent < room.edit_count:
+            message = room.encoded_cells(self.edits_sent)
+        self.map_hash = room.map_hash
+        self.edits_sent = room.edit_count
+        return message
+
+    def sees_area(self, room):
+        # no viewport, or one the whole map fits in: every token is sent anyway
+        return self.area is None or room.covers(self.area)
+
+    def next_message(self, room):
+        # encoded delta to push, or None when nothing the client can see changed
+        if self.sees_area(room) and self.fog is None:
+            if self.known is not None:
+                # the viewport was dropped, start over with everything
+                self.known = None
+                self.client_version = None
+            message = None
+            if self.client_version is None or self.client_version != room.version:
+                message = room.encoded_delta(self.client_version)
+        elif self.fog is None and not self.viewport_changed and self.known is not None:
+            # the tokens a client knows follow from the version it saw and its area,
+            # so every subscriber with the same ones gets the same delta, encoded once
+            made = []
+            def make():
+                made.append(True)
+                return self.encode_area_delta(room)
+            delta, message = room.area_delta((self.seen, self.client_version, self.area), make)
+            if not made:
+                if delta['base'] is None:
+                    self.known = set(delta['tokens'])
                 else:
-                    response = 'err'
-            elif req['op'] == 'set':
-                if req['arg'] == 'place_token':
-                    token_name = req['data']['name']
-                    row = req['data']['row']
-                    col = req['data']['col']
-                    img = req['data']['img']
-                    tokens[token_name] = {'row':row, 'col':col, 'img':img}
+                    self.known |= set(delta['tokens'])
+                    self.known -= set(delta['removed'])
+        else:
+            delta, message = self.encode_area_delta(room)
+        self.viewport_changed = False
+        self.seen = room.version
+        if message is not None:
+            self.client_version = room.version
+        return message
+
+    def encode_area_delta(self, room):
+        delta = self.area_delta(room)
+        message = None
+        if delta['base'] is None or delta['tokens'] or delta['removed']:
+            message = encode_message(json.dumps(dict(delta, type='tokens')))
+        return delta, message
+
+    def area_delta(self, room):
+        if (self.known is None or self.seen is None or self.client_version is None
+                or self.seen < room.reset_version or self.seen > room.version):
+            names = self.visible_tokens(room)
+            self.known = set(names)
+            return {'base':None, 'version':room.version,
+                    'tokens':{token_name: room.tokens[token_name] for token_name in names}, 'removed':[]}
+        changes = room.token_delta(self.seen)
+        tokens = {}
+        removed = set()
+        for token_name, token in changes['tokens'].items():
+            if self.sees(room, token_name, token):
+                tokens[token_name] = token
+                self.known.add(token_name)
+            elif token_name in self.known:
+                removed.add(token_name)
+                self.known.discard(token_name)
+        for token_name in changes['removed']:
+            if token_name in self.known:
+                removed.add(token_name)
+                self.known.discard(token_name)
+        if self.viewport_changed:
+            visible = set(self.visible_tokens(room))
+            for token_name in visible - self.known:
+                tokens[token_name] = room.tokens[token_name]
+            removed |= self.known - visible
+            self.known = visible
+        return {'base':self.client_version, 'version':room.version, 'tokens':tokens, 'removed':sorted(removed)}
+
+parser = argparse.ArgumentParser(description='Simple Map server')
+parser.add_argument('mapfile', help='map in maps/ that new rooms start on')
+parser.add_argument('--host', default=HOST)
+parser.add_argument('--port', type=int, default=PORT)
+parser.add_argument('--state-dir', default=STATE_DIR)
+args = parser.parse_args()
+
+rooms = {}
+default_mapfile = args.mapfile
+# request latencies per op, request/byte counters and connected clients, read with 'admin stats'
+metrics = Metrics(window=1000)
+
+def get_room(name):
+    if name not in rooms:
+        rooms[name] = Room(name, default_mapfile)
+    return rooms[name]
+
+def apply_record(record):
+    room = get_room(record['room'])
+    if record['op'] == 'place_token':
+        room.update_token(record['name'], record['token'])
+    elif record['op'] == 'set_cells':
+        # edits to a map that failed to load are dropped
+        if record.get('map', room.map_hash) == room.map_hash:
+            room.apply_cells(record['cells'])
+    elif record['op'] == 'load_encounter':
+        try:
+            load_encounter(room, record['encounter'])
+        except (OSError, ValueError) as e:
+            # its tokens still replace the old ones, on the map the room has, where they fit on it
+            print('Failed to load map of encounter in room %s: %s' % (room.name, e))
+            tokens = {token_name: token for token_name, token in record['encounter']['tokens'].items()
+                      if token is None or on_map(room.grid, token)}
+            load_encounter(room, dict(record['encounter'], map=None, replace=True, tokens=tokens))
+    elif record['op'] == 'fog':
+        room.fog = record['enabled']
+    elif record['op'] == 'set_map':
+        # a map file that is gone leaves the room on the map it had, so the server still starts
+        try:
+            room.set_map(record['map'])
+        except (OSError, ValueError) as e:
+            print('Failed to load map %s of room %s: %s' % (record['map'], room.name, e))
+        room.reset_tokens()
+
+def parse_token(token, grid=None):
+    # {'row', 'col', 'img'} as stored, None if it is not a valid token or, given the grid, not on it
+    if not isinstance(token, dict) or not isinstance(token.get('img'), str):
+        return None
+    if not all(isinstance(token.get(key), int) and not isinstance(token[key], bool) and token[key] >= 0
+               for key in ('row', 'col')):
+        return None
+    if grid is not None and not on_map(grid, token):
+        return None
+    return {'row':token['row'], 'col':token['col'], 'img':token['img']}
+
+def on_map(grid, token):
+    return token['row'] < grid.num_rows and token['col'] < grid.row_len(token['row'])
+
+def parse_encounter(data):
+    # {'map': optional map file, 'tokens': {name: {'row', 'col', 'img'}}, 'replace': optional, default true},
+    # None if anything in it is not valid
+    if not isinstance(data, dict) or not isinstance(data.get('tokens'), dict):
+        return None
+    if data.get('map') is not None and not isinstance(data['map'], str):
+        return None
+    tokens = {}
+    for token_name, token in data['tokens'].items():
+        if token is None:
+            tokens[token_name] = None
+            continue
+        tokens[token_name] = parse_token(token)
+        if tokens[token_name] is None:
+            return None
+    return {'map':data.get('map'), 'tokens':tokens, 'replace':bool(data.get('replace', True))}
+
+def load_encounter(room, encounter):
+    # all or nothing: a map that does not load, or tokens off the map, leave the room as it was
+    grid = room.grid
+    if encounter['map'] is not None:
+        grid = load_map(os.path.join('maps', encounter['map']))
+    if not all(token is None or on_map(grid, token) for token in encounter['tokens'].values()):
+        raise ValueError('tokens off the map')
+    if encounter['map'] is not None:
+        room.set_map(encounter['map'], grid)
+    if encounter['replace'] or encounter['map'] is not None:
+        room.reset_tokens()
+    room.place_tokens(encounter['tokens'])
+
+def save_snapshot():
+    journal.snapshot({'rooms':{name: room.state() for name, room in rooms.items()}})
+
+journal = Journal(args.state_dir)
+snapshot, records = journal.recover()
+if snapshot is not None:
+    for name, state in snapshot['rooms'].items():
+        rooms[name] = Room.from_state(name, state, default_mapfile)
+for record in records:
+    apply_record(record)
+print('restored %d rooms from snapshot and %d journal records' % (len(rooms), len(records)))
+get_room(DEFAULT_ROOM)
+journal.start()
+save_snapshot()
+
+def op_name(req):
+    if req.get('op') in ('get', 'set', 'admin'):
+        return '%s %s' % (req['op'], req.get('arg'))
+    return str(req.get('op'))
+
+def send(writer, message):
+    metrics.count('bytes_out', len(message))
+    writer.write(message)
+
+def server_stats():
+    stats = metrics.summary()
+    stats['rooms'] = {name: {'map':room.mapfile, 'edits':room.edit_count, 'fog':room.fog, 'tokens':len(room.tokens),
+                             'version':room.version, 'subscribers':len(room.subscribers)}
+                      for name, room in rooms.items()}
+    return stats
+
+async def push_tokens(room, subscriber):
+    # a client that falls behind gets one combined delta from the version it last saw
+    room.subscribers.add(subscriber)
+    # map edits are pushed from the ones made after subscribing, earlier ones come with the map
+    subscriber.map_hash = room.map_hash
+    subscriber.edits_sent = room.edit_count
+    try:
+        while True:
+            wait = subscriber.positions_wait(room)
+            async with room.changed:
+                try:
+                    # without a timeout, woken as soon as the positions are out of date to start one
+                    await asyncio.wait_for(room.changed.wait_for(
+                        lambda: subscriber.pending(room) or (wait is None and subscriber.positions_wait(room) is not None)),
+                        wait)
+                except asyncio.TimeoutError:
+                    pass
+            # the fog first, the tokens sent next depend on it
+            for message in (subscriber.next_cells(room), subscriber.next_fog(room), subscriber.next_message(room),
+                            subscriber.next_positions(room)):
+                if message is not None:
+                    send(subscriber.writer, message)
+                    metrics.count('pushes')
+            await subscriber.writer.drain()
+    finally:
+        room.subscribers.discard(subscriber)
+
+def parse_viewport(data):
+    if isinstance(data, list) and len(data) == 4 and all(isinstance(value, int) for value in data):
+        return tuple(data)
+    return None
+
+def handle_request(room, req, player=()):
+    # player: the connection's own tokens, a player only gets the tokens it may see and runs no admin requests
+    response = 'err'
+    if 'op' in req and 'arg' in req:
+        if req['op'] == 'get':
+            if req['arg'] == 'map':
+                if isinstance(req.get('data'), dict):
+                    # conditional get, nothing comes back while the client's copy is current,
+                    # edits made to it since are pushed
+                    if req['data'].get('hash') == room.map_hash:
+                        response = ''
+                    else:
+                        response = json.dumps({'name':room.mapfile, 'hash':room.map_hash, 'edits':room.edit_count,
+                                               'cells':group_cells(room.edited_cells)})
+                else:
+                    response = json.dumps(room.mapfile)
+            elif req['arg'] == 'map_data':
+                if req.get('data') in (None, room.map_hash):
+                    response = json.dumps({'name':room.mapfile, 'hash':room.map_hash, 'edits':room.edit_count,
+                                           'cells':group_cells(room.edited_cells),
+                                           'data':base64.b64encode(room.map_blob).decode('ascii')})
+            elif req['arg'] == 'tokens':
+                response = json.dumps(room.visible_tokens(player))
+        elif req['op'] == 'set':
+            if req['arg'] == 'place_token':
+                # {'name', 'row', 'col', 'img'}, a row and col of None take the token off the map
+                data = req.get('data')
+                if isinstance(data, dict) and isinstance(data.get('name'), str):
+                    token = None
+                    if data.get('row') is not None or data.get('col') is not None:
+                        token = parse_token(data, room.grid)
+                    if token is not None or (data.get('row') is None and data.get('col') is None):
+                        room.update_token(data['name'], token)
+                        journal.append({'room':room.name, 'op':'place_token', 'name':data['name'], 'token':token})
+                        response = 'ack'
+            elif req['arg'] == 'cells':
+                # a live edit from map_builder, for the map the editor has open
+                data = req.get('data')
+                if isinstance(data, dict) and data.get('map') == room.map_hash and room.apply_cells(data.get('cells')):
+                    journal.append({'room':room.name, 'op':'set_cells', 'map':room.map_hash, 'cells':data['cells']})
                     response = 'ack'
-            elif req['op'] == 'admin':
-                print(req)
-                if req['arg'] == 'set_map':
-                    mapfile = req['data']
-                    tokens = {}
+        elif req['op'] == 'admin' and not player:
+            # an encounter can be large, it is logged once it has been read
+            if req['arg'] != 'load_encounter':
+                print(room.name, req)
+            response = 'ack'
+            if req['arg'] == 'set_map':
+                try:
+                    if not isinstance(req.get('data'), str):
+                        raise ValueError('no map file given')
+                    room.set_map(req['data'])
+                    room.reset_tokens()
+                    journal.append({'room':room.name, 'op':'set_map', 'map':req['data']})
+                except (OSError, ValueError) as e:
+                    print('Failed to load map: %s' % e)
+                    response = 'err'
+            elif req['arg'] == 'stats':
+                response = json.dumps(server_stats())
+            elif req['arg'] == 'load_encounter':
+                encounter = parse_encounter(req.get('data'))
+                if encounter is None:
+                    print(room.name, 'load_encounter: not a valid encounter')
+                    response = 'err'
+                else:
+                    print(room.name, 'load_encounter: %d tokens' % len(encounter['tokens']))
+                    try:
+                        load_encounter(room, encounter)
+                        journal.append({'room':room.name, 'op':'load_encounter', 'encounter':encounter})
+                    except (OSError, ValueError) as e:
+                        print('Failed to load encounter: %s' % e)
+                        response = 'err'
+            elif req['arg'] == 'fog':
+                room.fog = bool(req.get('data'))
+                journal.append({'room':room.name, 'op':'fog', 'enabled':room.fog})
+            elif req['arg'] == 'export_encounter':
+                response = json.dumps({'map':room.mapfile, 'tokens':room.tokens})
+    return response
+
+async def handle_client(reader, writer):
+    room = get_room(DEFAULT_ROOM)
+    pusher = None
+    subscriber = None
+    # cells the client shows, it is only sent tokens near them once it told us
+    viewport = None
+    # the client's own tokens, they decide what it sees in fog of war
+    player = ()
+    metrics.count('connections')
+    metrics.count('clients')
+    # the pusher, the client count and the connection are cleaned up however the loop ends
+    try:
+        while True:
+            try:
+                message = await read_message(reader)
+                started = time.perf_counter()
+                metrics.count('bytes_in', len(message.encode('utf8')) + 8)
+                req = json.loads(message)
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                break
+            if not isinstance(req, dict):
+                break
+            metrics.count('requests')
+            if req.get('op') == 'subscribe' and req.get('arg') == 'tokens':
+                # answered by the pushed snapshot or delta instead of a response
+                if pusher is not None:
+                    pusher.cancel()
+                # the version the client has, anything else gets it a snapshot
+                since = req.get('data') if isinstance(req.get('data'), int) else None
+                subscriber = Subscriber(writer, since, viewport, player)
+                pusher = asyncio.ensure_future(push_tokens(room, subscriber))
+                continue
+            if req.get('op') == 'player':
+                # no response, the pusher sends the fog for the new tokens
+                player = req.get('data') if isinstance(req.get('data'), list) else []
+                player = [str(token_name) for token_name in player]
+                if subscriber is not None:
+                    subscriber.set_player(player)
+                    await room.notify_changed()
+                continue
+            if req.get('op') == 'viewport':
+                # no response either, the pusher sends what came into or went out of view
+                viewport = parse_viewport(req.get('data'))
+                if subscriber is not None:
+                    subscriber.set_viewport(viewport)
+                    await room.notify_changed()
+                continue
+            version_before = (room.version, room.map_hash, room.edit_count, room.fog)
+            if req.get('op') == 'join':
+                # later requests and the subscription, if any, switch to the room
+                room = get_room(str(req.get('arg')))
+                if pusher is not None:
+                    pusher.cancel()
+                    subscriber = Subscriber(writer, None, viewport, player)
+                    pusher = asyncio.ensure_future(push_tokens(room, subscriber))
                 response = 'ack'
-        else:
-            response = 'err'
-        resp_len = len(response.encode('utf8'))
-        writer.write(((u'%08d' % resp_len) + response).encode('utf8'))
-        await writer.drain()
-    writer.close()
+            elif req.get('op') == 'batch':
+                if isinstance(req.get('data'), list):
+                    metrics.count('batched_requests', len(req['data']))
+                    response = json.dumps([handle_request(room, r, player) if isinstance(r, dict) else 'err' for r in req['data']])
+                else:
+                    response = 'err'
+            else:
+                response = handle_request(room, req, player)
+            if (room.version, room.map_hash, room.edit_count, room.fog) != version_before:
+                await room.notify_changed()
+            if journal.needs_snapshot():
+                save_snapshot()
+            if 'id' in req:
+                # pipelining clients match responses to requests by id
+                response = json.dumps({'id':req['id'], 'resp':response})
+            send(writer, encode_message(response))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                break
+            metrics.add(op_name(req), time.perf_counter() - started)
+    finally:
+        if pusher is not None:
+            pusher.cancel()
+        metrics.count('clients', -1)
+        writer.close()
 
 loop = asyncio.get_event_loop()
-loop.create_task(asyncio.start_server(handle_client, HOST, PORT))
-loop.run_forever()
-
+loop.create_task(asyncio.start_server(handle_client, args.host, args.port))
+try:
+    loop.run_forever()
+finally:
+    journal.close()
@@ -1,5 +1,7 @@
+from simple_map.metrics import startup
 from simple_map import Game
 import configparser
+startup.mark('imports')
 
 print('parsing config...')
 conf = configparser.ConfigParser()
@@ -12,7 +14,9 @@ font_size = int(conf.get('Graphics', 'Font Size'))
 
 host = conf.get('Server', 'Hostname')
 port = int(conf.get('Server', 'Port'))
-refresh_period = int(conf.get('Server', 'Refresh Period'))
+room = conf.get('Server', 'Room', fallback=None)
+# comma separated names of the player's tokens, what they see is shown in fog of war
+player = [name.strip() for name in conf.get('Server', 'Player', fallback='').split(',') if name.strip()]
 
 conf_res = conf.get('Graphics', 'Resolution')
 
@@ -27,6 +31,7 @@ game = Game(server_hostname=host,
                        tile_padding=tile_padding,
                        tile_size=tile_size,
                        font_size=font_size,
-                       refresh_period=refresh_period)
+                       room=room,
+                       player=player)
 
 game.game_loop()
\ No newline at end of file
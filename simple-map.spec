@@ -7,7 +7,7 @@ a = Analysis(['simple-map.py', 'admin_client.py', 'map_builder.py'],
              pathex=['C:\\Users\\Matt\\workspace\\simple-map'],
              binaries=[],
              datas=[('maps','maps'), ('tiles','tiles'), ('tokens', 'tokens'), ('arial.ttf', '.'), ('config.ini', '.')],
-             hiddenimports=[],
+             hiddenimports=['pkg_resources.py2_warn'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
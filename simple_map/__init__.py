@@ -1 +1,6 @@
-from .game_map import Game
\ No newline at end of file
+def __getattr__(name):
+    # Game pulls in pygame, only import it when it is asked for
+    if name == 'Game':
+        from .game_map import Game
+        return Game
+    raise AttributeError("module 'simple_map' has no attribute %r" % name)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pygame
+
+MANIFEST_VERSION = 1
+
+# Images of one asset directory, keyed by file name without extension.
+# A manifest in cache_dir records every file's size and mtime along with its
+# decoded pixels, stored raw in a single file next to it. Unchanged images are
+# rebuilt from those pixels instead of being decoded again, and while the
+# directory's mtime is unchanged it is not even listed. Everything else is
+# decoded on a thread pool and written back to the cache in the background.
+# With thumbnail_size set the images are shrunk to fit that size when they are
+# decoded, and the cache holds the thumbnails instead of the full images.
+class AssetDirectory:
+    def __init__(self, directory, cache_dir='asset_cache', executor=None, thumbnail_size=None):
+        self.directory = directory
+        self.thumbnail_size = thumbnail_size
+        name = os.path.basename(os.path.normpath(directory))
+        if thumbnail_size is not None:
+            name += '.%d' % thumbnail_size
+        self.name = name
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, name + '.json')
+        self.executor = executor or ThreadPoolExecutor(min(8, os.cpu_count() or 1))
+        # load_async runs here, the decode pool stays free for the images themselves
+        self.loader = ThreadPoolExecutor(1)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as fin:
+                manifest = json.load(fin)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {'version':MANIFEST_VERSION, 'dir_mtime':None, 'pixels':None, 'files':{}}
+
+    def list_files(self, manifest):
+        # name -> file name of every png, from the manifest while the directory is unchanged
+        dir_mtime = os.stat(self.directory).st_mtime_ns
+        if dir_mtime == manifest['dir_mtime']:
+            return {name: entry['file'] for name, entry in manifest['files'].items()}
+        with os.scandir(self.directory) as entries:
+            return {os.path.splitext(entry.name)[0]: entry.name for entry in entries
+                    if entry.name.lower().endswith('.png')}
+
+    def load(self):
+        manifest = self.read_manifest()
+        files = self.list_files(manifest)
+        cached = {}
+        missing = []
+        for name, file_name in files.items():
+            entry = manifest['files'].get(name)
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                continue
+            if entry is not None and entry['file'] == file_name and entry['size'] == stat.st_size \
+                    and entry['mtime'] == stat.st_mtime_ns:
+                cached[name] = entry
+            else:
+                missing += [name]
+        images = {}
+        if cached:
+            try:
+                with open(os.path.join(self.cache_dir, manifest['pixels']), 'rb') as fin:
+                    pixels = fin.read()
+                for name, entry in cached.items():
+                    data = pixels[entry['offset']:entry['offset'] + entry['length']]
+                    images[name] = pygame.image.fromstring(data, (entry['width'], entry['height']), entry['format'])
+            except (OSError, ValueError):
+                images = {}
+                missing = list(files)
+        decoded = self.executor.map(self.decode, [os.path.join(self.directory, files[name]) for name in missing])
+        for name, image in zip(missing, decoded):
+            images[name] = image
+        if missing or len(files) != len(manifest['files']):
+            self.save(files, images, manifest['pixels'])
+        return images
+
+    def decode(self, path):
+        image = pygame.image.load(path)
+        if self.thumbnail_size is None:
+            return image
+        if image.get_bitsize() < 24:
+            # smoothscale needs 24 or 32 bit pixels
+            converted = pygame.Surface(image.get_size(), pygame.SRCALPHA, 32)
+            converted.blit(image, (0, 0))
+            image = converted
+        scale = self.thumbnail_size / max(image.get_size())
+        size = (max(1, round(image.get_width()*scale)), max(1, round(image.get_height()*scale)))
+        return pygame.transform.smoothscale(image, size)
+
+    def load_async(self):
+        # a future of the images, for assets that are not needed for the first frame
+        return self.loader.submit(self.load)
+
+    def save(self, files, images, old_pixels):
+        # pixels are copied out now, the files are written on the pool
+        manifest = {'version':MANIFEST_VERSION, 'dir_mtime':os.stat(self.directory).st_mtime_ns,
+                    'pixels':'%s.%x.pixels' % (self.name, time.time_ns()), 'files':{}}
+        chunks = []
+        offset = 0
+        for name, image in images.items():
+            image_format = 'RGBA' if image.get_flags() & pygame.SRCALPHA else 'RGB'
+            data = pygame.image.tostring(image, image_format)
+            stat = os.stat(os.path.join(self.directory, files[name]))
+            manifest['files'][name] = {'file':files[name], 'size':stat.st_size, 'mtime':stat.st_mtime_ns,
+                                       'width':image.get_width(), 'height':image.get_height(),
+                                       'format':image_format, 'offset':offset, 'length':len(data)}
+            chunks += [data]
+            offset += len(data)
+        self.executor.submit(self.write_cache, manifest, chunks, old_pixels)
+
+    def write_cache(self, manifest, chunks, old_pixels):
+        # every rewrite gets a new pixel file, so a manifest always matches the one it names
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, manifest['pixels']), 'wb') as fout:
+                fout.writelines(chunks)
+            with open(self.manifest_path + '.tmp', 'w', encoding='utf-8') as fout:
+                json.dump(manifest, fout)
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+            if old_pixels is not None:
+                os.remove(os.path.join(self.cache_dir, old_pixels))
+        except OSError as e:
+            print('Failed to write asset cache: %s' % e)
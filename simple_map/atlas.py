@@ -0,0 +1,103 @@
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pygame
+from .token import image_scale
+
+# Packs a set of images into one sheet made of base_size x base_size units,
+# converted to the display format once. An image named *_2x ... *_9x spans
+# that many units each way. Scaled copies of the sheet are built per tile size
+# and kept in an LRU cache bounded by pixel count; neighbouring sizes can be
+# built ahead of time on a background thread.
+class TextureAtlas:
+    def __init__(self, images, base_size=None, background=None, max_pixels=32*1024*1024):
+        if base_size is None:
+            # keep the full resolution of the largest source image
+            base_size = max([image.get_width() // image_scale(name) for name, image in images.items()] + [1])
+        self.base_size = base_size
+        self.max_pixels = max_pixels
+        # name -> (x, y, units) in units of base_size
+        self.cells = {}
+        self.pack(images)
+        if background is None:
+            self.sheet = pygame.Surface((self.width*base_size, self.height*base_size), pygame.SRCALPHA).convert_alpha()
+            self.sheet.fill((0, 0, 0, 0))
+        else:
+            # flatten onto the colour the images are drawn over so the sheet can be opaque
+            self.sheet = pygame.Surface((self.width*base_size, self.height*base_size)).convert()
+            self.sheet.fill(background)
+        for name, image in images.items():
+            x, y, units = self.cells[name]
+            size = units*base_size
+            if image.get_size() != (size, size):
+                image = pygame.transform.scale(image, (size, size))
+            self.sheet.blit(image, (x*base_size, y*base_size))
+        # tile size -> (sheet, name -> subsurface)
+        self.levels = OrderedDict()
+        self.building = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def pack(self, images):
+        # shelf packing, largest images first
+        names = sorted(images, key=lambda name: (-image_scale(name), name))
+        area = sum(image_scale(name)**2 for name in names)
+        self.width = max([int(math.ceil(math.sqrt(area)))] + [image_scale(name) for name in names])
+        x = y = shelf_height = 0
+        for name in names:
+            units = image_scale(name)
+            if x + units > self.width:
+                x = 0
+                y += shelf_height
+                shelf_height = 0
+            self.cells[name] = (x, y, units)
+            x += units
+            shelf_height = max(shelf_height, units)
+        self.height = max(1, y + shelf_height)
+
+    def build_level(self, tile_size):
+        # each cell is scaled on its own so neighbouring images can never bleed into each other
+        sheet = pygame.Surface((self.width*tile_size, self.height*tile_size), self.sheet.get_flags() & pygame.SRCALPHA, self.sheet)
+        images = {}
+        for name, (x, y, units) in self.cells.items():
+            src = self.sheet.subsurface((x*self.base_size, y*self.base_size, units*self.base_size, units*self.base_size))
+            rect = pygame.Rect(x*tile_size, y*tile_size, units*tile_size, units*tile_size)
+            pygame.transform.scale(src, rect.size, sheet.subsurface(rect))
+            images[name] = sheet.subsurface(rect)
+        return sheet, images
+
+    def store_level(self, tile_size, level):
+        with self.lock:
+            self.building.pop(tile_size, None)
+            self.levels[tile_size] = level
+            self.levels.move_to_end(tile_size)
+            pixels = sum(sheet.get_width()*sheet.get_height() for sheet, _ in self.levels.values())
+            while pixels > self.max_pixels and len(self.levels) > 1:
+                sheet, _ = self.levels.popitem(last=False)[1]
+                pixels -= sheet.get_width()*sheet.get_height()
+
+    def get_level(self, tile_size):
+        with self.lock:
+            if tile_size in self.levels:
+                self.levels.move_to_end(tile_size)
+                return self.levels[tile_size][1]
+            future = self.building.get(tile_size)
+        if future is not None:
+            return future.result()[1]
+        level = self.build_level(tile_size)
+        self.store_level(tile_size, level)
+        return level[1]
+
+    def prefetch(self, tile_size):
+        if tile_size <= 0:
+            return
+        with self.lock:
+            if tile_size in self.levels or tile_size in self.building:
+                return
+            self.building[tile_size] = self.executor.submit(self.prefetch_level, tile_size)
+
+    def prefetch_level(self, tile_size):
+        level = self.build_level(tile_size)
+        self.store_level(tile_size, level)
+        return level
@@ -0,0 +1,341 @@
+import argparse
+import array
+import copy
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+from .tile_grid import TileGrid
+
+# Chunked map files (.smap) hold a fixed size prefix, a JSON header with the
+# map size and tile palette, then the map as chunk_size x chunk_size blocks of
+# little endian uint16 palette ids, block rows top to bottom. Every block has
+# the same size, so any block can be found without reading the others and the
+# file can be memory-mapped. Cells past the end of a short row hold PADDING.
+# After the blocks comes a preview: the palette id of every step-th cell of
+# every step-th row, at most PREVIEW_SIZE per side, which is what a minimap
+# shows, so one can be drawn without reading any block.
+# A map opened locally, by the offline client or map_builder, only reads the
+# blocks that are drawn or that a token's movement range covers. The server
+# still reads every block once to encode the map, and networked clients
+# download the whole encoded map, so for them the format only saves parsing
+# a CSV.
+MAGIC = b'SMAP'
+VERSION = 1
+PREFIX = struct.Struct('<4sHHII')  # magic, version, chunk_size, header_len, data_offset
+CHUNK_SIZE = 64
+PADDING = 0xFFFF
+# room left after the header so saving in place can add palette entries
+HEADER_SLACK = 4096
+PAGE = 4096
+PREVIEW_SIZE = 200
+
+def preview_step(num_rows, num_cols):
+    # cells per preview pixel, the same as a minimap of PREVIEW_SIZE pixels uses
+    return max(1, -(-max(num_rows, num_cols, 1) // PREVIEW_SIZE))
+
+# A map backed by a read-only memory map of a .smap file. Blocks are read
+# straight from the mapping, so only the pages that are looked at are loaded.
+# Changed blocks are copied into memory and written back by save().
+# Implements the same methods as TileGrid.
+class ChunkedGrid:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.chunk_size, header_len, self.data_offset = PREFIX.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %d chunked map' % (path, VERSION))
+        header = json.loads(self.mm[PREFIX.size:PREFIX.size + header_len].decode('utf8'))
+        self.rows_count = header['rows']
+        self.cols_count = header['cols']
+        self.row_lens = header.get('row_lens')
+        self.palette = header['palette']
+        # files written before previews were added have none
+        self.preview_step = header.get('preview')
+        self.tile_ids = {tile_name: tile_id for tile_id, tile_name in enumerate(self.palette)}
+        self.chunk_cols = -(-self.cols_count // self.chunk_size)
+        self.chunk_rows = -(-self.rows_count // self.chunk_size)
+        # single cells are read in place on little endian hosts, like the file
+        if sys.byteorder == 'little':
+            self.cells = memoryview(self.mm).cast('H')
+        else:
+            self.cells = None
+        # (chunk_row, chunk_col) -> array('H') of blocks changed since loading
+        self.dirty = {}
+
+    def __len__(self):
+        return self.rows_count
+
+    @property
+    def num_rows(self):
+        return self.rows_count
+
+    @property
+    def num_cols(self):
+        return self.cols_count
+
+    def row_len(self, row):
+        if self.row_lens is not None:
+            return self.row_lens[row]
+        return self.cols_count
+
+    def tile_id(self, tile_name):
+        tile_id = self.tile_ids.get(tile_name)
+        if tile_id is None:
+            tile_id = len(self.palette)
+            self.palette += [tile_name]
+            self.tile_ids[tile_name] = tile_id
+        return tile_id
+
+    def chunk_offset(self, chunk_row, chunk_col):
+        return self.data_offset + (chunk_row*self.chunk_cols + chunk_col) * self.chunk_size * self.chunk_size * 2
+
+    def preview_size(self):
+        # (rows, cols) of the stored preview
+        return (-(-self.rows_count // self.preview_step), -(-self.cols_count // self.preview_step))
+
+    def read_preview(self):
+        # the stored preview with the changed blocks' cells, one array of preview rows
+        rows, cols = self.preview_size()
+        offset = self.chunk_offset(self.chunk_rows, 0)
+        cells = array.array('H')
+        cells.frombytes(self.mm[offset:offset + rows*cols*2])
+        if sys.byteorder == 'big':
+            cells.byteswap()
+        step = self.preview_step
+        for chunk_row, chunk_col in self.dirty:
+            first_row, first_col = chunk_row*self.chunk_size, chunk_col*self.chunk_size
+            for row in range(-(-first_row // step) * step, min(first_row + self.chunk_size, self.rows_count), step):
+                end = min(first_col + self.chunk_size, self.row_len(row))
+                for col in range(-(-first_col // step) * step, end, step):
+                    cells[row // step * cols + col // step] = self.cell_id(row, col)
+        return cells
+
+    def preview(self, step):
+        # palette ids of every step-th cell of every step-th row, cut to the row lengths, without
+        # reading the blocks; None when the file has no preview step divides into
+        if self.preview_step is None or step % self.preview_step:
+            return None
+        cells = self.read_preview()
+        cols = self.preview_size()[1]
+        stride = step // self.preview_step
+        rows = []
+        for row in range(0, self.rows_count, step):
+            r = row // self.preview_step
+            rows += [cells[r*cols:(r + 1)*cols:stride][:-(-self.row_len(row) // step)]]
+        return rows
+
+    def read_cells(self, chunk_row, chunk_col, start, count):
+        # count palette ids of a block from index start
+        chunk = self.dirty.get((chunk_row, chunk_col))
+        if chunk is not None:
+            return chunk[start:start + count]
+        offset = self.chunk_offset(chunk_row, chunk_col) + start*2
+        cells = array.array('H')
+        cells.frombytes(self.mm[offset:offset + count*2])
+        if sys.byteorder == 'big':
+            cells.byteswap()
+        return cells
+
+    def writable_chunk(self, chunk_row, chunk_col):
+        chunk = self.dirty.get((chunk_row, chunk_col))
+        if chunk is None:
+            chunk = self.read_cells(chunk_row, chunk_col, 0, self.chunk_size * self.chunk_size)
+            self.dirty[(chunk_row, chunk_col)] = chunk
+        return chunk
+
+    def cell_id(self, row, col):
+        if not (0 <= row < self.rows_count and 0 <= col < self.row_len(row)):
+            raise IndexError('cell (%d, %d) is outside the map' % (row, col))
+        chunk_row, r = divmod(row, self.chunk_size)
+        chunk_col, c = divmod(col, self.chunk_size)
+        index = r*self.chunk_size + c
+        chunk = self.dirty.get((chunk_row, chunk_col))
+        if chunk is not None:
+            return chunk[index]
+        if self.cells is not None:
+            return self.cells[self.chunk_offset(chunk_row, chunk_col) // 2 + index]
+        return self.read_cells(chunk_row, chunk_col, index, 1)[0]
+
+    def get(self, row, col):
+        return self.palette[self.cell_id(row, col)]
+
+    def set(self, row, col, tile_name):
+        if not (0 <= row < self.rows_count and 0 <= col < self.row_len(row)):
+            raise IndexError('cell (%d, %d) is outside the map' % (row, col))
+        chunk_row, r = divmod(row, self.chunk_size)
+        chunk_col, c = divmod(col, self.chunk_size)
+        self.writable_chunk(chunk_row, chunk_col)[r*self.chunk_size + c] = self.tile_id(tile_name)
+
+    def region(self, first_row, first_col, num_rows, num_cols):
+        # one array of palette ids per row, cut to the row lengths
+        size = self.chunk_size
+        rows = []
+        for row in range(first_row, min(first_row + num_rows, self.rows_count)):
+            end = min(first_col + num_cols, self.row_len(row))
+            cells = array.array('H')
+            chunk_row, r = divmod(row, size)
+            col = first_col
+            while col < end:
+                chunk_col, c = divmod(col, size)
+                count = min(size - c, end - col)
+                cells.extend(self.read_cells(chunk_row, chunk_col, r*size + c, count))
+                col += count
+            rows += [cells]
+        return rows
+
+    def bands(self):
+        # the whole map, chunk_size rows at a time
+        for first_row in range(0, self.rows_count, self.chunk_size):
+            yield self.region(first_row, 0, self.chunk_size, self.cols_count)
+
+    def to_names(self):
+        return [[self.palette[tile_id] for tile_id in row] for band in self.bands() for row in band]
+
+    def to_tile_grid(self):
+        return TileGrid(self.palette, [row for band in self.bands() for row in band])
+
+    def count(self, tile_name):
+        tile_id = self.tile_ids.get(tile_name)
+        if tile_id is None:
+            return 0
+        return sum(row.count(tile_id) for band in self.bands() for row in band)
+
+    def replace(self, old_name, new_name):
+        old_id = self.tile_ids.get(old_name)
+        if old_id is None or old_name == new_name:
+            return
+        if new_name not in self.tile_ids:
+            self.palette[old_id] = new_name
+            del self.tile_ids[old_name]
+            self.tile_ids[new_name] = old_id
+            return
+        new_id = self.tile_ids[new_name]
+        for chunk_row in range(self.chunk_rows):
+            for chunk_col in range(self.chunk_cols):
+                if old_id in self.read_cells(chunk_row, chunk_col, 0, self.chunk_size * self.chunk_size):
+                    chunk = self.writable_chunk(chunk_row, chunk_col)
+                    for index, tile_id in enumerate(chunk):
+                        if tile_id == old_id:
+                            chunk[index] = new_id
+
+    def copy(self):
+        # shares the read-only mapping, changes to either grid stay separate
+        grid = copy.copy(self)
+        grid.palette = list(self.palette)
+        grid.tile_ids = dict(self.tile_ids)
+        grid.dirty = {key: array.array('H', chunk) for key, chunk in self.dirty.items()}
+        return grid
+
+    def save_csv(self, path):
+        with open(path, 'w', newline='\n', encoding='utf-8') as fout:
+            writer = csv.writer(fout)
+            for band in self.bands():
+                for row in band:
+                    writer.writerow(map(self.palette.__getitem__, row))
+
+    def save_in_place(self):
+        # writes back the changed blocks, their part of the preview and the header, False if the header no longer fits
+        header = encode_header(self, self.preview_step)
+        if len(header) > self.data_offset - PREFIX.size:
+            return False
+        preview = self.read_preview() if self.preview_step is not None and self.dirty else None
+        with open(self.path, 'r+b') as fout:
+            for (chunk_row, chunk_col), chunk in sorted(self.dirty.items()):
+                fout.seek(self.chunk_offset(chunk_row, chunk_col))
+                fout.write(chunk_bytes(chunk))
+            if preview is not None:
+                fout.seek(self.chunk_offset(self.chunk_rows, 0))
+                fout.write(chunk_bytes(preview))
+            fout.seek(0)
+            fout.write(PREFIX.pack(MAGIC, VERSION, self.chunk_size, len(header), self.data_offset) + header)
+            fout.flush()
+            os.fsync(fout.fileno())
+        return True
+
+    def close(self):
+        if self.cells is not None:
+            self.cells.release()
+            self.cells = None
+        self.mm.close()
+
+def encode_header(grid, step=None):
+    header = {'rows':grid.num_rows, 'cols':grid.num_cols, 'palette':grid.palette}
+    if step is not None:
+        header['preview'] = step
+    row_lens = [grid.row_len(row) for row in range(grid.num_rows)]
+    if any(row_len != grid.num_cols for row_len in row_lens):
+        header['row_lens'] = row_lens
+    return json.dumps(header).encode('utf8')
+
+def chunk_bytes(chunk):
+    if sys.byteorder == 'big':
+        chunk = array.array('H', chunk)
+        chunk.byteswap()
+    return chunk.tobytes()
+
+def write_chunked(grid, path, chunk_size=CHUNK_SIZE):
+    # writes any grid with region() and row_len(), a TileGrid or a ChunkedGrid
+    step = preview_step(grid.num_rows, grid.num_cols)
+    header = encode_header(grid, step)
+    data_offset = -(-(PREFIX.size + len(header) + HEADER_SLACK) // PAGE) * PAGE
+    chunk_cols = -(-grid.num_cols // chunk_size)
+    preview_cols = -(-grid.num_cols // step)
+    preview = array.array('H')
+    with open(path, 'wb') as fout:
+        fout.write(PREFIX.pack(MAGIC, VERSION, chunk_size, len(header), data_offset) + header)
+        fout.write(bytes(data_offset - PREFIX.size - len(header)))
+        for first_row in range(0, grid.num_rows, chunk_size):
+            band = grid.region(first_row, 0, chunk_size, grid.num_cols)
+            for chunk_col in range(chunk_cols):
+                chunk = array.array('H', [PADDING]) * (chunk_size * chunk_size)
+                for r, row in enumerate(band):
+                    part = row[chunk_col*chunk_size:(chunk_col + 1)*chunk_size]
+                    chunk[r*chunk_size:r*chunk_size + len(part)] = part
+                fout.write(chunk_bytes(chunk))
+            for r in range(-first_row % step, len(band), step):
+                cells = band[r][::step]
+                preview.extend(cells)
+                preview.extend([PADDING] * (preview_cols - len(cells)))
+        fout.write(chunk_bytes(preview))
+        fout.flush()
+        os.fsync(fout.fileno())
+
+def load_map(path):
+    if path.endswith('.smap'):
+        return ChunkedGrid(path)
+    return TileGrid.read_csv(path)
+
+def save_map(grid, path):
+    # the format follows the extension; a chunked map saved over its own file only writes its changes
+    if path.endswith('.smap'):
+        if isinstance(grid, ChunkedGrid) and os.path.abspath(path) == os.path.abspath(grid.path):
+            if grid.save_in_place():
+                return
+        tmp_path = path + '.tmp'
+        write_chunked(grid, tmp_path)
+    else:
+        tmp_path = path + '.tmp'
+        grid.save_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert maps between CSV and the chunked .smap format')
+    parser.add_argument('source', help='.csv or .smap map to read')
+    parser.add_argument('dest', help='.csv or .smap map to write')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    grid = load_map(args.source)
+    if args.dest.endswith('.smap'):
+        tmp_path = args.dest + '.tmp'
+        write_chunked(grid, tmp_path, args.chunk_size)
+        os.replace(tmp_path, args.dest)
+    else:
+        save_map(grid, args.dest)
+    print('wrote %s: %d x %d, %d tile types' % (args.dest, grid.num_rows, grid.num_cols, len(grid.palette)))
+
+if __name__ == '__main__':
+    main()
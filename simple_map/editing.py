@@ -0,0 +1,230 @@
+import array
+import base64
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .journal import Journal
+from .map_codec import encode_grid, decode_grid, group_cells
+from .chunked_map import ChunkedGrid, save_map
+
+# Cells covered by the map builder's tools, as (row, col) pairs. They may fall
+# outside the map, MapEditor.apply skips those.
+
+def rect_cells(row0, col0, row1, col1):
+    return [(row, col) for row in range(min(row0, row1), max(row0, row1) + 1)
+                       for col in range(min(col0, col1), max(col0, col1) + 1)]
+
+def line_cells(row0, col0, row1, col1):
+    # Bresenham
+    cells = []
+    d_row, d_col = abs(row1 - row0), abs(col1 - col0)
+    step_row = 1 if row1 >= row0 else -1
+    step_col = 1 if col1 >= col0 else -1
+    error = d_col - d_row
+    row, col = row0, col0
+    while True:
+        cells += [(row, col)]
+        if row == row1 and col == col1:
+            return cells
+        doubled = 2 * error
+        if doubled > -d_row:
+            error -= d_row
+            col += step_col
+        if doubled < d_col:
+            error += d_col
+            row += step_row
+
+def brush_cells(row, col, radius):
+    return [(row + r, col + c) for r in range(-radius, radius + 1)
+                               for c in range(-radius, radius + 1) if r*r + c*c <= radius*radius]
+
+def flood_cells(grid, row, col):
+    # the 4-connected area of cells with the same tile as (row, col)
+    if not (0 <= row < grid.num_rows and 0 <= col < grid.row_len(row)):
+        return []
+    tile_id = grid.cell_id(row, col)
+    stride = grid.num_cols
+    seen = bytearray(grid.num_rows * stride)
+    seen[row*stride + col] = 1
+    stack = [(row, col)]
+    cells = []
+    while stack:
+        row, col = stack.pop()
+        cells += [(row, col)]
+        for r, c in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+            if (0 <= r < grid.num_rows and 0 <= c < grid.row_len(r) and not seen[r*stride + c]
+                    and grid.cell_id(r, c) == tile_id):
+                seen[r*stride + c] = 1
+                stack += [(r, c)]
+    return cells
+
+# One undo step: the changed cells as flat indices with their palette ids
+# before and after.
+class Edit:
+    __slots__ = ('cells', 'old', 'new')
+
+    def __init__(self):
+        self.cells = array.array('I')
+        self.old = array.array('H')
+        self.new = array.array('H')
+
+    def __len__(self):
+        return len(self.cells)
+
+# Applies tool strokes to a TileGrid with undo/redo. Cells are written through
+# set_tile(row, col, tile_name), normally Game.set_tile which also redraws them. Changes are
+# journaled to autosave_dir in the background, along with a compressed copy of
+# the whole map every snapshot_every edits. Saving writes the CSV on a worker
+# thread from a copy of the grid, once that is on disk the autosave is
+# marked as matching the map file.
+class MapEditor:
+    def __init__(self, grid, set_tile, autosave_dir=None, snapshot_every=200, max_undo=500, saved=True,
+                 on_change=None, path=None):
+        self.grid = grid
+        # the map file being edited, saving anywhere else leaves the autosave alone
+        self.path = path
+        self.set_tile = set_tile
+        # called with tile name -> cell ids of every change, e.g. to send it to the server
+        self.on_change = on_change
+        self.stride = grid.num_cols
+        self.undo_stack = []
+        self.redo_stack = []
+        self.max_undo = max_undo
+        # edit being built by the current brush stroke, if any
+        self.stroke = None
+        self.saver = ThreadPoolExecutor(1)
+        self.journal = None
+        if autosave_dir is not None:
+            self.journal = Journal(autosave_dir, snapshot_every)
+            self.journal.recover()
+            self.journal.start()
+            self.snapshot(saved)
+
+    @staticmethod
+    def recover(autosave_dir):
+        # the autosaved map, or None if there is nothing that was not saved
+        journal = Journal(autosave_dir)
+        snapshot, records = journal.recover()
+        if snapshot is None or (snapshot['saved'] and not records):
+            return None
+        if 'base' in snapshot:
+            # a chunked map: its file plus the blocks changed since it was opened
+            grid = ChunkedGrid(snapshot['base'])
+            for tile_name in snapshot['palette']:
+                grid.tile_id(tile_name)
+            for key, data in snapshot['chunks'].items():
+                chunk = grid.writable_chunk(*map(int, key.split(',')))
+                chunk[:] = array.array('H', base64.b64decode(data))
+        else:
+            grid = decode_grid(base64.b64decode(snapshot['data']))
+        for record in records:
+            for tile_name, cells in record['set'].items():
+                for cell in cells:
+                    grid.set(*divmod(cell, snapshot['cols']), tile_name)
+        return grid
+
+    def snapshot_state(self, grid, saved):
+        # saved marks a snapshot that matches the map file
+        if isinstance(grid, ChunkedGrid):
+            # the file holds the rest, a large map is never copied as a whole
+            return {'saved':saved, 'cols':self.stride, 'base':grid.path, 'palette':list(grid.palette),
+                    'chunks':{'%d,%d' % key: base64.b64encode(chunk.tobytes()).decode('ascii')
+                              for key, chunk in grid.dirty.items()}}
+        return {'saved':saved, 'cols':self.stride, 'data':base64.b64encode(encode_grid(grid)).decode('ascii')}
+
+    def snapshot(self, saved=False):
+        self.journal.snapshot(self.snapshot_state(self.grid, saved))
+
+    def in_map(self, row, col):
+        return 0 <= row < self.grid.num_rows and 0 <= col < self.grid.row_len(row)
+
+    def begin_stroke(self):
+        self.end_stroke()
+        self.stroke = Edit()
+
+    def end_stroke(self):
+        if self.stroke is not None:
+            stroke, self.stroke = self.stroke, None
+            self.commit(stroke)
+
+    def apply(self, cells, tile_name):
+        # paints cells, as part of the current stroke if there is one
+        edit = self.stroke if self.stroke is not None else Edit()
+        tile_id = self.grid.tile_id(tile_name)
+        changed = []
+        for row, col in cells:
+            if self.in_map(row, col) and self.grid.cell_id(row, col) != tile_id:
+                edit.cells.append(row*self.stride + col)
+                edit.old.append(self.grid.cell_id(row, col))
+                edit.new.append(tile_id)
+                self.set_tile(row, col, tile_name)
+                changed += [row*self.stride + col]
+        self.log({tile_name: changed})
+        if edit is not self.stroke:
+            self.commit(edit)
+
+    def commit(self, edit):
+        if len(edit):
+            self.undo_stack += [edit]
+            del self.undo_stack[:-self.max_undo]
+            self.redo_stack = []
+
+    def restore(self, cell_ids):
+        palette = self.grid.palette
+        # a cell restored twice is logged once, with the tile it ends up with
+        cells = {}
+        for cell, tile_id in cell_ids:
+            row, col = divmod(cell, self.stride)
+            self.set_tile(row, col, palette[tile_id])
+            cells[cell] = palette[tile_id]
+        self.log(group_cells(cells))
+
+    def undo(self):
+        self.end_stroke()
+        if self.undo_stack:
+            edit = self.undo_stack.pop()
+            # cells are restored newest first, so a cell painted twice ends up with its first old value
+            self.restore(zip(reversed(edit.cells), reversed(edit.old)))
+            self.redo_stack += [edit]
+
+    def redo(self):
+        self.end_stroke()
+        if self.redo_stack:
+            edit = self.redo_stack.pop()
+            self.restore(zip(edit.cells, edit.new))
+            self.undo_stack += [edit]
+
+    def log(self, changes):
+        changes = {tile_name: cells for tile_name, cells in changes.items() if cells}
+        if self.on_change is not None and changes:
+            self.on_change(changes)
+        if self.journal is not None and changes:
+            self.journal.append({'set':changes})
+            if self.journal.needs_snapshot():
+                self.snapshot()
+
+    def save(self, path, done=None):
+        # the copy is taken now, later edits do not race with the writer thread
+        grid = self.grid.copy()
+        # the autosave of what is being written, it replaces the one on disk if the write succeeds;
+        # edits made meanwhile are after seq in the journal and stay there
+        saved_state = None
+        if self.journal is not None and self.path is not None and os.path.abspath(path) == os.path.abspath(self.path):
+            saved_state = self.snapshot_state(grid, True)
+            seq = self.journal.seq
+        def write():
+            try:
+                save_map(grid, path)
+            except OSError as e:
+                print('Failed to save %s: %s' % (path, e))
+                return
+            if saved_state is not None:
+                self.journal.snapshot(saved_state, seq)
+            if done is not None:
+                done(path)
+        return self.saver.submit(write)
+
+    def close(self):
+        self.end_stroke()
+        self.saver.shutdown(wait=True)
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import socket
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import pygame
+from .chunked_map import load_map
+from .token import image_scale
+from .protocol import encode_message, recv_message
+
+CLR_GREY = (200, 200, 200)
+CLR_LABEL = (0, 0, 255)
+# largest token footprint in cells, tokens starting this far above a band can still reach into it
+MAX_TOKEN_SCALE = 9
+
+# Renders a whole map to a PNG without ever holding the whole image. The image
+# is cut into bands of pixel rows, each one rendered and deflated on its own in
+# a worker process. The main process writes the compressed bands to the file
+# in order as one zlib stream, joining their checksums, so at most a few bands
+# are in memory at any time.
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+def adler32_combine(adler1, adler2, len2):
+    # adler32 of two blocks of data from the adler32 of each, as zlib's adler32_combine
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+# images, sizes and font of the process rendering bands, set by init_worker
+worker = {}
+
+def init_worker(palette, token_names, options):
+    pygame.font.init()
+    tile_size = options['tile_size']
+    tiles = []
+    for tile_name in palette:
+        tile_path = os.path.join(options['tile_dir'], tile_name + '.png')
+        if not os.path.exists(tile_path):
+            tile_path = os.path.join(options['tile_dir'], options['default_tile'] + '.png')
+        tiles += [pygame.transform.scale(pygame.image.load(tile_path), (tile_size, tile_size))]
+    tokens = {}
+    for token_name in token_names:
+        token_path = os.path.join(options['token_dir'], token_name + '.png')
+        if not os.path.exists(token_path):
+            token_path = os.path.join(options['token_dir'], options['default_token'] + '.png')
+        size = tile_size * image_scale(token_name)
+        tokens[token_name] = pygame.transform.scale(pygame.image.load(token_path), (size, size))
+    worker.clear()
+    worker.update(options, tiles=tiles, tokens=tokens, labels={})
+    if options['labels']:
+        worker['font'] = pygame.font.Font(options['font_path'], options['font_size'])
+
+def render_band(y0, height, first_row, rows, tokens):
+    # deflated scanlines of image rows y0 .. y0 + height, with their adler32 and length
+    tile_size = worker['tile_size']
+    pitch = tile_size + worker['tile_padding']
+    band = pygame.Surface((worker['width'], height))
+    band.fill(CLR_GREY)
+    tiles = worker['tiles']
+    band.blits([(tiles[tile_id], (c*pitch, (first_row + r)*pitch - y0))
+                for r, row in enumerate(rows) for c, tile_id in enumerate(row)], False)
+    for name, row, col, img in tokens:
+        x, y = col*pitch, row*pitch - y0
+        band.blit(worker['tokens'][img], (x, y))
+        if 'font' in worker:
+            if name not in worker['labels']:
+                worker['labels'][name] = worker['font'].render(name, True, CLR_LABEL)
+            band.blit(worker['labels'][name], (x, y + tile_size - worker['font_size']))
+    pixels = pygame.image.tostring(band, 'RGB')
+    stride = worker['width'] * 3
+    # filter type 0 (none) in front of every scanline
+    raw = b''.join(b'\x00' + pixels[i*stride:(i + 1)*stride] for i in range(height))
+    compressor = zlib.compressobj(worker['level'], zlib.DEFLATED, -15)
+    data = compressor.compress(raw) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(raw), len(raw)
+
+def band_tasks(grid, tokens, width, height, band_height, options):
+    tile_size = options['tile_size']
+    pitch = tile_size + options['tile_padding']
+    for y0 in range(0, height, band_height):
+        rows = min(band_height, height - y0)
+        first_row = y0 // pitch
+        last_row = (y0 + rows - 1) // pitch
+        grid_rows = grid.region(first_row, 0, last_row - first_row + 1, grid.num_cols)
+        band_tokens = [token for token in tokens
+                       if first_row - MAX_TOKEN_SCALE <= token[1] <= last_row]
+        yield (y0, rows, first_row, grid_rows, band_tokens)
+
+def export_map(grid, path, tile_size=64, tile_padding=1, tokens=None, labels=True, workers=None,
+               band_bytes=16*1024*1024, level=6, tile_dir='tiles', token_dir='tokens', font_path='arial.ttf',
+               font_size=None, default_tile='white', default_token='black_circle'):
+    # tokens: name -> {'row', 'col', 'img'} as the server has them, drawn in that order
+    # workers: processes to render with, None for one per core, 0 to render in this process
+    pitch = tile_size + tile_padding
+    width = max(1, grid.num_cols*pitch - tile_padding)
+    height = max(1, grid.num_rows*pitch - tile_padding)
+    token_list = [(name, token['row'], token['col'], token['img']) for name, token in (tokens or {}).items()
+                  if token.get('row') is not None and token.get('col') is not None]
+    # the font is only needed, and only has to exist, when there are tokens to label
+    options = {'tile_size':tile_size, 'tile_padding':tile_padding, 'width':width, 'level':level,
+               'tile_dir':tile_dir, 'token_dir':token_dir, 'labels':labels and bool(token_list), 'font_path':font_path,
+               'font_size':font_size or max(6, tile_size * 9 // 32),
+               'default_tile':default_tile, 'default_token':default_token}
+    # bands are sized by memory, not by grid rows, so a wide map gets thin bands
+    band_height = max(1, min(height, band_bytes // (width*3)))
+    init_args = (list(grid.palette), sorted({token[3] for token in token_list}), options)
+    tasks = band_tasks(grid, token_list, width, height, band_height, options)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    try:
+        write_png(path + '.tmp', tasks, init_args, width, height, level, workers)
+    except BaseException:
+        # no half written image is left behind
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+    os.replace(path + '.tmp', path)
+    return width, height
+
+def write_png(path, tasks, init_args, width, height, level, workers):
+    with open(path, 'wb') as fout:
+        fout.write(b'\x89PNG\r\n\x1a\n')
+        fout.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        # zlib header, then the raw deflate blocks of every band
+        fout.write(png_chunk(b'IDAT', b'\x78\x9c'))
+        adler = 1
+        if workers == 0:
+            init_worker(*init_args)
+            results = (render_band(*task) for task in tasks)
+            adler = write_bands(fout, results, adler)
+        else:
+            with ProcessPoolExecutor(workers, initializer=init_worker, initargs=init_args) as executor:
+                # a few bands ahead of the writer keep every worker busy without queueing the whole map
+                in_flight = []
+                results = []
+                for task in tasks:
+                    in_flight += [executor.submit(render_band, *task)]
+                    if len(in_flight) >= 2 * workers:
+                        adler = write_bands(fout, [in_flight.pop(0).result()], adler)
+                adler = write_bands(fout, (future.result() for future in in_flight), adler)
+        fout.write(png_chunk(b'IDAT', zlib.compressobj(level, zlib.DEFLATED, -15).flush() + struct.pack('>I', adler)))
+        fout.write(png_chunk(b'IEND', b''))
+
+def write_bands(fout, results, adler):
+    for data, band_adler, length in results:
+        fout.write(png_chunk(b'IDAT', data))
+        adler = adler32_combine(adler, band_adler, length)
+    return adler
+
+def fetch_tokens(host, port, room=None):
+    # the server's current tokens, as they are drawn on the client
+    with socket.create_connection((host, port)) as server_con:
+        if room is not None:
+            server_con.sendall(encode_message(json.dumps({'op':'join', 'arg':room})))
+            recv_message(server_con)
+        server_con.sendall(encode_message(json.dumps({'op':'get', 'arg':'tokens'})))
+        return json.loads(recv_message(server_con))
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a map to a PNG image')
+    parser.add_argument('map', help='.csv or .smap map file')
+    parser.add_argument('output', help='PNG file to write')
+    parser.add_argument('--tile-size', type=int, default=64)
+    parser.add_argument('--tile-padding', type=int, default=1)
+    parser.add_argument('--server', help='host:port to draw the current tokens from')
+    parser.add_argument('--room', help='room on the server, the default room if not given')
+    parser.add_argument('--no-labels', action='store_true', help='leave out token names')
+    parser.add_argument('--workers', type=int, help='render processes, default one per core, 0 for none')
+    args = parser.parse_args()
+
+    tokens = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        tokens = fetch_tokens(host, int(port), args.room)
+    started = time.perf_counter()
+    width, height = export_map(load_map(args.map), args.output, args.tile_size, args.tile_padding, tokens,
+                               not args.no_labels, args.workers)
+    print('wrote %s: %d x %d in %.1fs' % (args.output, width, height, time.perf_counter() - started))
+
+if __name__ == '__main__':
+    main()
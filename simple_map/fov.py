@@ -0,0 +1,104 @@
+from .tileset import sight_blocks, BLOCKED
+
+# Line of sight over a grid, worked out on a grid three times as fine so the
+# walls along cell edges (see tileset) cast shadows. A cell counts as seen
+# when its centre is lit or a lit part of it is a wall or window.
+# Sight is found by recursive shadowcasting: each of the eight octants is
+# scanned row by row outwards from the viewer, narrowing the range of lit
+# slopes at every blocking part, so every part in range is looked at once.
+
+def cell_runs(cells):
+    # cell ids as [first, count, first, count, ...] runs, how they are sent
+    runs = []
+    for cell in sorted(cells):
+        if runs and runs[-2] + runs[-1] == cell:
+            runs[-1] += 1
+        else:
+            runs += [cell, 1]
+    return runs
+
+def run_cells(runs):
+    return {cell for i in range(0, len(runs), 2) for cell in range(runs[i], runs[i] + runs[i + 1])}
+
+# (xx, xy, yx, yy) turning octant coordinates into grid offsets
+OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+           (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+class OpacityGrid:
+    def __init__(self, grid):
+        self.num_rows = grid.num_rows
+        self.num_cols = grid.num_cols
+        self.width = 3 * grid.num_cols
+        self.height = 3 * grid.num_rows
+        self.patterns = {}
+        palette = grid.palette
+        # outside a short row nothing can be seen through
+        rows = []
+        for row in grid.region(0, 0, grid.num_rows, grid.num_cols):
+            patterns = [self.pattern(palette[tile_id]) for tile_id in row]
+            padding = b'\x01\x01\x01' * (grid.num_cols - len(row))
+            for part_row in range(3):
+                rows += [b''.join(pattern[3*part_row:3*part_row + 3] for pattern in patterns) + padding]
+        self.sight = bytearray(b''.join(rows))
+
+    def pattern(self, tile_name):
+        if tile_name not in self.patterns:
+            self.patterns[tile_name] = sight_blocks(tile_name)
+        return self.patterns[tile_name]
+
+    def set_tile(self, row, col, tile_name):
+        pattern = self.pattern(tile_name)
+        for part_row in range(3):
+            start = (3*row + part_row) * self.width + 3*col
+            self.sight[start:start + 3] = pattern[3*part_row:3*part_row + 3]
+
+    def field_of_view(self, row, col, radius):
+        # ids (row * num_cols + col) of the cells seen from the centre of a cell, up to radius cells away
+        origin_x, origin_y = 3*col + 1, 3*row + 1
+        lit = {origin_y * self.width + origin_x}
+        for octant in OCTANTS:
+            self.cast_light(lit, origin_x, origin_y, 1, 1.0, 0.0, 3*radius, *octant)
+        width, num_cols, sight = self.width, self.num_cols, self.sight
+        cells = set()
+        for part in lit:
+            y, x = divmod(part, width)
+            if (y % 3 == 1 and x % 3 == 1) or sight[part]:
+                cells.add((y // 3) * num_cols + x // 3)
+        return cells
+
+    def cast_light(self, lit, origin_x, origin_y, first, start, end, radius, xx, xy, yx, yy):
+        if start < end:
+            return
+        width, height, sight = self.width, self.height, self.sight
+        radius_squared = radius * radius
+        new_start = start
+        for distance in range(first, radius + 1):
+            dx, dy = -distance - 1, -distance
+            in_shadow = False
+            while dx <= 0:
+                dx += 1
+                x = origin_x + dx*xx + dy*xy
+                y = origin_y + dx*yx + dy*yy
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+                # outside the map counts as blocking and is never lit
+                inside = 0 <= x < width and 0 <= y < height
+                opaque = not inside or sight[y*width + x] == BLOCKED
+                if inside and dx*dx + dy*dy <= radius_squared:
+                    lit.add(y*width + x)
+                if in_shadow:
+                    if opaque:
+                        new_start = right_slope
+                    else:
+                        in_shadow = False
+                        start = new_start
+                elif opaque and distance < radius:
+                    in_shadow = True
+                    self.cast_light(lit, origin_x, origin_y, distance + 1, start, left_slope, radius, xx, xy, yx, yy)
+                    new_start = right_slope
+            if in_shadow:
+                break
@@ -1,14 +1,18 @@
 import pygame
-import glob
 import os
-import socket
 import json
-import pkg_resources.py2_warn
-import configparser
-import csv
 import pygame_gui
-import copy
-import re
+import base64
+from collections import OrderedDict
+from .assets import AssetDirectory
+from .map_codec import decode_grid, map_hash
+from .chunked_map import load_map
+from .atlas import TextureAtlas
+from .token import Token
+from .minimap import Minimap
+from .fov import run_cells
+from .movement import MoveGrid, MAX_STEPS
+from .metrics import Metrics, PhaseTimer, startup
 
 class TokenSelectionDialog(pygame_gui.elements.UIWindow):
     def __init__(self, manager, row, col, token_images):
@@ -55,105 +59,278 @@ class Game:
                  tile_padding,
                  tile_size,
                  font_size,
-                 refresh_period):
+                 room=None,
+                 player=None):
         self.map_margin = map_margin
         self.tile_padding = tile_padding
         self.tile_size = tile_size
         self.font_size = font_size
         self.display_width = display_width
         self.display_height = display_height
-        self.refresh_period = refresh_period
+        
+        # screen areas that need redrawing, or everything when redraw_all is set
+        self.dirty_rects = []
+        self.redraw_all = True
+        # how often the stats overlay is refreshed, also while idle, in milliseconds
+        self.stats_period = 500
         
         self.default_token = 'black_circle'
         self.default_tile = 'white'
         
+        # pre-rendered blocks of chunk_size x chunk_size tiles, keyed by (chunk_row, chunk_col)
+        self.chunk_size = 16
+        self.map_chunks = OrderedDict()
+        # scaled tile surfaces indexed by the grid's palette ids
+        self.palette_tiles = []
+        # counts changes to the map, and to which cells tokens stand on, for the movement overlay's cache
+        self.map_version = 0
+        self.token_layout = 0
+        
         self.game_grid = None
         self.tokens = {}
-        self.selected_token = None
+        # last token state confirmed by the server, self.tokens also holds unacknowledged moves
+        self.server_tokens = {}
+        self.pending_moves = {}
+        self.pending_seen = set()
+        # (row, col) -> names of the tokens covering that cell, in drawing order
+        self.token_cells = {}
+        self._selected_token = None
         
         self.load_images()
-        
-        self.scaled_tiles = {}
-        self.scaled_token_images = {}
+        startup.mark('images')
+        # build the other zoom levels next to the current one in the background
+        self.prefetch_zoom_levels = True
         
         self.view_offset = (0,0)
         
+        self.NETWORK_EVENT = pygame.event.custom_type()
         if server_hostname is not None and server_port is not None:
-            self.server_con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_con.connect((server_hostname, server_port))
+            # asyncio is only imported when there is a server to talk to
+            from .network import NetworkClient
+            self.network = NetworkClient(server_hostname, server_port, room=room, notify=self.wake)
         else:
-            self.server_con = None
+            self.network = None
+        self.token_version = None
+        self.map_requested = False
+        # visible cells last reported to the server, which only sends tokens near them
+        self.reported_viewport = None
         
         self.mapfile = None
-        if self.server_con is not None:
+        self.map_hash = None
+        # hash of the server's map as last pushed, fetched when it differs from ours
+        self.server_map_hash = None
+        # live edits to the server's map included in our copy
+        self.map_edits = 0
+        # encoded maps received from the server, stored by content hash
+        self.map_cache_dir = 'map_cache'
+        # in fog of war the ids of the cells our tokens can see, None when the whole map is shown,
+        # and the chunks with any of them, worked out when drawn
+        self.fog = None
+        self.fog_chunks = None
+        if self.network is not None:
+            self.network.subscribe(self.token_version)
+            if player:
+                # names of our tokens, the server sends what they see when fog of war is on
+                self.network.set_player(player)
             self.update_map()
         
         print('initializing game engine')
         self.display = pygame.display.set_mode((display_width,display_height))
         pygame.display.set_caption('Simple Map')
         pygame.init()
-        self.font = pygame.font.Font('arial.ttf',self.font_size)
+        self.convert_images()
+        startup.mark('display')
+        self.fonts = {}
+        self.font = self.get_font(self.font_size)
         self.ui_manager = pygame_gui.UIManager((self.display_width, self.display_height))
+        startup.mark('ui')
         
         self.token_dialog = None
+        # rendered token names, keyed by (name, font size, colour)
+        self.label_cache = {}
+        
+        # per-phase frame timings, shown in an overlay toggled with F3
+        self.metrics = Metrics(window=300)
+        self.show_stats = False
+        self.stats_rect = pygame.Rect(0, 0, 0, 0)
+        self.stats_drawn = 0
+        
+        # overview of the whole map in the bottom left corner, toggled with M
+        self.show_minimap = True
+        self.tile_colours = {}
+        # (row, col, cells per side) of every token, sent now and then by a server that
+        # only sends us the tokens near the viewport; None when self.tokens has them all
+        self.token_positions = None
+        
+        # where the selected token can get to within move_range steps, changed with [ and ],
+        # and the way to the cell under the cursor
+        self.move_range = 6
+        self.hover_cell = None
+        self.reach_cache = OrderedDict()
+    
+    @property
+    def game_grid(self):
+        return self._game_grid
+    
+    @game_grid.setter
+    def game_grid(self, game_grid):
+        self._game_grid = game_grid
+        if game_grid:
+            self.grid_cols = game_grid.num_cols
+        else:
+            self.grid_cols = 0
+        self.map_chunks.clear()
+        self.fog_chunks = None
+        self.move_grid = None
+        self.map_version += 1
+        self.palette_tiles = []
+        self.minimap = None
+        self.minimap_rect = pygame.Rect(0, 0, 0, 0)
+        self.invalidate()
+    
+    @property
+    def view_offset(self):
+        return self._view_offset
+    
+    @view_offset.setter
+    def view_offset(self, view_offset):
+        self._view_offset = view_offset
+        self.invalidate()
+    
+    @property
+    def selected_token(self):
+        return self._selected_token
+    
+    @selected_token.setter
+    def selected_token(self, name):
+        for token_name in (self._selected_token, name):
+            if token_name in self.tokens:
+                self.invalidate(self.token_rect(token_name))
+        self.invalidate(self.movement_rect())
+        self._selected_token = name
+        self.invalidate(self.movement_rect())
+    
+    def set_tile(self, row, col, tile_name):
+        self.game_grid.set(row, col, tile_name)
+        self.map_chunks.pop((row // self.chunk_size, col // self.chunk_size), None)
+        x, y = self.row_col_to_x_y(row, col)
+        self.invalidate(pygame.Rect(x, y, self.tile_size, self.tile_size))
+        if self.minimap is not None and self.minimap.set_cell(row, col):
+            self.invalidate(self.minimap_rect)
+        if self.move_grid is not None:
+            self.move_grid.set_tile(row, col, tile_name)
+        self.map_version += 1
+        self.invalidate(self.movement_rect())
+    
+    def wake(self):
+        # called from the network thread so an idle game_loop picks up the update
+        try:
+            pygame.event.post(pygame.event.Event(self.NETWORK_EVENT))
+        except pygame.error:
+            # display not initialized yet or already shut down
+            pass
+    
+    def invalidate(self, rect=None):
+        if rect is None:
+            self.redraw_all = True
+        elif not self.redraw_all:
+            self.dirty_rects += [rect]
+    
+    def take_dirty_rects(self):
+        screen = self.display.get_rect()
+        if self.redraw_all:
+            rects = [screen]
+        else:
+            rects = [rect.clip(screen) for rect in self.dirty_rects]
+            rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+            if len(rects) > 8:
+                rects = [rects[0].unionall(rects[1:])]
+        self.redraw_all = False
+        self.dirty_rects = []
+        return rects
     
     def __del__(self):
-        if self.server_con is not None:
-            self.server_con.close()
+        if self.network is not None:
+            self.network.close()
     
     def load_images(self):
         print('loading images...')
-        self.tiles = {}
-        
-        for img_file in glob.glob('tiles/*.png'):
-            tile_name = os.path.splitext(os.path.basename(img_file))[0]
-            self.tiles[tile_name] = pygame.image.load(img_file)
-            
-        self.token_images = {}
-
-        for img_file in glob.glob('tokens/*.png'):
-            token_name = os.path.splitext(os.path.basename(img_file))[0]
-            self.token_images[token_name] = pygame.image.load(img_file)
+        # tiles are needed for the first frame, tokens finish loading in the background
+        self.tiles = AssetDirectory('tiles').load()
+        self.token_loader = AssetDirectory('tokens').load_async()
+        self._token_images = None
+        self._token_atlas = None
+    
+    @staticmethod
+    def convert_surfaces(images):
+        # match the display pixel format once instead of converting on every blit
+        for name, image in images.items():
+            if image.get_flags() & pygame.SRCALPHA:
+                images[name] = image.convert_alpha()
+            else:
+                images[name] = image.convert()
+        return images
+    
+    def convert_images(self):
+        # tiles are always drawn over the grey background
+        self.tile_atlas = TextureAtlas(self.convert_surfaces(self.tiles), background=self.CLR_GREY)
+    
+    @property
+    def token_images(self):
+        if self._token_images is None:
+            self._token_images = self.convert_surfaces(self.token_loader.result())
+        return self._token_images
+    
+    @property
+    def token_atlas(self):
+        # tokens keep their alpha
+        if self._token_atlas is None:
+            self._token_atlas = TextureAtlas(self.token_images)
+        return self._token_atlas
+    
+    def get_font(self, font_size):
+        if font_size not in self.fonts:
+            self.fonts[font_size] = pygame.font.Font('arial.ttf',font_size)
+        return self.fonts[font_size]
             
     def rescale_assets(self):
-        #Rescale font, this is the lazy way
-        self.font = pygame.font.Font('arial.ttf',self.font_size)
-        #clear scaled tile and token caches
-        self.scaled_tiles = {}
-        self.scaled_token_images = {}
+        self.font = self.get_font(self.font_size)
+        self.label_cache = {}
+        #scaled tiles and tokens come from the atlas level for the new size
+        self.map_chunks.clear()
+        self.palette_tiles = []
+        self.invalidate()
+        if self.prefetch_zoom_levels:
+            for tile_size in (self.tile_size - 5, self.tile_size + 5):
+                self.tile_atlas.prefetch(tile_size)
+                self.token_atlas.prefetch(tile_size)
     
     def get_scaled_token(self, token_name):
-        if token_name in self.scaled_token_images:
-            return self.scaled_token_images[token_name]
-        elif token_name in self.token_images:
-            if re.match('_[2-9]x',token_name[-3:]) is not None:
-                scale_factor = int(token_name[-2])
-            else:
-                scale_factor = 1
-            self.scaled_token_images[token_name] = pygame.transform.scale(self.token_images[token_name],
-                                                                              (self.tile_size*scale_factor,self.tile_size*scale_factor))
-            return self.scaled_token_images[token_name]
+        scaled_token_images = self.token_atlas.get_level(self.tile_size)
+        if token_name in scaled_token_images:
+            return scaled_token_images[token_name]
         else:
             print('Token with name "%s" not found.' % token_name)
             return self.get_scaled_token(self.default_token)
 
     def get_scaled_tile(self, tile_name):
-        if tile_name in self.scaled_tiles:
-            return self.scaled_tiles[tile_name]
-        elif tile_name in self.tiles:
-            self.scaled_tiles[tile_name] = pygame.transform.scale(self.tiles[tile_name],
-                                                                 (self.tile_size,self.tile_size))
-            return self.scaled_tiles[tile_name]
+        scaled_tiles = self.tile_atlas.get_level(self.tile_size)
+        if tile_name in scaled_tiles:
+            return scaled_tiles[tile_name]
         else:
             print('Tile with name "%s" not found.' % tile_name)
             return self.get_scaled_tile(self.default_tile)
 
     def x_y_to_row_col(self, x, y):
-        for row in range(len(self.game_grid)):
-            for col in range(len(self.game_grid[row])):
-                tile_x, tile_y = self.row_col_to_x_y(row, col)
-                if tile_x < x < (tile_x + self.tile_size) and tile_y < y < (tile_y + self.tile_size):
-                    return (row, col)
+        if not self.game_grid:
+            return None
+        origin_x, origin_y = self.row_col_to_x_y(0, 0)
+        col, tile_x = divmod(x - origin_x, self.tile_size + self.tile_padding)
+        row, tile_y = divmod(y - origin_y, self.tile_size + self.tile_padding)
+        if not (0 < tile_x < self.tile_size and 0 < tile_y < self.tile_size):
+            return None
+        if 0 <= row < self.game_grid.num_rows and 0 <= col < self.game_grid.row_len(row):
+            return (row, col)
         return None
 
     def row_col_to_x_y(self, row, col):
@@ -161,70 +338,438 @@ class Game:
         x_pos = self.map_margin + col*(self.tile_size + self.tile_padding)
         return (x_pos+self.view_offset[0],y_pos+self.view_offset[1])
 
+    def get_label(self, name, colour):
+        key = (name, self.font_size, colour)
+        label = self.label_cache.get(key)
+        if label is None:
+            label = self.font.render(name, True, colour)
+            self.label_cache[key] = label
+        return label
+
+    def token_rect(self, name):
+        token = self.tokens[name]
+        if not token.on_map:
+            return pygame.Rect(0, 0, 0, 0)
+        x, y = self.row_col_to_x_y(token.row, token.col)
+        rect = pygame.Rect(x, y, self.tile_size*token.scale, self.tile_size*token.scale)
+        label = self.get_label(name, (0, 0, 255))
+        return rect.union(pygame.Rect(x, y + self.tile_size - self.font_size, label.get_width(), label.get_height()))
+
     def draw_tokens(self):
+        clip = self.display.get_clip()
         for name,token in self.tokens.items():
-            if token['row'] is not None and token['col'] is not None:
-                x,y = self.row_col_to_x_y(token['row'], token['col'])
-                self.display.blit(self.get_scaled_token(token['img']),(x,y))
+            if token.on_map and clip.colliderect(self.token_rect(name)):
+                x,y = self.row_col_to_x_y(token.row, token.col)
+                self.display.blit(self.get_scaled_token(token.img),(x,y))
                 # now print the text
-                text_surface = self.font.render(name, True, (0, 0, 255))
-                self.display.blit(text_surface, dest=(x,y+self.tile_size-self.font_size))
+                self.display.blit(self.get_label(name, (0, 0, 255)), dest=(x,y+self.tile_size-self.font_size))
                 if name == self.selected_token:
-                    if re.match('_[2-9]x',token['img'][-3:]) is not None:
-                        scale_factor = int(token['img'][-2])
-                    else:
-                        scale_factor = 1
-                    pygame.draw.rect(self.display, (255,0,0), pygame.Rect(x,y, self.tile_size*scale_factor, self.tile_size*scale_factor), 3)
+                    pygame.draw.rect(self.display, (255,0,0), pygame.Rect(x,y, self.tile_size*token.scale, self.tile_size*token.scale), 3)
+
+    def get_palette_tiles(self):
+        palette = self.game_grid.palette
+        while len(self.palette_tiles) < len(palette):
+            self.palette_tiles += [self.get_scaled_tile(palette[len(self.palette_tiles)])]
+        return self.palette_tiles
+
+    def render_chunk(self, chunk_row, chunk_col):
+        pitch = self.tile_size + self.tile_padding
+        first_row = chunk_row * self.chunk_size
+        first_col = chunk_col * self.chunk_size
+        rows = self.game_grid.region(first_row, first_col, self.chunk_size, self.chunk_size)
+        chunk_cols = min(self.chunk_size, self.grid_cols - first_col)
+        surface = pygame.Surface((chunk_cols*pitch, len(rows)*pitch))
+        palette_tiles = self.get_palette_tiles()
+        if self.fog is None:
+            surface.fill(self.CLR_GREY)
+            surface.blits([(palette_tiles[tile_id], (c*pitch, r*pitch))
+                           for r, row in enumerate(rows)
+                           for c, tile_id in enumerate(row)], False)
+        else:
+            # cells out of sight stay black
+            surface.fill(self.CLR_BLACK)
+            surface.blits([(palette_tiles[tile_id], (c*pitch, r*pitch))
+                           for r, row in enumerate(rows)
+                           for c, tile_id in enumerate(row)
+                           if (first_row + r)*self.grid_cols + first_col + c in self.fog], False)
+        return surface
+
+    def get_fog_chunks(self):
+        if self.fog_chunks is None:
+            self.fog_chunks = {(row // self.chunk_size, col // self.chunk_size)
+                               for row, col in (divmod(cell, self.grid_cols) for cell in self.fog)}
+        return self.fog_chunks
+
+    def apply_fog(self, message):
+        # cells are ids on the server's map, which ours is or soon will be
+        self.fog = None if message['cells'] is None else run_cells(message['cells'])
+        self.fog_chunks = None
+        self.map_chunks.clear()
+        self.invalidate()
+
+    def visible_cells(self, rect):
+        # inclusive (first_row, first_col, last_row, last_col) of the cells overlapping rect
+        pitch = self.tile_size + self.tile_padding
+        origin_x, origin_y = self.row_col_to_x_y(0, 0)
+        first_col = max(0, (rect.left - origin_x) // pitch)
+        first_row = max(0, (rect.top - origin_y) // pitch)
+        last_col = min(self.grid_cols - 1, (rect.right - 1 - origin_x) // pitch)
+        last_row = min(self.game_grid.num_rows - 1, (rect.bottom - 1 - origin_y) // pitch)
+        return (first_row, first_col, last_row, last_col)
 
     def draw_tiles(self, display):
-        for row in range(len(self.game_grid)):
-            for col in range(len(self.game_grid[row])):
-                x_pos, y_pos = self.row_col_to_x_y(row, col)
-                display.blit(self.get_scaled_tile(self.game_grid[row][col]), (x_pos,y_pos))
+        if not self.game_grid:
+            return
+        first_row, first_col, last_row, last_col = self.visible_cells(display.get_clip())
+        if first_row > last_row or first_col > last_col:
+            return
+        visible_chunks = 0
+        pitch = self.tile_size + self.tile_padding
+        for chunk_row in range(first_row // self.chunk_size, last_row // self.chunk_size + 1):
+            for chunk_col in range(first_col // self.chunk_size, last_col // self.chunk_size + 1):
+                key = (chunk_row, chunk_col)
+                if self.fog is not None and key not in self.get_fog_chunks():
+                    # nothing in sight, no need to render it
+                    x, y = self.row_col_to_x_y(chunk_row*self.chunk_size, chunk_col*self.chunk_size)
+                    rows = min(self.chunk_size, self.game_grid.num_rows - chunk_row*self.chunk_size)
+                    cols = min(self.chunk_size, self.grid_cols - chunk_col*self.chunk_size)
+                    display.fill(self.CLR_BLACK, pygame.Rect(x, y, cols*pitch, rows*pitch))
+                    continue
+                chunk = self.map_chunks.get(key)
+                if chunk is None:
+                    chunk = self.render_chunk(chunk_row, chunk_col)
+                    self.map_chunks[key] = chunk
+                else:
+                    self.map_chunks.move_to_end(key)
+                display.blit(chunk, self.row_col_to_x_y(chunk_row*self.chunk_size, chunk_col*self.chunk_size))
+                visible_chunks += 1
+        # keep the chunks around the viewport, drop the least recently drawn ones
+        while len(self.map_chunks) > max(2*visible_chunks, 8):
+            self.map_chunks.popitem(last=False)
 
-    def update_tokens(self):
-        self.server_con.sendall(json.dumps({'op':'get', 'arg':'tokens'}).encode())
-        try:
-            resp_len_str = self.server_con.recv(8).decode()
-            resp_len = int(resp_len_str)
-            data = ''
-            while len(data) < resp_len:
-                data += self.server_con.recv(resp_len - len(data)).decode()
-            try:
-                self.tokens = json.loads(data)
-            except json.decoder.JSONDecodeError:
-                print('Failed to parse tokens')
-        except ValueError:
-            print('Failed to parse response length')
+    def tile_colour(self, tile_name):
+        # average colour of each tile image, worked out the first time a minimap needs it
+        if tile_name not in self.tile_colours:
+            image = self.tiles.get(tile_name, self.tiles.get(self.default_tile))
+            if image is None:
+                self.tile_colours[tile_name] = self.CLR_WHITE
+            else:
+                self.tile_colours[tile_name] = tuple(pygame.transform.average_color(image))[:3]
+        return self.tile_colours[tile_name]
+
+    def get_minimap(self):
+        # built once per map, kept up to date by set_tile
+        if self.minimap is None:
+            self.minimap = Minimap(self.game_grid, self.tile_colour, background=self.CLR_GREY)
+            width, height = self.minimap.size
+            self.minimap_rect = pygame.Rect(10, self.display_height - height - 10, width, height)
+        return self.minimap
+
+    def minimap_cell(self, pos):
+        # cell of the map under a point on the minimap, None when the point is not on it
+        if not (self.show_minimap and self.game_grid) or self.fog is not None:
+            return None
+        minimap = self.get_minimap()
+        if not self.minimap_rect.collidepoint(pos):
+            return None
+        return minimap.cell_at(pos[0] - self.minimap_rect.x, pos[1] - self.minimap_rect.y)
+
+    def centre_on(self, row, col):
+        pitch = self.tile_size + self.tile_padding
+        self.view_offset = (self.display_width // 2 - self.map_margin - col*pitch - self.tile_size // 2,
+                            self.display_height // 2 - self.map_margin - row*pitch - self.tile_size // 2)
+
+    def draw_minimap(self, display):
+        # no overview of the map in fog of war, it would show what the fog hides
+        if not (self.show_minimap and self.game_grid) or self.fog is not None:
+            return
+        minimap = self.get_minimap()
+        if not display.get_clip().colliderect(self.minimap_rect.inflate(2, 2)):
+            return
+        display.blit(minimap.get_surface(), self.minimap_rect)
+        markers = [(token.row, token.col, token.scale) for token in self.tokens.values() if token.on_map]
+        if self.token_positions is not None and self.reported_viewport is not None:
+            # the server's positions for the tokens we are not sent, ours are newer inside the viewport
+            first_row, first_col, last_row, last_col = self.reported_viewport
+            markers += [(row, col, scale) for row, col, scale in self.token_positions
+                        if not (first_row <= row <= last_row and first_col <= col <= last_col)]
+        for row, col, scale in markers:
+            rect = minimap.cell_rect(row, col, row + scale - 1, col + scale - 1)
+            display.fill((255, 0, 0), rect.move(self.minimap_rect.topleft).inflate(2, 2))
+        view = minimap.cell_rect(*self.visible_cells(display.get_rect()))
+        pygame.draw.rect(display, self.CLR_WHITE, view.move(self.minimap_rect.topleft).clip(self.minimap_rect), 1)
+        pygame.draw.rect(display, self.CLR_BLACK, self.minimap_rect.inflate(2, 2), 1)
+
+    def get_reach(self, name):
+        # where a token can move, cached by its position, the range and what stands in the way
+        token = self.tokens[name]
+        key = (token.row, token.col, self.move_range, self.map_version, self.token_layout)
+        reach = self.reach_cache.get(key)
+        if reach is None:
+            if self.move_grid is None:
+                self.move_grid = MoveGrid(self.game_grid)
+            occupied = {row*self.grid_cols + col for (row, col), names in self.token_cells.items()
+                        if names != [name]}
+            reach = self.move_grid.reach(token.row, token.col, self.move_range, occupied)
+            self.reach_cache[key] = reach
+            while len(self.reach_cache) > 8:
+                self.reach_cache.popitem(last=False)
+        else:
+            self.reach_cache.move_to_end(key)
+        return reach
+
+    def movement_rect(self):
+        # screen area of the movement overlay of the selected token
+        token = self.tokens.get(self.selected_token)
+        if token is None or not token.on_map:
+            return pygame.Rect(0, 0, 0, 0)
+        pitch = self.tile_size + self.tile_padding
+        x, y = self.row_col_to_x_y(token.row - self.move_range, token.col - self.move_range)
+        return pygame.Rect(x, y, (2*self.move_range + 1)*pitch, (2*self.move_range + 1)*pitch)
+
+    def draw_movement(self, display):
+        # shade the cells the selected token can reach, with the way to the cell under the cursor
+        if not self.game_grid or not display.get_clip().colliderect(self.movement_rect()):
+            return
+        reach = self.get_reach(self.selected_token)
+        shade = pygame.Surface((self.tile_size, self.tile_size))
+        shade.fill((0, 0, 255))
+        shade.set_alpha(60)
+        display.blits([(shade, self.row_col_to_x_y(row, col)) for row, col in reach.cells
+                       if self.fog is None or row*self.grid_cols + col in self.fog], False)
+        if self.hover_cell is None:
+            return
+        path = reach.path_to(*self.hover_cell)
+        if len(path) < 2:
+            return
+        centre = self.tile_size // 2
+        points = [(x + centre, y + centre) for x, y in (self.row_col_to_x_y(row, col) for row, col in path)]
+        pygame.draw.lines(display, (255, 255, 0), False, points, 3)
+        label = self.get_label(str(len(path) - 1), (255, 255, 0))
+        display.blit(label, (points[-1][0] - label.get_width() // 2, points[-1][1] - label.get_height() // 2))
+
+    def token_footprint(self, token):
+        if not token.on_map:
+            return []
+        return [(token.row + r, token.col + c) for r in range(token.scale) for c in range(token.scale)]
+    
+    def index_token(self, name):
+        self.invalidate(self.token_rect(name))
+        self.invalidate(self.minimap_rect)
+        self.invalidate(self.movement_rect())
+        self.token_layout += 1
+        for cell in self.token_footprint(self.tokens[name]):
+            self.token_cells.setdefault(cell, []).append(name)
+    
+    def unindex_token(self, name):
+        self.invalidate(self.token_rect(name))
+        self.invalidate(self.minimap_rect)
+        self.invalidate(self.movement_rect())
+        self.token_layout += 1
+        for cell in self.token_footprint(self.tokens[name]):
+            names = self.token_cells.get(cell)
+            if names is not None and name in names:
+                names.remove(name)
+                if not names:
+                    del self.token_cells[cell]
+    
+    def token_at(self, row, col):
+        names = self.token_cells.get((row, col))
+        if names:
+            # the last token indexed on a cell is the one drawn on top
+            return names[-1]
+        return None
+    
+    def set_tokens(self, tokens):
+        for name, token in self.tokens.items():
+            if tokens.get(name) != token:
+                self.unindex_token(name)
+        old_tokens = self.tokens
+        self.tokens = tokens
+        for name, token in tokens.items():
+            if old_tokens.get(name) != token:
+                self.index_token(name)
+        self.deselect_missing()
+
+    def show_token(self, name, token):
+        if name in self.tokens:
+            self.unindex_token(name)
+            del self.tokens[name]
+        if token is not None:
+            self.tokens[name] = token
+            self.index_token(name)
+        self.deselect_missing()
+
+    def deselect_missing(self):
+        # the selected token went out of view or was removed, there is nothing left to move
+        if self._selected_token is not None and self._selected_token not in self.tokens:
+            self.selected_token = None
+            # where its movement overlay was is not known any more
+            self.invalidate()
+
+    def apply_token_delta(self, delta):
+        if delta['base'] is None:
+            self.server_tokens = {name: Token.from_dict(token) for name, token in delta['tokens'].items()}
+            tokens = dict(self.server_tokens)
+            for name in self.pending_moves:
+                self.pending_seen.add(name)
+                if name in self.tokens:
+                    tokens[name] = self.tokens[name]
+                else:
+                    tokens.pop(name, None)
+            self.set_tokens(tokens)
+        elif delta['base'] != self.token_version:
+            # missed an update, ask the server for everything since the version we have
+            self.network.subscribe(self.token_version)
+            return
+        else:
+            changes = [(name, None) for name in delta['removed']]
+            changes += [(name, Token.from_dict(token)) for name, token in delta['tokens'].items()]
+            for name, token in changes:
+                if token is None:
+                    self.server_tokens.pop(name, None)
+                else:
+                    self.server_tokens[name] = token
+                # moves still waiting for an ack keep their optimistic position
+                if name in self.pending_moves:
+                    self.pending_seen.add(name)
+                else:
+                    self.show_token(name, token)
+        self.token_version = delta['version']
+
+    def reconcile_move(self, name, acknowledged):
+        self.pending_moves[name] -= 1
+        if self.pending_moves[name] > 0:
+            return
+        del self.pending_moves[name]
+        if not acknowledged:
+            print('Move not acknowledged by server')
+            self.show_token(name, self.server_tokens.get(name))
+        elif name in self.pending_seen:
+            # the server state already includes this move, anything newer wins
+            self.show_token(name, self.server_tokens.get(name))
+        self.pending_seen.discard(name)
+
+    def process_network(self):
+        self.network.flush()
+        for kind, tag, data in self.network.poll():
+            if kind == 'tokens':
+                self.apply_token_delta(data)
+            elif kind == 'cells':
+                self.apply_cell_delta(data)
+            elif kind == 'fog':
+                self.apply_fog(data)
+            elif kind == 'positions':
+                self.token_positions = [tuple(position) for position in data['tokens']]
+                self.invalidate(self.minimap_rect)
+            elif kind == 'map':
+                self.server_map_hash = data['map']
+            elif kind == 'response':
+                if tag == 'map':
+                    self.receive_map_header(data)
+                elif tag == 'map_data':
+                    self.receive_map_data(data)
+                elif tag == 'join':
+                    if data != 'ack':
+                        print('Failed to join room')
+                elif tag == 'cells':
+                    if data != 'ack':
+                        print('Map edit not accepted by server')
+                elif tag[0] == 'move':
+                    self.reconcile_move(tag[1], data == 'ack')
+            elif kind == 'disconnected':
+                print('Lost connection to server')
+        if self.server_map_hash is not None and self.server_map_hash != self.map_hash:
+            # also catches a map that changed again while the last one was being fetched
+            self.update_map()
+    
+    def report_viewport(self):
+        if self.game_grid:
+            viewport = self.visible_cells(self.display.get_rect())
+            if viewport != self.reported_viewport:
+                self.reported_viewport = viewport
+                self.network.set_viewport(viewport)
     
     @staticmethod
     def load_map(mapfile):
-        game_grid = []
-        with open(os.path.join('maps',mapfile), 'r') as fin:
-            reader = csv.reader(fin)
-            for row in reader:
-                game_grid += [row]
-        return game_grid
+        # .smap maps are memory-mapped and open without parsing the whole file
+        return load_map(os.path.join('maps',mapfile))
         
     def update_map(self):
-        self.server_con.sendall(json.dumps({'op':'get', 'arg':'map'}).encode())
-        resp_len = int(self.server_con.recv(8).decode())
-        data = self.server_con.recv(resp_len)
-        mapfile = json.loads(data.decode())
-        if mapfile != self.mapfile:
-            self.game_grid = self.load_map(mapfile)
-            self.mapfile = mapfile
+        if not self.map_requested:
+            self.map_requested = True
+            self.network.send_request({'op':'get', 'arg':'map', 'data':{'hash':self.map_hash}}, 'map')
+
+    def receive_map_header(self, data):
+        if not data:
+            # our copy is current
+            self.map_requested = False
+            return
+        header = json.loads(data)
+        cache_file = os.path.join(self.map_cache_dir, header['hash'] + '.map')
+        blob = None
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as fin:
+                blob = fin.read()
+        if blob is not None and map_hash(blob) == header['hash']:
+            self.set_map(header['name'], header['hash'], blob, header.get('edits', 0), header.get('cells'))
+            self.map_requested = False
+        else:
+            self.network.send_request({'op':'get', 'arg':'map_data', 'data':header['hash']}, 'map_data')
+
+    def receive_map_data(self, data):
+        self.map_requested = False
+        if data == 'err':
+            # the map changed again before we fetched it, the next update picks it up
+            return
+        header = json.loads(data)
+        blob = base64.b64decode(header['data'])
+        if map_hash(blob) != header['hash']:
+            print('Map data does not match its hash')
+            return
+        os.makedirs(self.map_cache_dir, exist_ok=True)
+        with open(os.path.join(self.map_cache_dir, header['hash'] + '.map'), 'wb') as fout:
+            fout.write(blob)
+        self.set_map(header['name'], header['hash'], blob, header.get('edits', 0), header.get('cells'))
+
+    def set_map(self, mapfile, hash_hex, blob, edits=0, cells=None):
+        # cells: the server's live edits to the map so far
+        grid = decode_grid(blob)
+        for tile_name, cell_ids in (cells or {}).items():
+            for cell in cell_ids:
+                grid.set(*divmod(cell, grid.num_cols), tile_name)
+        self.game_grid = grid
+        self.mapfile = mapfile
+        self.map_hash = hash_hex
+        self.map_edits = edits
+
+    def apply_cell_delta(self, delta):
+        if delta['map'] != self.map_hash or not self.game_grid or delta['version'] <= self.map_edits:
+            # edits to a map we are about to replace, or ones our copy already has
+            return
+        if delta['base'] > self.map_edits:
+            # missed some edits, fetch the map again, it comes with all of them
+            self.map_hash = None
+            self.update_map()
+            return
+        stride = self.game_grid.num_cols
+        for tile_name, cell_ids in delta['cells'].items():
+            for cell in cell_ids:
+                # only the chunks and screen areas of these cells are redrawn
+                self.set_tile(*divmod(cell, stride), tile_name)
+        self.map_edits = delta['version']
 
     def move_token(self,name, row, col):
-        token_to_move = self.tokens[name]
-        token_to_move['name'] = name
-        token_to_move['row'] = row
-        token_to_move['col'] = col
-        self.server_con.sendall(json.dumps({'op':'set', 'arg':'place_token', 'data':token_to_move}).encode())
-        resp_len = int(self.server_con.recv(8).decode())
-        data = self.server_con.recv(resp_len)
-        if data.decode() != 'ack':
-            print('Move not acknowledged by server')
+        # shown right away, reconciled with the server state once the move is acknowledged
+        if name not in self.tokens:
+            return
+        token_to_move = self.tokens[name].moved(row, col)
+        self.show_token(name, token_to_move)
+        if self.network is not None:
+            self.pending_moves[name] = self.pending_moves.get(name, 0) + 1
+            self.pending_seen.discard(name)
+            self.network.send_request({'op':'set', 'arg':'place_token', 'data':dict(token_to_move.to_dict(), name=name)},
+                                      ('move', name))
     
     def process_event(self, event):
         if self.token_dialog is not None:
@@ -237,7 +782,11 @@ class Game:
         ############################
         # if any mouse button is pressed
         if event.type == pygame.MOUSEBUTTONDOWN and not token_window_open:
-            if event.button == 1:
+            minimap_rc = self.minimap_cell(event.pos)
+            if minimap_rc is not None:
+                if event.button == 1:
+                    self.centre_on(*minimap_rc)
+            elif event.button == 1:
                 pos_rc = self.x_y_to_row_col(*event.pos)
                 if pos_rc is not None:
                     if self.selected_token is not None:
@@ -250,10 +799,7 @@ class Game:
                                                                  col=pos_rc[1],
                                                                  token_images=self.token_images)
                     else:
-                        for token_name, token in self.tokens.items():
-                            if (token['row'], token['col']) == pos_rc:
-                                self.selected_token = token_name
-                                break
+                        self.selected_token = self.token_at(*pos_rc)
             elif event.button == 5:
                 if self.tile_size > 5:
                     self.tile_size -= 5
@@ -264,6 +810,12 @@ class Game:
                 self.font_size += 1
                 self.rescale_assets()
             
+        elif event.type == pygame.MOUSEMOTION and self.selected_token is not None:
+            # the gaps between cells keep the last cell, so the path doesn't flicker
+            pos_rc = self.x_y_to_row_col(*event.pos)
+            if pos_rc is not None and pos_rc != self.hover_cell:
+                self.hover_cell = pos_rc
+                self.invalidate(self.movement_rect())
         elif event.type == pygame.KEYDOWN and not token_window_open:
             if event.key == pygame.K_DELETE:
                 if self.selected_token is not None:
@@ -306,13 +858,30 @@ class Game:
                 self.tile_size += 5
                 self.font_size += 1
                 self.rescale_assets()
+            elif event.key == pygame.K_m:
+                self.show_minimap = not self.show_minimap
+                self.invalidate()
+            elif event.key == pygame.K_LEFTBRACKET:
+                if self.move_range > 1:
+                    self.invalidate(self.movement_rect())
+                    self.move_range -= 1
+            elif event.key == pygame.K_RIGHTBRACKET:
+                if self.move_range < MAX_STEPS:
+                    self.move_range += 1
+                    self.invalidate(self.movement_rect())
+            elif event.key == pygame.K_F3:
+                self.show_stats = not self.show_stats
+                self.invalidate(self.stats_rect)
+                self.stats_drawn = 0
         elif event.type == pygame.USEREVENT:
             if event.user_type == pygame_gui.UI_BUTTON_PRESSED:
                 if self.token_dialog is not None:
                     if event.ui_element == self.token_dialog.btnOk:
                         token_name = self.token_dialog.txtName.text
                         token_image = self.token_dialog.cmbImg.selected_option
-                        self.tokens[token_name] = {'row':1, 'col':1, 'img':token_image}
+                        if token_name in self.tokens:
+                            self.unindex_token(token_name)
+                        self.tokens[token_name] = Token(None, None, token_image)
                         self.move_token(token_name, self.token_dialog.row, self.token_dialog.col)
                         self.token_dialog.is_modal = False
                         self.token_dialog.kill()
@@ -321,38 +890,102 @@ class Game:
                     if event.ui_element == self.token_dialog.cmbImg:
                         self.token_dialog.imgToken.set_image(self.token_images[event.text])
     
+    def draw_stats(self):
+        font = self.get_font(14)
+        rows = [('phase', 'p50 ms', 'p99 ms', 'max ms')]
+        for name in ('events', 'network', 'tiles', 'movement', 'tokens', 'minimap', 'ui', 'flip', 'frame'):
+            histogram = self.metrics.histograms.get(name)
+            if histogram is not None and histogram.samples:
+                summary = histogram.summary()
+                rows += [(name, '%.2f' % summary['p50_ms'], '%.2f' % summary['p99_ms'], '%.2f' % summary['max_ms'])]
+        rows += [('fps', '%.1f' % self.clock.get_fps(), '', '')]
+        column_width = 70
+        line_height = font.get_linesize()
+        self.stats_rect = pygame.Rect(self.display.get_width() - 4*column_width - 15, 5,
+                                      4*column_width + 10, len(rows)*line_height + 10)
+        background = pygame.Surface(self.stats_rect.size)
+        background.set_alpha(200)
+        self.display.blit(background, self.stats_rect)
+        for r, row in enumerate(rows):
+            for c, text in enumerate(row):
+                label = font.render(text, True, (255, 255, 255))
+                # name column left aligned, numbers right aligned
+                x = self.stats_rect.x + 5 + c*column_width
+                if c > 0:
+                    x += column_width - label.get_width()
+                self.display.blit(label, (x, self.stats_rect.y + 5 + r*line_height))
+        self.stats_drawn = pygame.time.get_ticks()
+
     def game_loop(self):
         self.clock = pygame.time.Clock()
 
         self.closed = False
-        frame_count = 0
+        drawn = True
+        dialog_was_open = False
         
         while not self.closed:
-            frame_count += 1
+            events = []
+            if not drawn:
+                # nothing changed last frame, sleep until input or a network update arrives,
+                # map changes are pushed so there is nothing to poll
+                event = pygame.event.wait(self.stats_period if self.show_stats else 0)
+                if event.type != pygame.NOEVENT:
+                    events += [event]
             time_delta = self.clock.tick(60)/1000.0
+            timer = PhaseTimer(self.metrics)
             
-            for event in pygame.event.get():
+            for event in events + pygame.event.get():
                 self.process_event(event)
                 self.ui_manager.process_events(event)
             
             self.ui_manager.update(time_delta)
-            if frame_count >= self.refresh_period:
-                self.update_map()
-                self.update_tokens()
-                frame_count = 0
-            
-            self.display.fill(self.CLR_GREY)
-            
-            self.draw_tiles(self.display)
-            
-            self.draw_tokens()
+            timer.mark('events')
+            if self.network is not None:
+                self.process_network()
+                self.report_viewport()
+            timer.mark('network')
             
+            # the translucent overlay is only drawn over freshly drawn map, refreshed twice a second
+            if self.show_stats and (self.redraw_all or self.dirty_rects
+                                    or pygame.time.get_ticks() - self.stats_drawn > self.stats_period):
+                self.invalidate(self.stats_rect if self.stats_drawn else None)
             
-            self.ui_manager.draw_ui(self.display)
+            # the dialog is redrawn every frame while it is open, and cleared once when it closes
+            dialog_open = self.token_dialog is not None and self.token_dialog.alive()
+            if dialog_open or dialog_was_open:
+                self.invalidate()
+            dialog_was_open = dialog_open
             
+            rects = self.take_dirty_rects()
+            for rect in rects:
+                self.display.set_clip(rect)
+                self.display.fill(self.CLR_GREY)
+                
+                self.draw_tiles(self.display)
+                timer.mark('tiles')
+                
+                if self.selected_token in self.tokens:
+                    self.draw_movement(self.display)
+                timer.mark('movement')
+                
+                self.draw_tokens()
+                timer.mark('tokens')
+                
+                self.draw_minimap(self.display)
+                timer.mark('minimap')
+            self.display.set_clip(None)
             
-            pygame.display.update()
-            self.clock.tick(60)
+            if rects:
+                self.ui_manager.draw_ui(self.display)
+                if self.show_stats:
+                    self.draw_stats()
+                    rects += [self.stats_rect]
+                timer.mark('ui')
+                pygame.display.update(rects)
+                timer.mark('flip')
+                startup.finish()
+            drawn = len(rects) > 0
+            timer.finish()
 
         pygame.quit()
         quit()
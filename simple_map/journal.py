@@ -0,0 +1,137 @@
+import json
+import os
+import queue
+import threading
+
+# Append-only log of state changes plus periodic snapshots, written by a
+# background thread so callers never wait on the disk. Records are JSON
+# lines tagged with a sequence number. Everything queued when the writer
+# wakes up goes out in one write and one fsync. After a snapshot is on disk
+# the log is cut down to the records it does not cover, so recovery reads the
+# snapshot plus a short tail.
+class Journal:
+    def __init__(self, directory, snapshot_every=1000):
+        self.directory = directory
+        self.log_path = os.path.join(directory, 'journal.log')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def recover(self):
+        # returns the last snapshot (or None) and the records logged after it
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as fin:
+                snapshot = json.load(fin)
+            self.seq = snapshot['seq']
+        records = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as fin:
+                for line in fin:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last write was cut short by a crash
+                        break
+                    if record['seq'] > self.seq:
+                        records += [record]
+                        self.seq = record['seq']
+        self.records_since_snapshot = len(records)
+        return snapshot, records
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        self.seq += 1
+        self.records_since_snapshot += 1
+        self.queue.put(('record', self.seq, json.dumps(dict(record, seq=self.seq))))
+
+    def needs_snapshot(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, state, seq=None):
+        # state must not be changed afterwards, it is serialized on the writer thread.
+        # seq: the last record a state taken earlier includes, the records after it stay in the log.
+        # A snapshot older than one already written is dropped, the newer one has everything it has.
+        if seq is None:
+            seq = self.seq
+            self.records_since_snapshot = 0
+        self.queue.put(('snapshot', dict(state, seq=seq)))
+
+    def run(self):
+        log = open(self.log_path, 'a', encoding='utf-8')
+        # (seq, line) of the records written since the last snapshot
+        logged = []
+        snapshot_seq = -1
+        running = True
+        while running:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items += [self.queue.get_nowait()]
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if item is None:
+                    running = False
+                elif item[0] == 'record':
+                    lines += [item[2]]
+                    logged += [item[1:]]
+                elif item[1]['seq'] >= snapshot_seq:
+                    snapshot_seq = item[1]['seq']
+                    self.write_lines(log, lines)
+                    lines = []
+                    self.write_snapshot(item[1])
+                    # the log only keeps what the snapshot does not cover
+                    logged = [(seq, line) for seq, line in logged if seq > item[1]['seq']]
+                    log.close()
+                    self.rewrite_log([line for _, line in logged])
+                    log = open(self.log_path, 'a', encoding='utf-8')
+            self.write_lines(log, lines)
+        log.close()
+
+    @staticmethod
+    def write_lines(log, lines):
+        if lines:
+            log.write('\n'.join(lines) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+
+    def rewrite_log(self, lines):
+        # the old log stays whole until the new one is on disk, a crash in between loses nothing
+        tmp_path = self.log_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fout:
+            self.write_lines(fout, lines)
+        os.replace(tmp_path, self.log_path)
+        self.sync_directory()
+
+    def write_snapshot(self, state):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fout:
+            json.dump(state, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.sync_directory()
+
+    def sync_directory(self):
+        # makes the renames durable, Windows cannot open a directory and does not need it
+        if os.name == 'nt':
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
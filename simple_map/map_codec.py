@@ -0,0 +1,49 @@
+import array
+import hashlib
+import json
+import struct
+import sys
+import zlib
+from .tile_grid import TileGrid
+
+# Maps travel as a zlib compressed blob: a little endian uint32 header length,
+# a JSON header with the tile palette and row lengths, then one uint16 palette
+# index per cell. The SHA-1 of the blob identifies the map content.
+
+def encode_grid(grid):
+    cells = array.array('H')
+    for row in grid.region(0, 0, grid.num_rows, grid.num_cols):
+        cells.extend(row)
+    if sys.byteorder == 'big':
+        cells.byteswap()
+    header = json.dumps({'palette':grid.palette,
+                         'rows':[grid.row_len(row) for row in range(grid.num_rows)]}).encode('utf8')
+    return zlib.compress(struct.pack('<I', len(header)) + header + cells.tobytes())
+
+def decode_grid(blob):
+    data = zlib.decompress(blob)
+    header_len = struct.unpack('<I', data[:4])[0]
+    header = json.loads(data[4:4 + header_len].decode('utf8'))
+    cells = array.array('H')
+    cells.frombytes(data[4 + header_len:])
+    if sys.byteorder == 'big':
+        cells.byteswap()
+    rows = []
+    start = 0
+    for row_len in header['rows']:
+        rows += [cells[start:start + row_len]]
+        start += row_len
+    return TileGrid(header['palette'], rows)
+
+def map_hash(blob):
+    return hashlib.sha1(blob).hexdigest()
+
+# Cell deltas travel as tile name -> cell ids, a cell id being
+# row * num_cols + col, so a fill sends each tile name once.
+
+def group_cells(cells):
+    # cell id -> tile name, grouped by tile name
+    changes = {}
+    for cell, tile_name in cells.items():
+        changes.setdefault(tile_name, []).append(cell)
+    return changes
@@ -0,0 +1,112 @@
+import time
+from collections import deque
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 4, 8, 16, 33, 66, 133)
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(pct / 100.0 * len(ordered)))]
+
+# Timings of the last `window` samples of one thing. Summaries are computed
+# on demand, so recording a sample is just a deque append.
+class Histogram:
+    def __init__(self, window=600):
+        self.samples = deque(maxlen=window)
+        self.total = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.total += 1
+
+    def buckets(self):
+        counts = [0] * (len(BUCKETS_MS) + 1)
+        for seconds in self.samples:
+            ms = seconds * 1000.0
+            index = 0
+            while index < len(BUCKETS_MS) and ms > BUCKETS_MS[index]:
+                index += 1
+            counts[index] += 1
+        return counts
+
+    def summary(self):
+        if not self.samples:
+            return {'total':self.total, 'count':0}
+        ordered = sorted(self.samples)
+        return {'total':self.total,
+                'count':len(ordered),
+                'mean_ms':round(1000.0 * sum(ordered) / len(ordered), 3),
+                'p50_ms':round(1000.0 * percentile(ordered, 50), 3),
+                'p95_ms':round(1000.0 * percentile(ordered, 95), 3),
+                'p99_ms':round(1000.0 * percentile(ordered, 99), 3),
+                'max_ms':round(1000.0 * ordered[-1], 3),
+                'buckets':self.buckets()}
+
+# Named histograms and counters
+class Metrics:
+    def __init__(self, window=600):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def add(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(self.window)
+        self.histograms[name].add(seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        return {'uptime_s':round(time.time() - self.started, 1),
+                'counters':dict(self.counters),
+                'timings':{name: histogram.summary() for name, histogram in sorted(self.histograms.items())}}
+
+# Time spent in each step of starting up, from the first import of this
+# module to the first frame on screen. Time waiting for the user is skipped.
+class StartupTimer:
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.steps = []
+        self.finished = False
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.steps += [(name, now - self.last)]
+        self.last = now
+
+    def skip(self):
+        self.last = time.perf_counter()
+
+    def finish(self):
+        # called after every frame, prints the report after the first one
+        if not self.finished:
+            self.finished = True
+            self.mark('first frame')
+            print(self.report())
+
+    def report(self):
+        total = sum(seconds for name, seconds in self.steps)
+        return 'startup: %s; first frame after %.0fms' % (
+            ', '.join('%s %.0fms' % (name, 1000*seconds) for name, seconds in self.steps), 1000*total)
+
+startup = StartupTimer()
+
+# Splits one pass of a loop into phases: each mark() charges the time since
+# the previous mark to the given phase. A phase can be marked several times
+# per pass, finish() records one sample per phase plus the pass total.
+class PhaseTimer:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.phases = {}
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0) + now - self.last
+        self.last = now
+
+    def finish(self):
+        for name, seconds in self.phases.items():
+            self.metrics.add(name, seconds)
+        self.metrics.add('frame', self.last - self.started)
@@ -0,0 +1,97 @@
+import math
+from array import array
+import pygame
+
+# palette slot for the space right of rows shorter than the widest one
+PAD = 255
+
+# Overview of a whole grid, one pixel per step x step block of cells, sampled
+# from the block's top left cell. The pixels are palette ids in an 8-bit
+# surface whose palette holds the average colour of each tile, so a row of the
+# grid becomes a row of pixels without touching each cell in Python. Changed
+# cells are written into the surface one pixel at a time and only the small
+# scaled copy that gets drawn is rebuilt.
+class Minimap:
+    def __init__(self, grid, tile_colour, max_size=200, background=(200, 200, 200)):
+        # tile_colour: tile name -> the colour the tile is shown as
+        self.grid = grid
+        self.tile_colour = tile_colour
+        self.background = background
+        longest = max([grid.num_cols, grid.num_rows, 1])
+        self.step = int(math.ceil(longest / max_size))
+        self.width = max(1, -(-grid.num_cols // self.step))
+        self.height = max(1, -(-grid.num_rows // self.step))
+        # pixels per minimap pixel when drawn, small maps are drawn larger
+        self.zoom = max(1, max_size // max(self.width, self.height))
+        self.size = (self.width*self.zoom, self.height*self.zoom)
+        self.palette_size = 0
+        self.surface = None
+        self.scaled = None
+        self.build()
+
+    def slots(self, row):
+        # palette ids past the 8-bit range share the slot of the closest colour below it
+        if len(self.grid.palette) <= PAD:
+            return array('B', row).tobytes()
+        return bytes(tile_id if tile_id < PAD else self.far_slots[tile_id] for tile_id in row)
+
+    def update_palette(self):
+        palette = self.grid.palette
+        colours = [self.tile_colour(tile_name) for tile_name in palette[:PAD]]
+        colours += [self.background] * (PAD - len(colours)) + [self.background]
+        self.far_slots = {}
+        for tile_id in range(PAD, len(palette)):
+            colour = self.tile_colour(palette[tile_id])
+            self.far_slots[tile_id] = min(range(PAD), key=lambda slot: sum((a - b)**2 for a, b in zip(colour, colours[slot])))
+        self.surface.set_palette(colours)
+        self.palette_size = len(palette)
+        self.scaled = None
+
+    def sampled_rows(self):
+        # a chunked map's stored preview saves reading every block of it
+        rows = None
+        if hasattr(self.grid, 'preview'):
+            rows = self.grid.preview(self.step)
+        if rows is None:
+            rows = (self.grid.region(row, 0, 1, self.grid.num_cols)[0][::self.step]
+                    for row in range(0, self.grid.num_rows, self.step))
+        return rows
+
+    def build(self):
+        pixels = bytearray()
+        for row in self.sampled_rows():
+            cells = self.slots(row)
+            pixels += cells + bytes([PAD]) * (self.width - len(cells))
+        pixels += bytes([PAD]) * (self.width*self.height - len(pixels))
+        self.surface = pygame.image.frombytes(bytes(pixels), (self.width, self.height), 'P')
+        self.update_palette()
+
+    def set_cell(self, row, col):
+        # True if the cell is one the minimap shows
+        if row % self.step or col % self.step:
+            return False
+        if len(self.grid.palette) != self.palette_size:
+            self.update_palette()
+        pixels = pygame.PixelArray(self.surface)
+        pixels[col // self.step, row // self.step] = self.slots([self.grid.cell_id(row, col)])[0]
+        del pixels
+        self.scaled = None
+        return True
+
+    def get_surface(self):
+        if self.scaled is None:
+            self.scaled = pygame.transform.scale(self.surface, self.size)
+        return self.scaled
+
+    def cell_rect(self, first_row, first_col, last_row, last_col):
+        # area of the minimap covering the cells, relative to its top left
+        scale = self.zoom / self.step
+        x0, y0 = int(first_col*scale), int(first_row*scale)
+        x1, y1 = int(math.ceil((last_col + 1)*scale)), int(math.ceil((last_row + 1)*scale))
+        return pygame.Rect(x0, y0, max(1, x1 - x0), max(1, y1 - y0))
+
+    def cell_at(self, x, y):
+        # cell under a point relative to the top left of the minimap
+        row = y * self.step // self.zoom
+        col = x * self.step // self.zoom
+        return (min(row, self.grid.num_rows - 1), min(col, self.grid.num_cols - 1))
@@ -0,0 +1,149 @@
+from .tileset import move_sides, SIDE_BITS
+
+# How far a token can move, counted in steps of one cell in any of the eight
+# directions, diagonals counting as one step like on a battle map. A step can
+# not cross a side of a cell the tile set closes (see tileset), end on a
+# cell another token stands on, or cut the corner of a wall: a diagonal step
+# needs both ways round it open.
+# The search is a breadth-first flood over flat arrays covering just the
+# square a token can reach, so its cost depends on the range, not the map.
+# Which sides are open is read from the map in BLOCK x BLOCK blocks the first
+# time a search covers them, so a memory-mapped map is only read near tokens.
+
+N, E, S, W = SIDE_BITS['n'], SIDE_BITS['e'], SIDE_BITS['s'], SIDE_BITS['w']
+# (row step, col step) of every step, orthogonal ones first, bit i of exits() is DIRECTIONS[i]
+DIRECTIONS = [(-1, 0), (0, 1), (1, 0), (0, -1), (-1, 1), (1, 1), (1, -1), (-1, -1)]
+UNREACHED = 255
+MAX_STEPS = UNREACHED - 1
+BLOCK = 64
+
+class MoveGrid:
+    def __init__(self, grid):
+        self.grid = grid
+        self.num_rows = grid.num_rows
+        self.num_cols = grid.num_cols
+        self.patterns = {}
+        # sides of each cell that can be stepped over, nothing outside a short row or in a block not read yet
+        self.sides = bytearray(self.num_rows * self.num_cols)
+        # (block_row, block_col) of the blocks read into sides
+        self.loaded = set()
+
+    def load(self, first_row, first_col, last_row, last_col):
+        # reads the sides of the cells in the blocks overlapping the area
+        first_row, first_col = max(0, first_row), max(0, first_col)
+        last_row, last_col = min(self.num_rows - 1, last_row), min(self.num_cols - 1, last_col)
+        for block_row in range(first_row // BLOCK, last_row // BLOCK + 1):
+            for block_col in range(first_col // BLOCK, last_col // BLOCK + 1):
+                if (block_row, block_col) in self.loaded:
+                    continue
+                self.loaded.add((block_row, block_col))
+                sides = [self.pattern(tile_name) for tile_name in self.grid.palette]
+                top, left = block_row*BLOCK, block_col*BLOCK
+                for row, cells in enumerate(self.grid.region(top, left, BLOCK, BLOCK), top):
+                    start = row * self.num_cols + left
+                    self.sides[start:start + len(cells)] = bytes(sides[tile_id] for tile_id in cells)
+
+    def pattern(self, tile_name):
+        if tile_name not in self.patterns:
+            self.patterns[tile_name] = move_sides(tile_name)
+        return self.patterns[tile_name]
+
+    def set_tile(self, row, col, tile_name):
+        # a block not read yet gets the new tile from the map when it is
+        if (row // BLOCK, col // BLOCK) in self.loaded:
+            self.sides[row * self.num_cols + col] = self.pattern(tile_name)
+
+    def exits(self, cell):
+        # bits of the DIRECTIONS a token can step in from a cell id, staying on the map
+        sides, num_cols = self.sides, self.num_cols
+        row, col = divmod(cell, num_cols)
+        side = sides[cell]
+        north = row > 0 and side & N and sides[cell - num_cols] & S
+        east = col < num_cols - 1 and side & E and sides[cell + 1] & W
+        south = row < self.num_rows - 1 and side & S and sides[cell + num_cols] & N
+        west = col > 0 and side & W and sides[cell - 1] & E
+        # diagonally only when both ways round the corner are open too
+        north_east = (north and east and sides[cell - num_cols] & E and sides[cell - num_cols + 1] & W
+                      and sides[cell + 1] & N and sides[cell - num_cols + 1] & S)
+        south_east = (south and east and sides[cell + num_cols] & E and sides[cell + num_cols + 1] & W
+                      and sides[cell + 1] & S and sides[cell + num_cols + 1] & N)
+        south_west = (south and west and sides[cell + num_cols] & W and sides[cell + num_cols - 1] & E
+                      and sides[cell - 1] & S and sides[cell + num_cols - 1] & N)
+        north_west = (north and west and sides[cell - num_cols] & W and sides[cell - num_cols - 1] & E
+                      and sides[cell - 1] & N and sides[cell - num_cols - 1] & S)
+        exits = 0
+        for bit, open_ in enumerate((north, east, south, west, north_east, south_east, south_west, north_west)):
+            if open_:
+                exits |= 1 << bit
+        return exits
+
+    def reach(self, row, col, steps, occupied=frozenset()):
+        # cells a token on (row, col) can get to in up to steps steps, occupied: ids of cells it can't enter
+        steps = min(steps, MAX_STEPS)
+        size = 2*steps + 1
+        top, left = row - steps, col - steps
+        # the square and the cells next to it, which exits() looks at
+        self.load(top - 1, left - 1, row + steps + 1, col + steps + 1)
+        # steps to each cell of the square around the token and the direction it was entered from
+        distance = bytearray([UNREACHED]) * (size * size)
+        came_from = bytearray(size * size)
+        start = steps * size + steps
+        distance[start] = 0
+        num_cols = self.num_cols
+        # square and cell id offsets of each direction
+        offsets = [(row_step * size + col_step, row_step * num_cols + col_step) for row_step, col_step in DIRECTIONS]
+        frontier = [start]
+        for step in range(1, steps + 1):
+            next_frontier = []
+            for square in frontier:
+                square_row, square_col = divmod(square, size)
+                cell = (top + square_row) * num_cols + left + square_col
+                exits = self.exits(cell)
+                for direction, (square_offset, cell_offset) in enumerate(offsets):
+                    next_square = square + square_offset
+                    if not exits >> direction & 1 or distance[next_square] != UNREACHED:
+                        continue
+                    if cell + cell_offset in occupied:
+                        continue
+                    distance[next_square] = step
+                    came_from[next_square] = direction
+                    next_frontier += [next_square]
+            frontier = next_frontier
+        return Reach(top, left, size, distance, came_from)
+
+# The result of MoveGrid.reach, kept while neither the map nor any token changes.
+class Reach:
+    def __init__(self, top, left, size, distance, came_from):
+        self.top = top
+        self.left = left
+        self.size = size
+        self.distance = distance
+        self.came_from = came_from
+        self.cells = [divmod(square, size) for square, steps in enumerate(distance) if steps != UNREACHED]
+        self.cells = [(top + square_row, left + square_col) for square_row, square_col in self.cells]
+
+    def square(self, row, col):
+        square_row, square_col = row - self.top, col - self.left
+        if 0 <= square_row < self.size and 0 <= square_col < self.size:
+            return square_row * self.size + square_col
+        return None
+
+    def steps_to(self, row, col):
+        # number of steps to a cell, None when it can't be reached
+        square = self.square(row, col)
+        if square is None or self.distance[square] == UNREACHED:
+            return None
+        return self.distance[square]
+
+    def path_to(self, row, col):
+        # cells from the token's to (row, col), empty when it can't be reached
+        if self.steps_to(row, col) is None:
+            return []
+        path = [(row, col)]
+        square = self.square(row, col)
+        while self.distance[square]:
+            row_step, col_step = DIRECTIONS[self.came_from[square]]
+            row, col = row - row_step, col - col_step
+            square = self.square(row, col)
+            path += [(row, col)]
+        return path[::-1]
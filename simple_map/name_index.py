@@ -0,0 +1,37 @@
+# Finds names containing a piece of text without scanning them all. Every
+# substring of one to three characters of each name maps to the names that
+# contain it, so a search only checks names having all of the query's
+# trigrams (or shorter grams for short queries). Typing more of a filter only
+# narrows the previous result, which is searched instead when it is smaller.
+class NameIndex:
+    def __init__(self, names, gram_size=3):
+        self.names = sorted(names)
+        self.keys = [name.lower() for name in self.names]
+        self.gram_size = gram_size
+        self.grams = {}
+        for name_id, key in enumerate(self.keys):
+            for size in range(1, gram_size + 1):
+                for i in range(len(key) - size + 1):
+                    self.grams.setdefault(key[i:i + size], set()).add(name_id)
+        self.last_query = ''
+        self.last_ids = None
+
+    def candidates(self, query):
+        size = min(self.gram_size, len(query))
+        postings = sorted((self.grams.get(query[i:i + size], set()) for i in range(len(query) - size + 1)), key=len)
+        name_ids = set(postings[0])
+        for posting in postings[1:]:
+            name_ids &= posting
+        if self.last_ids is not None and self.last_query in query and len(self.last_ids) < len(name_ids):
+            name_ids = self.last_ids
+        return name_ids
+
+    def search(self, text):
+        # matching names, the ones starting with the text first, otherwise in name order
+        query = text.strip().lower()
+        if not query:
+            self.last_query, self.last_ids = '', None
+            return list(self.names)
+        name_ids = {name_id for name_id in self.candidates(query) if query in self.keys[name_id]}
+        self.last_query, self.last_ids = query, name_ids
+        return [self.names[name_id] for name_id in sorted(name_ids, key=lambda name_id: (not self.keys[name_id].startswith(query), name_id))]
@@ -0,0 +1,145 @@
+import asyncio
+import concurrent.futures
+import json
+import queue
+import socket
+import threading
+from .protocol import encode_message, read_message
+
+# Owns the server connection and runs it on a background asyncio thread.
+# Responses and pushed token updates are handed to the render thread as
+# (kind, tag, data) tuples through a queue that poll() drains without blocking.
+class NetworkClient:
+    def __init__(self, server_hostname, server_port, room=None, notify=None):
+        self.updates = queue.Queue()
+        # called from the network thread when updates arrive while the queue was drained
+        self.notify = notify
+        self.notified = threading.Event()
+        # connect up front so an unreachable server still fails at startup
+        self.sock = socket.create_connection((server_hostname, server_port))
+        self.room = room
+        self.loop = asyncio.new_event_loop()
+        self.next_id = 0
+        # request id -> tags of the requests it carries, a batch carries several
+        self.pending = {}
+        self.outbox = []
+        self.outbox_lock = threading.Lock()
+        self.started = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+        self.started.set()
+        self.loop.run_forever()
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(sock=self.sock)
+        if self.room is not None:
+            # sent before anything else so every later request goes to the room
+            self.write_requests([({'op':'join', 'arg':self.room}, 'join')])
+        self.receiver = self.loop.create_task(self.process_messages())
+
+    async def process_messages(self):
+        try:
+            while True:
+                message = json.loads(await read_message(self.reader))
+                if 'id' in message:
+                    tags = self.pending.pop(message['id'])
+                    if len(tags) == 1:
+                        self.updates.put(('response', tags[0], message['resp']))
+                    else:
+                        for tag, response in zip(tags, json.loads(message['resp'])):
+                            self.updates.put(('response', tag, response))
+                elif message.get('type') == 'tokens':
+                    self.updates.put(('tokens', None, message))
+                elif message.get('type') == 'cells':
+                    self.updates.put(('cells', None, message))
+                elif message.get('type') == 'fog':
+                    self.updates.put(('fog', None, message))
+                elif message.get('type') == 'positions':
+                    self.updates.put(('positions', None, message))
+                elif message.get('type') == 'map':
+                    self.updates.put(('map', None, message))
+                self.wake()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            self.updates.put(('disconnected', None, None))
+            self.wake()
+
+    def wake(self):
+        # after the updates are queued, so a poll() that cleared notified before this still sees them
+        if self.notify is not None and not self.notified.is_set():
+            self.notified.set()
+            self.notify()
+
+    def write_requests(self, outbox):
+        self.next_id += 1
+        self.pending[self.next_id] = [tag for _, tag in outbox]
+        if len(outbox) == 1:
+            message = dict(outbox[0][0], id=self.next_id)
+        else:
+            message = {'op':'batch', 'arg':'requests', 'id':self.next_id, 'data':[request for request, _ in outbox]}
+        self.writer.write(encode_message(json.dumps(message)))
+
+    def send_request(self, request, tag=None):
+        with self.outbox_lock:
+            self.outbox.append((request, tag))
+
+    def flush(self):
+        # everything sent since the last flush goes out as one request or batch
+        with self.outbox_lock:
+            outbox, self.outbox = self.outbox, []
+        if outbox:
+            self.loop.call_soon_threadsafe(self.write_requests, outbox)
+
+    def subscribe(self, since):
+        message = encode_message(json.dumps({'op':'subscribe', 'arg':'tokens', 'data':since}))
+        self.loop.call_soon_threadsafe(self.writer.write, message)
+
+    def set_viewport(self, viewport):
+        # (first_row, first_col, last_row, last_col) of the cells on screen, no response
+        message = encode_message(json.dumps({'op':'viewport', 'data':list(viewport)}))
+        self.loop.call_soon_threadsafe(self.writer.write, message)
+
+    def set_player(self, player):
+        # names of the client's own tokens, no response
+        message = encode_message(json.dumps({'op':'player', 'data':list(player)}))
+        self.loop.call_soon_threadsafe(self.writer.write, message)
+
+    def poll(self):
+        self.notified.clear()
+        while True:
+            try:
+                yield self.updates.get_nowait()
+            except queue.Empty:
+                return
+
+    async def shutdown(self):
+        self.receiver.cancel()
+        try:
+            await self.receiver
+        except asyncio.CancelledError:
+            pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    def close(self):
+        # the receiver and the connection are finished on the loop thread before it stops, closing twice does nothing
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(1)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            print('Timed out closing the server connection')
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1)
+        if not self.thread.is_alive():
+            self.loop.close()
+        self.sock.close()
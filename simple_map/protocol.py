@@ -0,0 +1,24 @@
+# Every message in either direction is an 8 digit ASCII length followed by
+# that many bytes of UTF-8 text.
+HEADER_LEN = 8
+
+def encode_message(message):
+    data = message.encode('utf8')
+    return (u'%08d' % len(data)).encode('utf8') + data
+
+async def read_message(reader):
+    msg_len = int((await reader.readexactly(HEADER_LEN)).decode())
+    return (await reader.readexactly(msg_len)).decode('utf8')
+
+def recv_exactly(sock, num_bytes):
+    data = b''
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed by server')
+        data += chunk
+    return data
+
+def recv_message(sock):
+    msg_len = int(recv_exactly(sock, HEADER_LEN).decode())
+    return recv_exactly(sock, msg_len).decode('utf8')
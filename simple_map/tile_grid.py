@@ -0,0 +1,95 @@
+import array
+import csv
+
+# A map stored as one array('H') of palette indices per row, plus the palette
+# of tile names those indices refer to.
+class TileGrid:
+    def __init__(self, palette=None, rows=None):
+        self.palette = list(palette) if palette is not None else []
+        self.tile_ids = {tile_name: tile_id for tile_id, tile_name in enumerate(self.palette)}
+        self.rows = rows if rows is not None else []
+
+    @classmethod
+    def from_names(cls, name_rows):
+        grid = cls()
+        for name_row in name_rows:
+            grid.rows += [array.array('H', [grid.tile_id(tile_name) for tile_name in name_row])]
+        return grid
+
+    @classmethod
+    def blank(cls, num_rows, num_cols, tile_name):
+        grid = cls([tile_name])
+        grid.rows = [array.array('H', [0]) * num_cols for _ in range(num_rows)]
+        return grid
+
+    @classmethod
+    def read_csv(cls, path):
+        with open(path, 'r') as fin:
+            return cls.from_names(csv.reader(fin))
+
+    def save_csv(self, path):
+        with open(path, 'w', newline='\n', encoding='utf-8') as fout:
+            writer = csv.writer(fout)
+            for row in self.rows:
+                writer.writerow(map(self.palette.__getitem__, row))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def num_rows(self):
+        return len(self.rows)
+
+    @property
+    def num_cols(self):
+        return max((len(row) for row in self.rows), default=0)
+
+    def row_len(self, row):
+        return len(self.rows[row])
+
+    def tile_id(self, tile_name):
+        # palette index for tile_name, adding it to the palette if needed
+        tile_id = self.tile_ids.get(tile_name)
+        if tile_id is None:
+            tile_id = len(self.palette)
+            self.palette += [tile_name]
+            self.tile_ids[tile_name] = tile_id
+        return tile_id
+
+    def cell_id(self, row, col):
+        return self.rows[row][col]
+
+    def get(self, row, col):
+        return self.palette[self.rows[row][col]]
+
+    def set(self, row, col, tile_name):
+        self.rows[row][col] = self.tile_id(tile_name)
+
+    def region(self, first_row, first_col, num_rows, num_cols):
+        return [row[first_col:first_col + num_cols] for row in self.rows[first_row:first_row + num_rows]]
+
+    def copy(self):
+        return TileGrid(self.palette, [array.array('H', row) for row in self.rows])
+
+    def to_names(self):
+        return [[self.palette[tile_id] for tile_id in row] for row in self.rows]
+
+    def count(self, tile_name):
+        tile_id = self.tile_ids.get(tile_name)
+        if tile_id is None:
+            return 0
+        return sum(row.count(tile_id) for row in self.rows)
+
+    def replace(self, old_name, new_name):
+        old_id = self.tile_ids.get(old_name)
+        if old_id is None or old_name == new_name:
+            return
+        if new_name not in self.tile_ids:
+            # only the palette entry has to change
+            self.palette[old_id] = new_name
+            del self.tile_ids[old_name]
+            self.tile_ids[new_name] = old_id
+            return
+        remap = list(range(len(self.palette)))
+        remap[old_id] = self.tile_ids[new_name]
+        self.rows = [array.array('H', map(remap.__getitem__, row)) for row in self.rows]
@@ -0,0 +1,61 @@
+# What the tile names of the tile set say about a cell beyond its picture.
+# Walls, doors and alcoves are drawn along the edges of a cell, so a cell is
+# split 3 x 3 and each part is marked as blocking sight or not: bw_wall_n
+# blocks the top three parts and leaves the rest of the cell open. Stairs and
+# floor tiles are see-through, windows are marked but let sight through.
+# Movement reads the same names differently: doors can be walked through,
+# windows and the bars of a counter can not.
+
+# parts of the 3 x 3 split, row major, along each side
+SIDES = {'n':(0, 1, 2), 'e':(2, 5, 8), 's':(6, 7, 8), 'w':(0, 3, 6)}
+DIAGONALS = {('ne', 'sw'):(2, 4, 6), ('nw', 'se'):(0, 4, 8)}
+# sides an alcove open to one side is walled on
+ALCOVE_WALLS = {'n':'new', 'e':'nes', 's':'esw', 'w':'nsw'}
+SOLID_TILES = {'black'}
+# bits of the sides of a cell a token can leave it by
+SIDE_BITS = {'n':1, 'e':2, 's':4, 'w':8}
+ALL_SIDES = 15
+OPEN = 0
+BLOCKED = 1
+WINDOW = 2
+
+def sight_blocks(tile_name):
+    # 9 bytes, BLOCKED for each part of the cell that blocks sight, WINDOW for the parts of windows
+    parts = tile_name.split('_')
+    if tile_name in SOLID_TILES or 'column' in parts:
+        return bytes([BLOCKED] * 9)
+    blocked = set()
+    windows = set()
+    for i, part in enumerate(parts):
+        following = parts[i + 1:i + 3]
+        if part in ('wall', 'diagonal') and tuple(following) in DIAGONALS:
+            blocked.update(DIAGONALS[tuple(following)])
+        elif part in ('wall', 'door') and following:
+            for side in following[0]:
+                blocked.update(SIDES.get(side, ()))
+        elif part == 'alcove' and following:
+            for side in ALCOVE_WALLS.get(following[0], ''):
+                blocked.update(SIDES[side])
+        elif part == 'window' and following:
+            for side in following[0]:
+                windows.update(SIDES.get(side, ()))
+    return bytes(BLOCKED if part in blocked else WINDOW if part in windows else OPEN for part in range(9))
+
+def move_sides(tile_name):
+    # SIDE_BITS of the sides a token can step over, 0 for cells nothing can stand on
+    parts = tile_name.split('_')
+    if tile_name in SOLID_TILES or 'column' in parts:
+        return 0
+    sides = ALL_SIDES
+    for i, part in enumerate(parts):
+        following = parts[i + 1:i + 3]
+        if part in ('wall', 'diagonal') and tuple(following) in DIAGONALS:
+            # split in two along the diagonal
+            return 0
+        elif part in ('wall', 'window', 'bar') and following:
+            for side in following[0]:
+                sides &= ~SIDE_BITS.get(side, 0)
+        elif part == 'alcove' and following:
+            for side in ALCOVE_WALLS.get(following[0], ''):
+                sides &= ~SIDE_BITS[side]
+    return sides
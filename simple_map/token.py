@@ -0,0 +1,40 @@
+import re
+
+def image_scale(img):
+    # images named *_2x ... *_9x cover that many cells each way
+    if re.match('_[2-9]x', img[-3:]) is not None:
+        return int(img[-2])
+    return 1
+
+# A token as received from the server, with its image scale parsed once.
+# Tokens are not changed in place, moving one creates a new Token.
+class Token:
+    __slots__ = ('row', 'col', 'img', 'scale')
+
+    def __init__(self, row, col, img):
+        self.row = row
+        self.col = col
+        self.img = img
+        self.scale = image_scale(img)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['row'], data['col'], data['img'])
+
+    def to_dict(self):
+        return {'row':self.row, 'col':self.col, 'img':self.img}
+
+    def moved(self, row, col):
+        return Token(row, col, self.img)
+
+    @property
+    def on_map(self):
+        return self.row is not None and self.col is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, Token):
+            return NotImplemented
+        return (self.row, self.col, self.img) == (other.row, other.col, other.img)
+
+    def __repr__(self):
+        return 'Token(%r, %r, %r)' % (self.row, self.col, self.img)
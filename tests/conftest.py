@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import pytest
+from simple_map.protocol import encode_message, recv_message
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# A map_server.py process with its own maps/ and state directory under tmp_path.
+class Server:
+    def __init__(self, directory, mapfile='tavern.csv'):
+        self.directory = directory
+        self.port = free_port()
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'map_server.py'), mapfile,
+                                         '--host', '127.0.0.1', '--port', str(self.port),
+                                         '--state-dir', str(directory / 'state')],
+                                        cwd=str(directory), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        # output printed before it is stopped is kept
+                                        env=dict(os.environ, PYTHONUNBUFFERED='1'))
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.connect().close()
+                return
+            except ConnectionError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError('server did not start: %s' % self.output)
+                time.sleep(0.05)
+
+    def connect(self):
+        # a connection the server dropped fails the test instead of hanging it
+        return socket.create_connection(('127.0.0.1', self.port), timeout=5)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.output = self.process.communicate()[0].decode('utf-8', 'replace')
+
+def request(con, req):
+    con.sendall(encode_message(json.dumps(req)))
+    return recv_message(con)
+
+@pytest.fixture
+def map_dir(tmp_path):
+    os.makedirs(str(tmp_path / 'maps'))
+    for mapfile in ('tavern.csv', 'farm.csv', 'huge_field.csv'):
+        shutil.copy(os.path.join(ROOT, 'maps', mapfile), str(tmp_path / 'maps'))
+    return tmp_path
+
+@pytest.fixture
+def server(map_dir):
+    server = Server(map_dir)
+    yield server
+    server.stop()
+
+@pytest.fixture
+def client_dir(map_dir, monkeypatch):
+    # what a client needs in its working directory, with pygame's own font standing in for arial
+    import pygame
+    os.symlink(os.path.join(ROOT, 'tiles'), str(map_dir / 'tiles'))
+    os.symlink(os.path.join(ROOT, 'tokens'), str(map_dir / 'tokens'))
+    shutil.copy(os.path.join(os.path.dirname(pygame.__file__), pygame.font.get_default_font()), str(map_dir / 'arial.ttf'))
+    monkeypatch.setenv('SDL_VIDEODRIVER', 'dummy')
+    monkeypatch.setenv('SDL_AUDIODRIVER', 'dummy')
+    monkeypatch.chdir(str(map_dir))
+    return map_dir
@@ -0,0 +1,64 @@
+import random
+import pytest
+from simple_map.chunked_map import ChunkedGrid, save_map, write_chunked
+from simple_map.minimap import Minimap
+from simple_map.movement import MoveGrid
+from simple_map.tile_grid import TileGrid
+
+def random_grid(num_rows, num_cols, seed=1):
+    rng = random.Random(seed)
+    # short rows at the bottom, like a hand edited CSV
+    return TileGrid.from_names([[rng.choice(['grass', 'stone', 'water']) for _ in range(num_cols - row // 50)]
+                                for row in range(num_rows)])
+
+def sampled(grid, step):
+    return [list(grid.region(row, 0, 1, grid.num_cols)[0][::step]) for row in range(0, grid.num_rows, step)]
+
+@pytest.fixture
+def smap(tmp_path):
+    grid = random_grid(300, 250)
+    path = str(tmp_path / 'map.smap')
+    write_chunked(grid, path, chunk_size=16)
+    chunked = ChunkedGrid(path)
+    yield grid, chunked
+    chunked.close()
+
+def test_smap_round_trip(smap):
+    grid, chunked = smap
+    assert chunked.to_names() == grid.to_names()
+    assert [chunked.row_len(row) for row in range(300)] == [grid.row_len(row) for row in range(300)]
+
+def test_preview_matches_the_cells(smap):
+    grid, chunked = smap
+    assert chunked.preview_step == 2
+    for step in (2, 4, 6):
+        assert [list(row) for row in chunked.preview(step)] == sampled(grid, step)
+    assert chunked.preview(3) is None
+
+def test_save_in_place_updates_preview(smap):
+    grid, chunked = smap
+    for row, col in ((0, 0), (10, 20), (298, 100)):
+        chunked.set(row, col, 'lava')
+        grid.set(row, col, 'lava')
+    assert [list(row) for row in chunked.preview(2)] == sampled(grid, 2)
+    save_map(chunked, chunked.path)
+    reloaded = ChunkedGrid(chunked.path)
+    assert reloaded.to_names() == grid.to_names()
+    assert [list(row) for row in reloaded.preview(2)] == sampled(grid, 2)
+    reloaded.close()
+
+def test_minimap_reads_no_blocks(smap, monkeypatch):
+    grid, chunked = smap
+    def read_cells(*args):
+        raise AssertionError('block read')
+    monkeypatch.setattr(chunked, 'read_cells', read_cells)
+    monkeypatch.setattr(chunked, 'cells', None)
+    minimap = Minimap(chunked, lambda tile_name: (0, 0, 0))
+    assert minimap.step == 2
+
+def test_movement_reads_only_nearby_blocks():
+    grid = TileGrid.blank(1000, 1000, 'grass')
+    move_grid = MoveGrid(grid)
+    reach = move_grid.reach(500, 500, 6)
+    assert reach.steps_to(506, 494) == 6
+    assert move_grid.loaded == {(7, 7)}
@@ -0,0 +1,56 @@
+import time
+import pygame
+from simple_map import Game
+from simple_map.tile_grid import TileGrid
+from simple_map.token import Token
+from conftest import Server, request
+
+def wait_for(game, condition):
+    deadline = time.time() + 10
+    while not condition() and time.time() < deadline:
+        game.process_network()
+        time.sleep(0.02)
+    return condition()
+
+def test_idle_client_waits_for_map_push(client_dir, monkeypatch):
+    server = Server(client_dir)
+    game = None
+    try:
+        game = Game(server_hostname='127.0.0.1', server_port=server.port, display_width=800, display_height=600,
+                    map_margin=10, tile_padding=1, tile_size=64, font_size=18)
+        assert wait_for(game, lambda: game.mapfile == 'tavern.csv')
+        sent = []
+        monkeypatch.setattr(game.network, 'send_request', lambda request, tag=None: sent.append(tag))
+        pygame.event.get()
+        for _ in range(20):
+            game.process_network()
+            time.sleep(0.02)
+        # nothing is polled while the map stays the same
+        assert sent == []
+        monkeypatch.undo()
+        con = server.connect()
+        assert request(con, {'op':'admin', 'arg':'set_map', 'data':'farm.csv'}) == 'ack'
+        # the push wakes a client blocked waiting for events
+        assert pygame.event.wait(5000).type == game.NETWORK_EVENT
+        assert wait_for(game, lambda: game.mapfile == 'farm.csv')
+        con.close()
+    finally:
+        if game is not None:
+            game.network.close()
+        server.stop()
+
+def test_token_leaving_view_is_deselected(client_dir):
+    game = Game(server_hostname=None, server_port=None, display_width=800, display_height=600,
+                map_margin=10, tile_padding=1, tile_size=64, font_size=18)
+    game.game_grid = TileGrid.blank(20, 20, 'grass')
+    game.set_tokens({'orc':Token(2, 2, 'black_circle')})
+    game.selected_token = 'orc'
+    # a pan took the token out of the area the server sends
+    game.apply_token_delta({'base':None, 'version':1, 'tokens':{}, 'removed':[]})
+    assert game.selected_token is None
+    x, y = game.row_col_to_x_y(3, 3)
+    game.process_event(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=(x + 5, y + 5)))
+    game.process_event(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_DELETE, mod=0, unicode=''))
+    assert game.tokens == {}
+    game.move_token('orc', 3, 3)
+    assert game.tokens == {}
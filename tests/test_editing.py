@@ -0,0 +1,53 @@
+import threading
+from simple_map import editing
+from simple_map.editing import MapEditor
+from simple_map.tile_grid import TileGrid
+
+def make_editor(tmp_path, **kw):
+    grid = TileGrid.blank(4, 4, 'grass')
+    path = str(tmp_path / 'map.csv')
+    editor = MapEditor(grid, grid.set, str(tmp_path / 'autosave'), path=path, **kw)
+    return editor, path
+
+def test_failed_save_keeps_autosave(tmp_path, monkeypatch):
+    editor, path = make_editor(tmp_path)
+    editor.apply([(1, 1), (2, 2)], 'stone')
+    def fail(grid, path):
+        raise OSError('disk full')
+    monkeypatch.setattr(editing, 'save_map', fail)
+    editor.save(path).result()
+    editor.close()
+    grid = MapEditor.recover(str(tmp_path / 'autosave'))
+    assert grid is not None
+    assert grid.get(1, 1) == 'stone' and grid.get(2, 2) == 'stone'
+
+def test_save_marks_autosave_saved(tmp_path):
+    editor, path = make_editor(tmp_path)
+    editor.apply([(1, 1)], 'stone')
+    editor.save(path).result()
+    editor.close()
+    assert MapEditor.recover(str(tmp_path / 'autosave')) is None
+
+def test_save_elsewhere_keeps_autosave(tmp_path):
+    editor, path = make_editor(tmp_path)
+    editor.apply([(1, 1)], 'stone')
+    editor.save(str(tmp_path / 'map.smap')).result()
+    editor.close()
+    assert MapEditor.recover(str(tmp_path / 'autosave')).get(1, 1) == 'stone'
+
+def test_edits_during_save_are_kept(tmp_path, monkeypatch):
+    editor, path = make_editor(tmp_path)
+    editor.apply([(1, 1)], 'stone')
+    release = threading.Event()
+    save_map = editing.save_map
+    def slow_save(grid, path):
+        release.wait()
+        save_map(grid, path)
+    monkeypatch.setattr(editing, 'save_map', slow_save)
+    future = editor.save(path)
+    editor.apply([(3, 3)], 'water')
+    release.set()
+    future.result()
+    editor.close()
+    grid = MapEditor.recover(str(tmp_path / 'autosave'))
+    assert grid.get(1, 1) == 'stone' and grid.get(3, 3) == 'water'
@@ -0,0 +1,24 @@
+import os
+import pygame
+import pytest
+from simple_map.export import export_map
+from simple_map.tile_grid import TileGrid
+
+from conftest import ROOT
+
+def test_export_without_tokens_needs_no_font(tmp_path):
+    grid = TileGrid.blank(3, 5, 'grass')
+    path = str(tmp_path / 'map.png')
+    size = export_map(grid, path, tile_size=8, tile_dir=os.path.join(ROOT, 'tiles'), workers=0,
+                      font_path=str(tmp_path / 'missing.ttf'))
+    assert size == (5*9 - 1, 3*9 - 1)
+    assert pygame.image.load(path).get_size() == size
+    assert os.listdir(str(tmp_path)) == ['map.png']
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_failed_export_leaves_no_file(tmp_path, workers):
+    grid = TileGrid.blank(3, 5, 'grass')
+    path = str(tmp_path / 'map.png')
+    with pytest.raises(Exception):
+        export_map(grid, path, tile_size=8, tile_dir=str(tmp_path / 'missing'), workers=workers)
+    assert os.listdir(str(tmp_path)) == []
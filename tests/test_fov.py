@@ -0,0 +1,46 @@
+from simple_map.fov import OpacityGrid, cell_runs, run_cells
+from simple_map.tile_grid import TileGrid
+
+def grid_with(tiles, size=11):
+    grid = TileGrid.blank(size, size, 'grass')
+    for (row, col), tile_name in tiles.items():
+        grid.set(row, col, tile_name)
+    return grid
+
+def seen(grid, row, col, radius=5):
+    cells = OpacityGrid(grid).field_of_view(row, col, radius)
+    return {divmod(cell, grid.num_cols) for cell in cells}
+
+def test_open_ground_is_seen_up_to_the_radius():
+    cells = seen(grid_with({}), 5, 5, radius=3)
+    assert {(5, 5), (5, 8), (2, 5), (7, 7)} <= cells
+    assert (5, 9) not in cells and (0, 0) not in cells
+
+def test_solid_cells_cast_shadows():
+    grid = grid_with({(row, 7): 'black' for row in range(11)})
+    cells = seen(grid, 5, 5)
+    # the wall itself is seen, nothing behind it
+    assert (5, 7) in cells
+    assert not any(col > 7 for _, col in cells)
+
+def test_walls_along_an_edge_block_only_that_side():
+    cells = seen(grid_with({(5, 6): 'bw_wall_e'}), 5, 5)
+    assert (5, 6) in cells
+    assert (5, 8) not in cells
+    assert (3, 8) in cells and (5, 0) in cells
+
+def test_windows_let_sight_through():
+    cells = seen(grid_with({(5, 6): 'bw_window_e'}), 5, 5)
+    assert (5, 8) in cells
+
+def test_set_tile_updates_sight():
+    grid = grid_with({})
+    opacity = OpacityGrid(grid)
+    opacity.set_tile(5, 6, 'black')
+    cells = {divmod(cell, 11) for cell in opacity.field_of_view(5, 5, 5)}
+    assert (5, 6) in cells and (5, 8) not in cells
+
+def test_cell_runs_round_trip():
+    cells = {0, 1, 2, 5, 7, 8, 20}
+    assert cell_runs(cells) == [0, 3, 5, 1, 7, 2, 20, 1]
+    assert run_cells(cell_runs(cells)) == cells
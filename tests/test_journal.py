@@ -0,0 +1,59 @@
+import json
+import os
+import pytest
+from simple_map import journal
+from simple_map.journal import Journal
+
+def log_seqs(directory):
+    with open(os.path.join(directory, 'journal.log'), encoding='utf-8') as fin:
+        return [json.loads(line)['seq'] for line in fin]
+
+def test_snapshot_cuts_the_log(tmp_path):
+    directory = str(tmp_path / 'journal')
+    log = Journal(directory)
+    log.start()
+    for n in range(5):
+        log.append({'n':n})
+    log.snapshot({'state':3}, seq=3)
+    log.append({'n':5})
+    log.close()
+    assert log_seqs(directory) == [4, 5, 6]
+    assert sorted(os.listdir(directory)) == ['journal.log', 'snapshot.json']
+    snapshot, records = Journal(directory).recover()
+    assert snapshot['seq'] == 3
+    assert [record['n'] for record in records] == [3, 4, 5]
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_failed_log_rewrite_keeps_the_log(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'journal')
+    replace = os.replace
+    def crash(src, dst):
+        if dst.endswith('journal.log'):
+            raise OSError('crashed')
+        replace(src, dst)
+    monkeypatch.setattr(journal.os, 'replace', crash)
+    log = Journal(directory)
+    log.start()
+    for n in range(5):
+        log.append({'n':n})
+    log.snapshot({'state':3}, seq=3)
+    log.close()
+    # the writer stopped before the new log replaced the old one, which still has every record
+    assert log_seqs(directory) == [1, 2, 3, 4, 5]
+    snapshot, records = Journal(directory).recover()
+    assert snapshot['seq'] == 3
+    assert [record['n'] for record in records] == [3, 4]
+
+def test_older_snapshot_is_dropped(tmp_path):
+    directory = str(tmp_path / 'journal')
+    log = Journal(directory)
+    log.start()
+    for n in range(5):
+        log.append({'n':n})
+    # a save that started at seq 3 finishes after an autosave of everything
+    log.snapshot({'state':5})
+    log.snapshot({'state':3}, seq=3)
+    log.close()
+    snapshot, records = Journal(directory).recover()
+    assert snapshot == {'state':5, 'seq':5}
+    assert records == []
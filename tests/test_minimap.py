@@ -0,0 +1,33 @@
+import time
+from simple_map import Game
+from conftest import Server, request
+
+def test_minimap_shows_tokens_outside_viewport(client_dir):
+    server = Server(client_dir, 'huge_field.csv')
+    game = None
+    try:
+        con = server.connect()
+        assert request(con, {'op':'set', 'arg':'place_token',
+                             'data':{'name':'far', 'row':110, 'col':110, 'img':'black_circle'}}) == 'ack'
+        game = Game(server_hostname='127.0.0.1', server_port=server.port, display_width=800, display_height=600,
+                    map_margin=10, tile_padding=1, tile_size=64, font_size=18)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            game.process_network()
+            if game.game_grid:
+                game.report_viewport()
+            if 'far' not in game.tokens and game.token_positions:
+                break
+            time.sleep(0.02)
+        # the server only sends the tokens near the viewport, the minimap still shows the far one
+        assert 'far' not in game.tokens
+        assert game.token_positions == [(110, 110, 1)]
+        game.display.fill(game.CLR_GREY)
+        game.draw_minimap(game.display)
+        rect = game.get_minimap().cell_rect(110, 110, 110, 110).move(game.minimap_rect.topleft)
+        assert tuple(game.display.get_at(rect.center))[:3] == (255, 0, 0)
+        con.close()
+    finally:
+        if game is not None:
+            game.network.close()
+        server.stop()
@@ -0,0 +1,38 @@
+from simple_map.movement import MoveGrid
+from simple_map.tile_grid import TileGrid
+
+def grid_with(tiles, size=11):
+    grid = TileGrid.blank(size, size, 'grass')
+    for (row, col), tile_name in tiles.items():
+        grid.set(row, col, tile_name)
+    return grid
+
+def test_diagonal_steps_count_as_one():
+    reach = MoveGrid(grid_with({})).reach(5, 5, 2)
+    assert reach.steps_to(7, 7) == 2
+    assert reach.steps_to(5, 7) == 2
+    assert reach.steps_to(5, 8) is None
+    assert len(reach.cells) == 25
+
+def test_solid_cells_block_movement():
+    reach = MoveGrid(grid_with({(row, 7): 'black' for row in range(11)})).reach(5, 5, 6)
+    assert reach.steps_to(5, 7) is None
+    assert not any(col > 7 for _, col in reach.cells)
+
+def test_walls_block_their_side_and_the_corners():
+    reach = MoveGrid(grid_with({(5, 5): 'bw_wall_e'})).reach(5, 5, 3)
+    # not east through the wall, nor diagonally past its end, but round it
+    assert reach.steps_to(5, 6) == 3
+    assert reach.path_to(5, 6) == [(5, 5), (4, 5), (4, 6), (5, 6)]
+    assert reach.steps_to(5, 4) == 1
+
+def test_occupied_cells_are_not_entered():
+    reach = MoveGrid(grid_with({})).reach(5, 5, 2, occupied={5*11 + 6})
+    assert reach.steps_to(5, 6) is None
+    assert reach.steps_to(5, 7) == 2
+
+def test_set_tile_updates_movement():
+    move_grid = MoveGrid(grid_with({}))
+    assert move_grid.reach(5, 5, 1).steps_to(5, 6) == 1
+    move_grid.set_tile(5, 6, 'black')
+    assert move_grid.reach(5, 5, 1).steps_to(5, 6) is None
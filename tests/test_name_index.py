@@ -0,0 +1,24 @@
+from simple_map.name_index import NameIndex
+
+NAMES = ['bw_wall_n', 'bw_wall_ne', 'bw_door_n', 'grass', 'Stone_Wall', 'water']
+
+def test_search_finds_substrings_prefixes_first():
+    index = NameIndex(NAMES)
+    assert index.search('wall') == ['Stone_Wall', 'bw_wall_n', 'bw_wall_ne']
+    assert index.search('st') == ['Stone_Wall']
+    assert index.search('w')[:1] == ['water']
+
+def test_search_is_case_insensitive_and_exact():
+    index = NameIndex(NAMES)
+    assert index.search(' STONE ') == ['Stone_Wall']
+    # every trigram of the query occurs in grass, but not the query
+    assert index.search('grassgrass') == []
+    assert index.search('zz') == []
+
+def test_narrowing_and_widening_the_filter():
+    index = NameIndex(NAMES)
+    assert index.search('wa') == ['water', 'Stone_Wall', 'bw_wall_n', 'bw_wall_ne']
+    assert index.search('wal') == ['Stone_Wall', 'bw_wall_n', 'bw_wall_ne']
+    assert index.search('wall_n') == ['bw_wall_n', 'bw_wall_ne']
+    assert index.search('a') == ['Stone_Wall', 'bw_wall_n', 'bw_wall_ne', 'grass', 'water']
+    assert index.search('') == sorted(NAMES)
@@ -0,0 +1,203 @@
+import json
+import os
+import time
+import pytest
+from simple_map.protocol import encode_message, recv_message
+from conftest import Server, request
+
+@pytest.mark.parametrize('req', [
+    {'op':'set', 'arg':'place_token', 'data':{'row':1, 'col':1, 'img':'a'}},
+    {'op':'set', 'arg':'place_token', 'data':{'name':'orc', 'col':1, 'img':'a'}},
+    {'op':'set', 'arg':'place_token', 'data':{'name':'orc', 'row':'x', 'col':1, 'img':'a'}},
+    {'op':'set', 'arg':'place_token', 'data':None},
+    {'op':'set', 'arg':'place_token', 'data':{'name':'orc', 'row':1000, 'col':1, 'img':'a'}},
+    {'op':'set', 'arg':'place_token', 'data':{'name':'orc', 'row':1, 'col':1000, 'img':'a'}},
+    {'op':'set', 'arg':'place_token', 'data':{'name':'orc', 'row':True, 'col':1, 'img':'a'}},
+    {'op':'admin', 'arg':'load_encounter', 'data':{'tokens':{'orc':{'row':1000, 'col':1, 'img':'a'}}}},
+    {'op':'batch', 'arg':'requests', 'data':5},
+    {'op':'admin', 'arg':'set_map', 'data':None},
+])
+def test_malformed_request_answers_err(server, req):
+    con = server.connect()
+    assert request(con, req) == 'err'
+    # the connection is still served
+    assert json.loads(request(con, {'op':'get', 'arg':'map'})) == 'tavern.csv'
+    con.close()
+
+def test_connection_cleaned_up(server):
+    con = server.connect()
+    con.sendall(encode_message(json.dumps({'op':'subscribe', 'arg':'tokens', 'data':'x'})))
+    assert json.loads(recv_message(con))['type'] == 'tokens'
+    con.sendall(encode_message(json.dumps([1, 2])))
+    con.close()
+    stats_con = server.connect()
+    time.sleep(0.2)
+    stats = json.loads(request(stats_con, {'op':'admin', 'arg':'stats'}))
+    assert stats['counters']['clients'] == 1
+    stats_con.close()
+
+def test_place_and_remove_token(server):
+    con = server.connect()
+    assert request(con, {'op':'set', 'arg':'place_token',
+                         'data':{'name':'orc', 'row':1, 'col':2, 'img':'black_circle'}}) == 'ack'
+    assert json.loads(request(con, {'op':'get', 'arg':'tokens'})) == {'orc':{'row':1, 'col':2, 'img':'black_circle'}}
+    assert request(con, {'op':'set', 'arg':'place_token',
+                         'data':{'name':'orc', 'row':None, 'col':None, 'img':'black_circle'}}) == 'ack'
+    assert json.loads(request(con, {'op':'get', 'arg':'tokens'})) == {}
+    con.close()
+
+def test_recovers_without_journaled_map(map_dir):
+    server = Server(map_dir)
+    con = server.connect()
+    assert request(con, {'op':'admin', 'arg':'set_map', 'data':'farm.csv'}) == 'ack'
+    assert request(con, {'op':'set', 'arg':'place_token',
+                         'data':{'name':'orc', 'row':1, 'col':2, 'img':'black_circle'}}) == 'ack'
+    con.close()
+    # the journal writer has the records on disk well before this
+    time.sleep(0.3)
+    server.stop()
+    os.remove(str(map_dir / 'maps' / 'farm.csv'))
+    server = Server(map_dir)
+    try:
+        con = server.connect()
+        assert json.loads(request(con, {'op':'get', 'arg':'map'})) == 'tavern.csv'
+        assert json.loads(request(con, {'op':'get', 'arg':'tokens'})) == {'orc':{'row':1, 'col':2, 'img':'black_circle'}}
+        con.close()
+    finally:
+        server.stop()
+    assert 'Failed to load map farm.csv' in server.output
+
+def test_recovers_without_snapshot_map(map_dir):
+    server = Server(map_dir)
+    con = server.connect()
+    assert request(con, {'op':'admin', 'arg':'set_map', 'data':'farm.csv'}) == 'ack'
+    con.close()
+    time.sleep(0.3)
+    server.stop()
+    # a restart snapshots the recovered rooms, the next one starts from that snapshot
+    server = Server(map_dir)
+    snapshot_path = str(map_dir / 'state' / 'snapshot.json')
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        # written in the background, stopping the server before then would leave the journal to recover from
+        with open(snapshot_path, encoding='utf-8') as fin:
+            if 'farm.csv' in fin.read():
+                break
+        time.sleep(0.05)
+    server.stop()
+    os.remove(str(map_dir / 'maps' / 'farm.csv'))
+    server = Server(map_dir, 'huge_field.csv')
+    try:
+        con = server.connect()
+        assert json.loads(request(con, {'op':'get', 'arg':'map'})) == 'huge_field.csv'
+        con.close()
+    finally:
+        server.stop()
+    assert 'Failed to load map of room default' in server.output
+
+def send(con, req):
+    con.sendall(encode_message(json.dumps(req)))
+
+def next_tokens(con):
+    # the next token delta pushed, skipping the other pushes
+    while True:
+        message = json.loads(recv_message(con))
+        if message.get('type') == 'tokens':
+            return message
+
+def subscribe(server, viewport):
+    con = server.connect()
+    send(con, {'op':'subscribe', 'arg':'tokens', 'data':None})
+    assert next_tokens(con)['base'] is None
+    send(con, {'op':'viewport', 'data':viewport})
+    assert next_tokens(con)['base'] is None
+    return con
+
+def place(con, name, row, col):
+    assert request(con, {'op':'set', 'arg':'place_token',
+                         'data':{'name':name, 'row':row, 'col':col, 'img':'black_circle'}}) == 'ack'
+
+def test_same_viewport_gets_same_deltas(map_dir):
+    server = Server(map_dir, 'huge_field.csv')
+    try:
+        admin = server.connect()
+        clients = [subscribe(server, [0, 0, 10, 10]) for _ in range(2)]
+        place(admin, 'orc', 5, 5)
+        deltas = [next_tokens(con) for con in clients]
+        assert deltas[0] == deltas[1]
+        assert deltas[0]['tokens'] == {'orc':{'row':5, 'col':5, 'img':'black_circle'}}
+        # a token far away changes nothing they see, leaving the view removes it for both
+        place(admin, 'far', 100, 100)
+        place(admin, 'orc', 90, 90)
+        deltas = [next_tokens(con) for con in clients]
+        assert deltas[0] == deltas[1]
+        assert deltas[0]['tokens'] == {} and deltas[0]['removed'] == ['orc']
+        for con in clients + [admin]:
+            con.close()
+    finally:
+        server.stop()
+
+def test_viewport_covering_map_gets_every_token(server):
+    con = server.connect()
+    send(con, {'op':'subscribe', 'arg':'tokens', 'data':None})
+    assert next_tokens(con)['base'] is None
+    # nothing is resent, the client already has every token
+    send(con, {'op':'viewport', 'data':[0, 0, 60, 60]})
+    admin = server.connect()
+    place(admin, 'orc', 50, 25)
+    assert next_tokens(con)['tokens'] == {'orc':{'row':50, 'col':25, 'img':'black_circle'}}
+    con.close()
+    admin.close()
+
+def test_fog_hides_tokens_from_players(map_dir):
+    server = Server(map_dir, 'huge_field.csv')
+    try:
+        admin = server.connect()
+        place(admin, 'hero', 1, 1)
+        place(admin, 'orc', 100, 100)
+        assert request(admin, {'op':'admin', 'arg':'fog', 'data':True}) == 'ack'
+        player = server.connect()
+        send(player, {'op':'player', 'data':['hero']})
+        assert list(json.loads(request(player, {'op':'get', 'arg':'tokens'}))) == ['hero']
+        # nor can a player read them through the admin requests
+        assert request(player, {'op':'admin', 'arg':'export_encounter'}) == 'err'
+        assert sorted(json.loads(request(admin, {'op':'get', 'arg':'tokens'}))) == ['hero', 'orc']
+        player.close()
+        admin.close()
+    finally:
+        server.stop()
+
+def subscribe_since(server, since):
+    con = server.connect()
+    send(con, {'op':'subscribe', 'arg':'tokens', 'data':since})
+    delta = next_tokens(con)
+    con.close()
+    return delta
+
+def test_token_deltas_resync_after_reset(server):
+    admin = server.connect()
+    place(admin, 'orc', 1, 1)
+    version = subscribe_since(server, None)['version']
+    place(admin, 'goblin', 2, 2)
+    delta = subscribe_since(server, version)
+    assert delta['base'] == version and list(delta['tokens']) == ['goblin']
+    # a new map drops every token, clients from before it get the whole set
+    assert request(admin, {'op':'admin', 'arg':'set_map', 'data':'farm.csv'}) == 'ack'
+    place(admin, 'elf', 1, 1)
+    delta = subscribe_since(server, version + 1)
+    assert delta['base'] is None and list(delta['tokens']) == ['elf']
+    delta = subscribe_since(server, version + 2)
+    assert delta['base'] == version + 2 and list(delta['tokens']) == ['elf']
+    # as do clients claiming a version the room never reached
+    assert subscribe_since(server, version + 10)['base'] is None
+    admin.close()
+
+def test_cell_edits_are_checked(server):
+    con = server.connect()
+    map_hash = json.loads(request(con, {'op':'get', 'arg':'map', 'data':{}}))['hash']
+    for cells in ([True], [-1], [10**6], ['1'], 5):
+        assert request(con, {'op':'set', 'arg':'cells', 'data':{'map':map_hash, 'cells':{'stone':cells}}}) == 'err'
+    assert request(con, {'op':'set', 'arg':'cells', 'data':{'map':map_hash, 'cells':{'stone':[0, 1]}}}) == 'ack'
+    header = json.loads(request(con, {'op':'get', 'arg':'map', 'data':{}}))
+    assert header['edits'] == 1 and header['cells'] == {'stone':[0, 1]}
+    con.close()
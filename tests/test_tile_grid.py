@@ -0,0 +1,27 @@
+from simple_map.tile_grid import TileGrid
+
+def test_palette_is_shared_by_equal_tiles():
+    grid = TileGrid.from_names([['grass', 'stone'], ['stone', 'grass', 'grass']])
+    assert grid.palette == ['grass', 'stone']
+    assert [list(row) for row in grid.rows] == [[0, 1], [1, 0, 0]]
+    assert grid.num_cols == 3 and grid.row_len(0) == 2
+
+def test_set_adds_new_tiles_to_the_palette():
+    grid = TileGrid.blank(2, 2, 'grass')
+    grid.set(1, 1, 'lava')
+    grid.set(0, 1, 'lava')
+    assert grid.palette == ['grass', 'lava']
+    assert grid.get(1, 1) == 'lava' and grid.get(0, 0) == 'grass'
+    assert grid.count('lava') == 2 and grid.count('ice') == 0
+
+def test_copy_is_independent():
+    grid = TileGrid.blank(2, 2, 'grass')
+    copy = grid.copy()
+    copy.set(0, 0, 'lava')
+    assert grid.get(0, 0) == 'grass' and grid.palette == ['grass']
+
+def test_csv_round_trip(tmp_path):
+    grid = TileGrid.from_names([['grass', 'stone'], ['water']])
+    path = str(tmp_path / 'map.csv')
+    grid.save_csv(path)
+    assert TileGrid.read_csv(path).to_names() == [['grass', 'stone'], ['water']]